@@ -2,80 +2,234 @@ import requests
 from typing import Union, Iterable
 import ssl
 import asyncio
+import threading
 import time
 
 import aiohttp
 
 from dsurl import BaseExpirePolicy, DSUrl
-
-
-def iter_over_async(ait, loop):
-    ait = ait.__aiter__()
-    async def get_next():
-        try:
-            obj = await ait.__anext__()
-            return False, obj
-        except StopAsyncIteration:
-            return True, None
-    while True:
-        done, obj = loop.run_until_complete(get_next())
-        if done:
-            break
-        yield obj
+from rate_limit import RateLimiter
 
 
 class ApiExpirePolicy(BaseExpirePolicy):
-    api_url_template = "https://discord.com/api/v9/channels/{channel_id}/messages?{message_id}&limit=3"
+    """
+    Renew URLs by fetching their messages through the Discord API
+
+    Renewals run in a service thread of the policy, which owns the event loop and
+    one pooled session, so any number of threads can renew at the same time. A
+    message being fetched for one thread is not fetched again for another, they all
+    get the answer of the same API call. Calls go through the RateLimiter shared by
+    everything in the process using the same bot token.
+    """
+    api_url_template = "https://discord.com/api/v9/channels/{channel_id}/messages/{message_id}"
+    message_route = "GET /channels/{channel_id}/messages/{message_id}"
+    batch_size = 1  # URLs renewed per call
+    max_connections = 8
 
     def __init__(self):
         self.loop = asyncio.new_event_loop()
-    
-    async def fetch_msg(self, session: aiohttp.ClientSession, url:DSUrl, force_get=False):
-        if not self.is_expired(url) and not force_get:
-            return url
-        async with session.get(self.api_url_template.format(channel_id=url.channel_id, message_id=url.message_id), ssl=ssl.SSLContext()) as response:
-            status = response.status
-            if status != 200:
-                if status == 429:
-                    # get retry_after
-                    retry_after = response.headers["Retry-After"] + 0.08
-                    await asyncio.sleep(retry_after)
-                    return await self.fetch_msg(session, url)
-                else:
-                    raise Exception(f"Status code {status}")
-            resp = await response.json()
-            return resp[0]["attachments"][0]["url"], resp[0]["id"]
-
-    async def fetch_msg_all(self, urls: Iterable[DSUrl], loop: asyncio.AbstractEventLoop=None):
-        if loop is None:
-            loop = asyncio.get_event_loop()
-        async with aiohttp.ClientSession(loop=loop, headers={"Authorization": f"Bot {self.token}"}) as session:
-            tasks = []
-            for url in urls:
-                task = asyncio.ensure_future(self.fetch_msg(session, url))
-                tasks.append(task)
-                await asyncio.sleep(1/45)
-            
-            for task in tasks:
-                yield await task
-            # return await asyncio.gather(*tasks, return_exceptions=True)
-        
+        self.token = None
+        self.limiter = None
+        self._thread = None
+        self._thread_lock = threading.Lock()
+        self._session = None
+        self._ssl = None
+        self._inflight = {}  # (channel ID, message ID) -> future of the renewed DSUrl, only touched in the loop
+
     def setup(self, token):
         self.token = token
+        self.limiter = RateLimiter.shared(token)
 
-    def renew_url(self, dsurls: Iterable[DSUrl]) -> Iterable[DSUrl]:
-        # urls = [self.api_url_template.format(channel_id=dsurl.channel_id, message_id=dsurl.message_id) for dsurl in dsurls]
-        results = self.fetch_msg_all(dsurls)
-        results = iter_over_async(results, self.loop)
-        
-        for result in results:
-            if isinstance(result, Exception):
-                raise result
-            yield result
+    def _ensure_running(self):
+        with self._thread_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self.loop.run_forever, name="url-renewal", daemon=True)
+                self._thread.start()
 
-    def __del__(self):
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None:
+            self._ssl = ssl.create_default_context()
+            self._session = aiohttp.ClientSession(
+                headers={"Authorization": f"Bot {self.token}"},
+                connector=aiohttp.TCPConnector(limit=self.max_connections, ssl=self._ssl),
+            )
+        return self._session
+
+    async def fetch_msg(self, url: DSUrl):
+        """
+        Renew a URL by fetching the message it's attached to
+
+        Args:
+            url (DSUrl): The URL to renew
+
+        Returns:
+            DSUrl: The renewed URL
+        """
+        while True:
+            await self.limiter.acquire(self.message_route, url.channel_id)
+            async with self._get_session().get(self.api_url_template.format(channel_id=url.channel_id, message_id=url.message_id)) as response:
+                status = response.status
+                self.limiter.update(self.message_route, url.channel_id, status, response.headers)
+                if status == 429:
+                    continue  # the limiter holds the next call back for Retry-After
+                if status != 200:
+                    raise Exception(f"Status code {status}")
+                resp = await response.json()
+            break
+        # a message may carry several attachments, pick the one the URL points to
+        for attachment in resp["attachments"]:
+            if int(attachment["id"]) == url.attachment_id:
+                return DSUrl.from_url(attachment["url"], int(resp["id"]))
+        raise Exception(f"Attachment {url.attachment_id} not found in message {url.message_id}")
+
+    async def fetch_each(self, urls: list):
+        """Renew URLs one message fetch each"""
+        return await asyncio.gather(*(self.fetch_msg(url) for url in urls))
+
+    async def renew_batch(self, urls: list):
+        """
+        Renew up to batch_size URLs, the ones another thread is renewing already are waited for
+
+        Args:
+            urls (list): The DSUrls to renew
+
+        Returns:
+            list: The renewed DSUrls, in the same order
+        """
+        futures = {}  # key -> future, whoever renews it
+        mine = {}  # key -> the first URL of the message, for the keys renewed here
+        for url in urls:
+            key = (url.channel_id, url.message_id)
+            if key in futures:
+                continue
+            if key not in self._inflight:
+                self._inflight[key] = self.loop.create_future()
+                mine[key] = url
+            futures[key] = self._inflight[key]
+        try:
+            renewed = await self.fetch_batch(list(mine.values()))
+            for key, url in zip(mine, renewed):
+                futures[key].set_result(url)
+        except Exception as e:
+            for key in mine:
+                if not futures[key].done():
+                    futures[key].set_exception(e)
+                    futures[key].exception()  # retrieved, even if no other thread waits on it
+            raise
+        finally:
+            for key in mine:
+                del self._inflight[key]
+        results = []
+        for url in urls:
+            result = await asyncio.shield(futures[(url.channel_id, url.message_id)])
+            if result.attachment_id != url.attachment_id:
+                # another attachment of the same message, not what the shared call renewed
+                result = (await self.fetch_batch([url]))[0]
+            results.append(result)
+        return results
+
+    async def fetch_batch(self, urls: list):
+        """Renew URLs, the calls are made here, see renew_batch"""
+        return await self.fetch_each(urls)
+
+    def renew_url(self, dsurls: Iterable[DSUrl], within: float=0) -> Iterable[DSUrl]:
+        dsurls = list(dsurls)
+        expired = [i for i, dsurl in enumerate(dsurls) if self.is_expired(dsurl, within)]
+        if not expired:
+            # nothing to ask Discord for, don't wake the service up
+            yield from dsurls
+            return
+        self._ensure_running()
+        batches = []
+        for start in range(0, len(expired), self.batch_size):
+            positions = expired[start:start + self.batch_size]
+            future = asyncio.run_coroutine_threadsafe(self.renew_batch([dsurls[i] for i in positions]), self.loop)
+            batches.append((positions, future))
+
+        # hand out the URLs in order, each as soon as the batch holding it is back
+        position = 0
+        for positions, future in batches:
+            for i, dsurl in zip(positions, future.result()):
+                dsurls[i] = dsurl
+            while position <= positions[-1]:
+                yield dsurls[position]
+                position += 1
+        yield from dsurls[position:]
+
+    def close(self):
+        """Close the session and stop the service thread"""
+        if self._thread is not None:
+            if self._session is not None:
+                asyncio.run_coroutine_threadsafe(self._session.close(), self.loop).result()
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self._thread.join()
+            self._thread = None
         self.loop.close()
 
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+class BatchExpirePolicy(ApiExpirePolicy):
+    """
+    Renew URLs in batches through Discord's attachment refresh endpoint
+
+    Up to batch_size expired URLs are refreshed per call, instead of one message
+    fetch per URL. The batches are sent one after the other without waiting for the
+    previous ones to answer, and the URLs come back in order as their batch lands.
+    A batch the endpoint fails on, and any URL it leaves out, is renewed by fetching
+    its message like ApiExpirePolicy does.
+    """
+    refresh_url = "https://discord.com/api/v9/attachments/refresh-urls"
+    refresh_route = "POST /attachments/refresh-urls"
+    batch_size = 50
+
+    async def fetch_batch(self, urls: list):
+        """
+        Refresh a batch of URLs
+
+        Args:
+            urls (list): The DSUrls to refresh, at most batch_size of them
+
+        Returns:
+            list: The refreshed DSUrls, in the same order
+        """
+        if not urls:
+            return []
+        try:
+            while True:
+                await self.limiter.acquire(self.refresh_route)
+                async with self._get_session().post(self.refresh_url, json={"attachment_urls": [url.full_url for url in urls]}) as response:
+                    status = response.status
+                    self.limiter.update(self.refresh_route, None, status, response.headers)
+                    if status == 429:
+                        continue
+                    if status != 200:
+                        raise Exception(f"Status code {status}")
+                    resp = await response.json()
+                break
+            by_attachment = {url.attachment_id: url for url in urls}
+            refreshed = {}
+            for item in resp["refreshed_urls"]:
+                new = DSUrl.from_url(item["refreshed"], None)
+                old = by_attachment.get(new.attachment_id)
+                if old is not None:
+                    new.message_id = old.message_id  # the CDN URL doesn't tell
+                    refreshed[new.attachment_id] = new
+        except Exception as e:
+            print(f"Refreshing {len(urls)} URLs in a batch failed, fetching their messages instead: {e}")
+            refreshed = {}
+        missing = [url for url in urls if url.attachment_id not in refreshed]
+        for url in await self.fetch_each(missing):
+            refreshed[url.attachment_id] = url
+        return [refreshed[url.attachment_id] for url in urls]
+
+
+EXPIRE_POLICIES = {"api": ApiExpirePolicy, "batch": BatchExpirePolicy}
+
 
 def test():
     from datetime import datetime
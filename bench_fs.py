@@ -0,0 +1,77 @@
+import argparse
+import timeit
+
+from dsdrive_api import DSdriveApi, MemoryHookTool
+from discord_fs import DiscordFS
+
+
+def make_fs(backend: str, url: str):
+    """Create a DiscordFS whose data is kept in memory, and whose metadata is in the given backend"""
+    dsdriveapi = DSdriveApi(url, MemoryHookTool(), backend=backend)
+    dsdriveapi.clear()
+    return DiscordFS(dsdriveapi)
+
+
+def setup_tree(dsfs: DiscordFS, width: int):
+    """Create the tree the benchmarks run on, a few levels deep, with width files in /wide"""
+    dsfs.makedirs("/a/b/c/d")
+    dsfs.writebytes("/a/b/c/d/file", b"x" * 1024)
+    dsfs.makedir("/wide")
+    for i in range(width):
+        dsfs.writebytes(f"/wide/{i:06d}", b"")
+
+
+def bench(dsfs: DiscordFS, number: int):
+    """
+    Time the operations of DiscordFS
+
+    Returns:
+        results (list): (name, microseconds per call) tuples
+    """
+    counter = iter(range(10**9))
+
+    def makedir_removedir():
+        path = f"/tmp{next(counter)}"
+        dsfs.makedir(path)
+        dsfs.removedir(path)
+
+    def move_back_and_forth():
+        dsfs.move("/a/b/c/d/file", "/a/file")
+        dsfs.move("/a/file", "/a/b/c/d/file")
+
+    cases = [
+        ("exists /a/b/c/d/file", lambda: dsfs.exists("/a/b/c/d/file")),
+        ("getinfo /a/b/c/d/file", lambda: dsfs.getinfo("/a/b/c/d/file", namespaces=["details"])),
+        ("listdir /a", lambda: dsfs.listdir("/a")),
+        ("listdir /wide", lambda: dsfs.listdir("/wide")),
+        ("scandir /wide", lambda: list(dsfs.scandir("/wide", namespaces=["details"]))),
+        ("makedir + removedir", makedir_removedir),
+        ("move file x2", move_back_and_forth),
+        ("writebytes 1 KiB", lambda: dsfs.writebytes("/a/b/c/d/file", b"y" * 1024)),
+        ("readbytes 1 KiB", lambda: dsfs.readbytes("/a/b/c/d/file")),
+        ("getusage /", lambda: dsfs.getusage("/")),
+    ]
+    results = []
+    for name, func in cases:
+        func()  # warm up
+        seconds = min(timeit.repeat(func, number=number, repeat=3))
+        results.append((name, seconds / number * 1e6))
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure the per operation overhead of DiscordFS, with the data kept in memory")
+    parser.add_argument("-b", "--backend", type=str, default="memory", choices=["memory", "sqlite", "mongodb"],
+                        help="set metadata backend")
+    parser.add_argument("-u", "--url", type=str, default=None,
+                        help="set mongodb url, or the sqlite database path")
+    parser.add_argument("-n", "--number", type=int, default=200,
+                        help="set the number of calls per measurement")
+    parser.add_argument("-w", "--width", type=int, default=1000,
+                        help="set the number of files in the wide directory")
+    args = parser.parse_args()
+
+    dsfs = make_fs(args.backend, args.url)
+    setup_tree(dsfs, args.width)
+    for name, micros in bench(dsfs, args.number):
+        print(f"{name:<28}{micros:>12.1f} us")
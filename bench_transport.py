@@ -0,0 +1,90 @@
+import argparse
+import os
+import threading
+import time
+
+import paramiko
+
+from bench_fs import make_fs
+from config_loader import Config
+from expose_sftp import BaseSFTPServer
+from transport_profile import make_profiles
+
+_MIB = 1024 * 1024
+
+
+def start_server(profile, backend: str, url: str):
+    """Serve a DiscordFS kept in memory over SFTP on a free local port, with the transport profile given"""
+    server = BaseSFTPServer(("127.0.0.1", 0), fs=make_fs(backend, url), host_key=paramiko.ECDSAKey.generate(), noauth=True, profile=profile)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def connect(server, profile):
+    """Open an SFTP client to the server, preferring the first algorithms of the profile as a client would"""
+    transport = paramiko.Transport(server.server_address, **profile.transport_options())
+    profile.apply(transport)
+    transport.connect(username="bench", password="bench")
+    return transport, paramiko.SFTPClient.from_transport(transport)
+
+
+def bench(profile, data: bytes, request_size: int, backend: str, url: str):
+    """
+    Upload and download a file through a profile
+
+    Returns:
+        negotiated (str): The cipher, MAC and compression agreed on
+        upload (float): The upload throughput, in MiB/s
+        download (float): The download throughput, in MiB/s
+    """
+    server = start_server(profile, backend, url)
+    transport, sftp = connect(server, profile)
+    try:
+        start = time.perf_counter()
+        with sftp.open("/bench", "w") as file:
+            file.set_pipelined(True)
+            for offset in range(0, len(data), request_size):
+                file.write(data[offset:offset + request_size])
+        upload = time.perf_counter() - start
+
+        start = time.perf_counter()
+        with sftp.open("/bench") as file:
+            file.prefetch(len(data))
+            received = file.read()
+        download = time.perf_counter() - start
+        if received != data:
+            raise RuntimeError(f"Profile {profile.name} read back different data")
+        negotiated = f"{transport.local_cipher}, {transport.local_mac}, {transport.local_compression}"
+    finally:
+        sftp.close()
+        transport.close()
+        server.shutdown()
+        server.server_close()
+    return negotiated, len(data) / _MIB / upload, len(data) / _MIB / download
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the SFTP throughput of the transport profiles, with the data kept in memory")
+    parser.add_argument("profiles", nargs="*",
+                        help="the profiles to compare, all of them by default")
+    parser.add_argument("-c", "--config", type=str, default=".conf/config.yaml",
+                        help="the config file holding the TransportProfiles")
+    parser.add_argument("-s", "--size", type=int, default=64,
+                        help="set the size of the file transferred, in MiB")
+    parser.add_argument("-r", "--request-size", type=int, default=255 * 1024,
+                        help="set the bytes per SFTP read and write, OpenSSH asks for 255 KiB when limits@openssh.com allows it")
+    parser.add_argument("-z", "--zeros", action="store_true",
+                        help="transfer zeros instead of random bytes, which compress unlike media")
+    parser.add_argument("-b", "--backend", type=str, default="memory", choices=["memory", "sqlite", "mongodb"],
+                        help="set metadata backend")
+    parser.add_argument("-u", "--url", type=str, default=None,
+                        help="set mongodb url, or the sqlite database path")
+    args = parser.parse_args()
+
+    profiles = make_profiles(Config(config_filename=args.config).transport_profiles if os.path.exists(args.config) else None)
+    # the paramiko client splits reads and writes at this size
+    paramiko.sftp_file.SFTPFile.MAX_REQUEST_SIZE = args.request_size
+    data = bytes(args.size * _MIB) if args.zeros else os.urandom(args.size * _MIB)
+    for name in args.profiles or profiles:
+        negotiated, upload, download = bench(profiles[name], data, args.request_size, args.backend, args.url)
+        print(f"{name:<12}{upload:>10.1f} MiB/s up{download:>10.1f} MiB/s down    {negotiated}")
@@ -78,7 +78,8 @@ class BotExpirePolicy(BaseExpirePolicy):
     def setup(self, token: str):
         self.run_bot_background(token)
     
-    def renew_url(self, dsurls: Iterable[DSUrl]) -> Iterable[DSUrl]:
+    def renew_url(self, dsurls: Iterable[DSUrl], within: float=0) -> Iterable[DSUrl]:
+        # renews every URL, expired or not, so within makes no difference
         events = []
         for dsurl in dsurls:
             channel_id = dsurl.channel_id
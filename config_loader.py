@@ -22,13 +22,73 @@ class Config:
             mongo_port = mongodb_config.get("Port", "27017")
             self.mgdb_url = f"{mongo_prefix}{mongo_host}:{mongo_port}"
 
+            metadata_config = config.get("Metadata", {})
+            self.meta_backend = metadata_config.get("Backend", "mongodb")
+            self.meta_path = metadata_config.get("Path", ".conf/metadata.sqlite3")
+            self.meta_url = self.mgdb_url if self.meta_backend == "mongodb" else self.meta_path
+            self.meta_cache = metadata_config.get("Cache", False)
+            self.meta_max_staleness = metadata_config.get("MaxStaleness", 5.0)
+
+            refresh_config = config.get("UrlRefresh", {})
+            self.refresh_policy = refresh_config.get("Policy", "batch")
+            self.refresh_enabled = refresh_config.get("Enabled", False)
+            self.refresh_lead_time = refresh_config.get("LeadTime", 3600)
+            self.refresh_interval = refresh_config.get("Interval", 60)
+            self.refresh_budget = refresh_config.get("Budget", 600)
+            self.refresh_recent_time = refresh_config.get("RecentTime", 86400)
+
+            rate_config = config.get("RateLimit", {})
+            self.rate_limit = rate_config.get("Rate", 45)
+            self.rate_burst = rate_config.get("Burst", 5)
+            self.rate_lease = rate_config.get("Lease", False)
+
             sftp_config = config.get("SFTP", {})
             self.sftp_host = sftp_config.get("Host", "0.0.0.0")
             self.sftp_port = sftp_config.get("Port", "8022")
             self.sftp_noauth = sftp_config.get("NoAuth", False)
             self.sftp_auths = sftp_config.get("Auths", [{"Username": "Anonymous", "Password": "susman"}])
+            self.sftp_recursive_rmdir = sftp_config.get("RecursiveRmdir", False)
+            self.sftp_workers = sftp_config.get("Workers", 1)
+            self.sftp_max_connections = sftp_config.get("MaxConnections", 100)
+            self.sftp_max_sessions_per_user = sftp_config.get("MaxSessionsPerUser", 10)
+            self.sftp_accept_queue = sftp_config.get("AcceptQueue", 200)
+            self.sftp_handshake_workers = sftp_config.get("HandshakeWorkers", 8)
+            self.sftp_fs_workers = sftp_config.get("FsWorkers", 16)
+            self.sftp_busy_timeout = sftp_config.get("BusyTimeout", 30)
+            self.sftp_profile = sftp_config.get("Profile", "default")
+            # more addresses to listen on besides Host and Port, each with its own transport profile
+            self.sftp_listeners = [
+                {"host": listener.get("Host", "0.0.0.0"), "port": int(listener["Port"]), "profile": listener.get("Profile", "default")}
+                for listener in sftp_config.get("Listeners") or []
+            ]
+
+            self.transport_profiles = config.get("TransportProfiles") or {}
     
 
+    @property
+    def refresh_options(self):
+        """The keyword arguments of DSdriveApi's refresh, None when the refresher is disabled"""
+        if not self.refresh_enabled:
+            return None
+        return {
+            "lead_time": self.refresh_lead_time,
+            "interval": self.refresh_interval,
+            "budget": self.refresh_budget,
+            "recent_time": self.refresh_recent_time,
+        }
+
+    @property
+    def sftp_limits(self):
+        """The keyword arguments of the ConnectionManager of the SFTP server"""
+        return {
+            "max_connections": self.sftp_max_connections,
+            "max_sessions_per_user": self.sftp_max_sessions_per_user,
+            "accept_queue": self.sftp_accept_queue,
+            "handshake_workers": self.sftp_handshake_workers,
+            "fs_workers": self.sftp_fs_workers,
+            "busy_timeout": self.sftp_busy_timeout,
+        }
+
     def load_host_key(self, host_key_filename):
         self.sftp_host_key = paramiko.RSAKey.from_private_key_file(host_key_filename)
     
@@ -45,10 +105,25 @@ class Config:
 def test_loader():
     config = Config(config_filename=".conf/config.yaml", host_key_filename=".conf/host_key", webhooks_filename=".conf/webhooks.txt", bot_token_filename=".conf/bot_token")
     print(config.mgdb_url)
+    print(config.meta_backend)
+    print(config.meta_url)
+    print(config.meta_cache)
+    print(config.meta_max_staleness)
+    print(config.refresh_policy)
+    print(config.refresh_options)
+    print(config.rate_limit)
+    print(config.rate_burst)
+    print(config.rate_lease)
     print(config.sftp_host)
     print(config.sftp_port)
     print(config.sftp_noauth)
     print(config.sftp_auths)
+    print(config.sftp_recursive_rmdir)
+    print(config.sftp_workers)
+    print(config.sftp_limits)
+    print(config.sftp_profile)
+    print(config.sftp_listeners)
+    print(config.transport_profiles)
     print(config.sftp_host_key)
     print(config.webhooks)
     print(config.bot_token)
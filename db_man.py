@@ -1,12 +1,20 @@
 #!/usr/bin/env python3
+import datetime
+import time
+
 import click
 from pymongo import MongoClient
 import bson
 import yaml
 
+from config_loader import Config
+from dsdrive_api import DSdriveApi, HookTool
+from meta_store import migrate_manifests
+
 # MongoDB connection parameters
 DB_NAME = "dsdrive"
 COLLECTION_NAME = "tree"
+CHUNKS_COLLECTION_NAME = "chunks"
 
 # Default MongoDB connection parameters
 DEFAULT_MONGO_HOST = "localhost"
@@ -14,6 +22,27 @@ DEFAULT_MONGO_PORT = 27017
 DEFAULT_DB_NAME = "your_database_name"
 DEFAULT_COLLECTION_NAME = "your_collection_name"
 
+SIZE_UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+DURATION_UNITS = {"": 1, "s": 1, "m": 60, "h": 3600, "d": 86400}
+
+
+def parse_amount(text, units):
+    """Parse a number with an optional unit suffix, such as 1G or 12h."""
+    text = text.strip()
+    unit = text[-1:] if text[-1:].isalpha() else ""
+    if unit not in units:
+        raise click.BadParameter(f"unknown unit in {text}, use one of {', '.join(u for u in units if u)}")
+    return int(float(text[:len(text) - len(unit)]) * units[unit])
+
+
+def make_api(ctx):
+    """Open the drive on the metadata backend of the config file, or on MongoDB at --mongourl without one."""
+    config = ctx.obj['config']
+    if config is None:
+        return DSdriveApi(ctx.obj['url'], HookTool([]))
+    return DSdriveApi(config.meta_url, HookTool([]), backend=config.meta_backend, cache=config.meta_cache, max_staleness=config.meta_max_staleness)
+
+
 @click.group()
 @click.option('--mongourl', default=DEFAULT_MONGO_HOST, help='MongoDB url')
 @click.option('--config', default=None, help='Config file, if provided, other options will be ignored.')
@@ -21,17 +50,23 @@ DEFAULT_COLLECTION_NAME = "your_collection_name"
 def cli(ctx, mongourl, config):
     """Simple CLI for dumping and loading MongoDB data."""
     ctx.ensure_object(dict)
+    ctx.obj['url'] = mongourl
     ctx.obj['client'] = MongoClient(mongourl)
-    with open(config, "r") as file:
-        _config = yaml.load(file.read(), Loader=yaml.FullLoader)
-        mongodb_config = _config.get("MongoDB", {})
-        prefix = mongodb_config.get("Prefix", "mongodb://")
-        MONGO_HOST = mongodb_config.get("Host", "127.0.0.1")
-        MONGO_PORT = mongodb_config.get("Port", "27017")
-        mgdb_url = f"{prefix}{MONGO_HOST}:{MONGO_PORT}"
-        ctx.obj['client'] = MongoClient(mgdb_url)
+    ctx.obj['config'] = None
+    if config is not None:
+        ctx.obj['config'] = Config(config_filename=config)
+        with open(config, "r") as file:
+            _config = yaml.load(file.read(), Loader=yaml.FullLoader)
+            mongodb_config = _config.get("MongoDB", {})
+            prefix = mongodb_config.get("Prefix", "mongodb://")
+            MONGO_HOST = mongodb_config.get("Host", "127.0.0.1")
+            MONGO_PORT = mongodb_config.get("Port", "27017")
+            mgdb_url = f"{prefix}{MONGO_HOST}:{MONGO_PORT}"
+            ctx.obj['url'] = mgdb_url
+            ctx.obj['client'] = MongoClient(mgdb_url)
     ctx.obj['db'] = ctx.obj['client'][DB_NAME]
     ctx.obj['collection'] = ctx.obj['db'][COLLECTION_NAME]
+    ctx.obj['chunks'] = ctx.obj['db'][CHUNKS_COLLECTION_NAME]
 
 
 @cli.command()
@@ -44,6 +79,7 @@ def dump(ctx, output_file, key, webhooks, encrypt):
     """Dump MongoDB data to a file."""
     data = {}
     data["database"] = list(ctx.obj['collection'].find())
+    data["chunks"] = list(ctx.obj['chunks'].find())
     if key:
         with open(".conf/host_key", "rb") as file:
             data["key"] = file.read()
@@ -61,10 +97,85 @@ def dump(ctx, output_file, key, webhooks, encrypt):
 def load(ctx, input_file):
     """Load MongoDB data from a BSON file."""
     bson_data = input_file.read()
-    data = list(bson.decode_all(bson_data)[0]["data"])
-    ctx.obj['collection'].insert_many(data)
+    data = bson.decode_all(bson_data)[0]
+    ctx.obj['collection'].insert_many(list(data["database"]))
+    if data.get("chunks"):
+        ctx.obj['chunks'].insert_many(list(data["chunks"]))
     click.echo("Data loaded successfully.")
 
 
+@cli.command()
+@click.pass_context
+def migrate(ctx):
+    """Move chunk manifests out of file documents into their own collection."""
+    count = migrate_manifests(ctx.obj['db'])
+    click.echo(f"Migrated {count} files.")
+
+
+@cli.command("repair-usage")
+@click.pass_context
+def repair_usage(ctx):
+    """Recompute the size and file count stored under every folder."""
+    api = make_api(ctx)
+    usage = api.rebuild_usage()
+    click.echo(f"Total: {usage['size']} bytes in {usage['files']} files.")
+
+
+@cli.command()
+@click.argument("path")
+@click.option("--unpin", is_flag=True, help="Unpin the file instead.")
+@click.pass_context
+def pin(ctx, path, unpin):
+    """Keep the CDN URLs of the file at PATH fresh in the background."""
+    api = make_api(ctx)
+    code = api.pin(path, not unpin)
+    if code == 1:
+        raise click.ClickException(f"{path} not found.")
+    if code == 2:
+        raise click.ClickException(f"{path} is not a file.")
+    click.echo(f"{path} {'unpinned' if unpin else 'pinned'}.")
+
+
+@cli.command()
+@click.argument("path", default="/")
+@click.option("--min-size", default=None, help="Smallest size, e.g. 1G.")
+@click.option("--max-size", default=None, help="Largest size, e.g. 500M.")
+@click.option("--modified-within", default=None, help="Only files modified in this long, e.g. 1d or 12h.")
+@click.option("--modified-before", default=None, help="Only files last modified this long ago, e.g. 30d.")
+@click.option("--name-prefix", default=None, help="Only files whose name starts with this.")
+@click.option("--sort", type=click.Choice(["name", "size", "modified"]), default="name", help="Sort field.")
+@click.option("--desc", is_flag=True, help="Sort in descending order.")
+@click.option("--limit", default=100, help="Files per page.")
+@click.option("--all", "all_pages", is_flag=True, help="Fetch every page instead of the first one.")
+@click.pass_context
+def query(ctx, path, min_size, max_size, modified_within, modified_before, name_prefix, sort, desc, limit, all_pages):
+    """Find files under PATH by size, modification time and name."""
+    api = make_api(ctx)
+    now = time.time()
+    filters = {
+        "min_size": None if min_size is None else parse_amount(min_size, SIZE_UNITS),
+        "max_size": None if max_size is None else parse_amount(max_size, SIZE_UNITS),
+        "modified_after": None if modified_within is None else now - parse_amount(modified_within, DURATION_UNITS),
+        "modified_before": None if modified_before is None else now - parse_amount(modified_before, DURATION_UNITS),
+        "name_prefix": name_prefix,
+        "sort": sort,
+        "descending": desc,
+    }
+    cursor = None
+    while True:
+        code, results, cursor = api.query(path, limit=limit, cursor=cursor, **filters)
+        if code == 1:
+            raise click.ClickException(f"{path} not found.")
+        if code == 2:
+            raise click.ClickException(f"{path} is not a directory.")
+        for file_path, fn in results:
+            modified = datetime.datetime.fromtimestamp(fn["details"]["modified"]).isoformat(sep=" ", timespec="seconds")
+            click.echo(f"{fn['details']['size']:>14}  {modified}  {file_path}")
+        if cursor is None or not all_pages:
+            break
+    if cursor is not None:
+        click.echo("More results, use --all to list them.")
+
+
 if __name__ == "__main__":
     cli()
\ No newline at end of file
@@ -1,4 +1,5 @@
-from typing import Text, Optional, Collection, Any, BinaryIO
+from typing import Text, Optional, Collection, Any, BinaryIO, Iterator, Tuple
+import itertools
 import os
 import string
 import sys
@@ -9,14 +10,100 @@ import fs.errors
 import fs.info
 import fs.subfs
 import fs.permissions
+import fs.path
+import fs.glob
+import fs.walk
+import fs.wildcard
 import yaml
 
-from dsdrive_api import DSdriveApi, HookTool
+from dsdrive_api import DSdriveApi, HookTool, MemoryHookTool
 from config_loader import Config
+from api_expire import EXPIRE_POLICIES
 
 sys.setrecursionlimit(1200)
 
+
+class DiscordWalker(fs.walk.Walker):
+    """A walker that reads the whole tree with a few queries up front, instead of one scandir per directory.
+
+    The ``filter`` patterns and ``max_depth`` are handed to the database, so files
+    that can't match are never read. Every other check is still done by
+    `~fs.walk.Walker`, on the listings read up front.
+
+    """
+
+    @classmethod
+    def bind(cls, dsfs):
+        # Walker.bind always binds a plain Walker
+        return fs.walk.BoundWalker(dsfs, cls)
+
+    def _iter_walk(self, dsfs, path, namespaces=None):
+        self._listings = {}
+        if isinstance(dsfs, DiscordFS):
+            try:
+                self._listings = dsfs._scan_tree(path, self.filter, self.max_depth)
+            except fs.errors.FSError:
+                pass  # the plain scandir raises it again, where on_error can handle it
+        return super()._iter_walk(dsfs, path, namespaces=namespaces)
+
+    def _scan(self, dsfs, dir_path, namespaces=None):
+        listing = self._listings.get(dir_path)
+        if listing is None:
+            return super()._scan(dsfs, dir_path, namespaces=namespaces)
+        return iter(listing)
+
+
+class DiscordGlobber(fs.glob.Globber):
+    """A globber that lets the database skip the files whose name can't match the last part of the pattern."""
+
+    def _make_iter(self, search="breadth", namespaces=None):
+        try:
+            levels, recursive, re_pattern = fs.glob._PATTERN_CACHE[
+                (self.pattern, self.case_sensitive)
+            ]
+        except KeyError:
+            levels, recursive, re_pattern = fs.glob._translate_glob(
+                self.pattern, case_sensitive=self.case_sensitive
+            )
+
+        name_pattern = fs.path.basename(self.pattern)
+        file_filter = None
+        if self.case_sensitive and name_pattern not in ("", "**"):
+            file_filter = [name_pattern]
+
+        for path, info in self.fs.walk.info(
+            path=self.path,
+            namespaces=namespaces or self.namespaces,
+            max_depth=None if recursive else levels,
+            search=search,
+            exclude_dirs=self.exclude_dirs,
+            filter=file_filter,
+        ):
+            if info.is_dir:
+                path += "/"
+            if re_pattern.match(path):
+                yield fs.glob.GlobMatch(path, info)
+
+
+class DiscordBoundGlobber(fs.glob.BoundGlobber):
+    """A `~fs.glob.BoundGlobber` making `DiscordGlobber` objects."""
+
+    __slots__ = []
+
+    def __call__(self, pattern, path="/", namespaces=None, case_sensitive=True, exclude_dirs=None):
+        return DiscordGlobber(
+            self.fs,
+            pattern,
+            path,
+            namespaces=namespaces,
+            case_sensitive=case_sensitive,
+            exclude_dirs=exclude_dirs,
+        )
+
+
 class DiscordFS(fs.base.FS):
+    walker_class = DiscordWalker
+
     def __init__(self, dsdrive_api=None) -> None:
         self.dsdrive_api: DSdriveApi = dsdrive_api
         self._lock = fs.base.threading.RLock()
@@ -70,14 +157,53 @@ class DiscordFS(fs.base.FS):
 
         """
         self.check()
-        stat, objs = list(self.dsdrive_api.list_dir(path))
+        stat, objs = self.dsdrive_api.list_dir(path)
         if stat == 1:
             raise fs.errors.ResourceNotFound(path)
         elif stat == 2:
             raise fs.errors.DirectoryExpected(path)
         return [i["name"] for i in objs]
 
+    def scandir(
+        self,
+        path,  # type: Text
+        namespaces=None,  # type: Optional[Collection[Text]]
+        page=None,  # type: Optional[Tuple[int, int]]
+    ):
+        # type: (...) -> Iterator[fs.info.Info]
+        """Get an iterator of resource info.
+
+        Entries are streamed from the database in batches sorted by name,
+        so the first entries are available before the whole directory is
+        read.
 
+        Arguments:
+            path (str): A path to a directory on the filesystem.
+            namespaces (list, optional): A list of namespaces to include
+                in the resource information, e.g. ``['basic', 'access']``.
+            page (tuple, optional): May be a tuple of ``(<start>, <end>)``
+                indexes to return an iterator of a subset of the resource
+                info, or `None` to iterate over the entire directory.
+
+        Returns:
+            ~collections.abc.Iterator: an iterator of `Info` objects.
+
+        Raises:
+            fs.errors.DirectoryExpected: If ``path`` is not a directory.
+            fs.errors.ResourceNotFound: If ``path`` does not exist.
+
+        """
+        self.check()
+        stat, objs = self.dsdrive_api.list_dir(path)
+        if stat == 1:
+            raise fs.errors.ResourceNotFound(path)
+        elif stat == 2:
+            raise fs.errors.DirectoryExpected(path)
+        iter_info = (fs.info.Info(self.dsdrive_api.raw_info(i)) for i in objs)
+        if page is not None:
+            start, end = page
+            iter_info = itertools.islice(iter_info, start, end)
+        return iter_info
 
     def makedir(
         self,
@@ -154,7 +280,7 @@ class DiscordFS(fs.base.FS):
         if not path.isprintable():
             raise fs.errors.InvalidCharsInPath(path)
         paths = self.dsdrive_api.path_splitter(path)
-        stat, fn = self.dsdrive_api.find(paths, return_obj=True)
+        stat, fn = self.dsdrive_api.find(paths, return_obj=True, projection=self.dsdrive_api.open_fields)
         if stat == 0:
             if fn["type"] == "folder":
                 raise fs.errors.FileExpected(path)
@@ -167,9 +293,10 @@ class DiscordFS(fs.base.FS):
                     raise fs.errors.ResourceNotFound((path, mode))           
             elif stat == 2:
                 raise fs.errors.ResourceNotFound((path, mode))
+            fn = None
 
-        
-        return self.dsdrive_api.open_binary(path, mode)
+        # the file found above is passed on, so opening costs a single lookup
+        return self.dsdrive_api.open_binary(path, mode, fn=fn)
     
     def copy(
         self,
@@ -206,6 +333,48 @@ class DiscordFS(fs.base.FS):
         elif stat == 3:
             raise fs.errors.DestinationExists(dst_path)
     
+    def copydir(
+        self,
+        src_path,  # type: Text
+        dst_path,  # type: Text
+        create=False,  # type: bool
+        preserve_time=False,  # type: bool
+    ):
+        # type: (...) -> None
+        """Copy the contents of ``src_path`` to ``dst_path``.
+
+        The copy only clones metadata, copied files share their chunks
+        with the originals.
+
+        Arguments:
+            src_path (str): Path of source directory.
+            dst_path (str): Path to destination directory.
+            create (bool): If `True`, then ``dst_path`` will be created
+                if it doesn't exist already (defaults to `False`).
+            preserve_time (bool): If `True`, try to preserve mtime of the
+                resource (defaults to `False`).
+
+        Raises:
+            fs.errors.ResourceNotFound: If the ``dst_path``
+                does not exist, and ``create`` is not `True`.
+            fs.errors.DirectoryExpected: If ``src_path`` is not a
+                directory.
+
+        """
+        self.check()
+        with self._lock:
+            stat = self.dsdrive_api.copy_tree(src_path, dst_path, create_dirs=create, preserve_timestamps=preserve_time)
+            if stat == 1:
+                raise fs.errors.ResourceNotFound(src_path)
+            elif stat == 2:
+                raise fs.errors.DirectoryExpected(src_path)
+            elif stat == 3:
+                raise fs.errors.DestinationExists(dst_path)
+            elif stat == 4:
+                raise fs.errors.ResourceNotFound(dst_path)
+            elif stat == 5:
+                raise fs.errors.OperationFailed(dst_path, msg="cannot copy a directory into itself")
+
     def move(self, src_path, dst_path, overwrite=False, preserve_time=False):
         # type: (Text, Text, bool, bool) -> None
         """Move a file from ``src_path`` to ``dst_path``.
@@ -229,7 +398,7 @@ class DiscordFS(fs.base.FS):
 
         """
         self.check()
-        stat = self.dsdrive_api.rename(src_path, dst_path, overwrite=overwrite, preserve_timestamps=preserve_time)
+        stat = self.dsdrive_api.rename(src_path, dst_path, overwrite=overwrite, preserve_timestamps=preserve_time, files_only=True)
         if stat == 1:
             raise fs.errors.ResourceNotFound(src_path)
         elif stat == 2:
@@ -237,6 +406,57 @@ class DiscordFS(fs.base.FS):
         elif stat == 3:
             raise fs.errors.DestinationExists(dst_path)
 
+    def movedir(self, src_path, dst_path, create=False, preserve_time=False):
+        # type: (Text, Text, bool, bool) -> None
+        """Move directory ``src_path`` to ``dst_path``.
+
+        If ``dst_path`` does not exist or is empty, the directory is
+        moved by relinking it to its new parent, without touching any of
+        its contents. Otherwise the contents of ``src_path`` are merged
+        into ``dst_path`` entry by entry, each entry being relinked in
+        the same way.
+
+        Arguments:
+            src_path (str): Path of source directory on the filesystem.
+            dst_path (str): Path to destination directory.
+            create (bool): If `True`, then ``dst_path`` will be created
+                if it doesn't exist already (defaults to `False`).
+            preserve_time (bool): If `True`, try to preserve mtime of the
+                resources (defaults to `False`).
+
+        Raises:
+            fs.errors.ResourceNotFound: if ``dst_path`` does not exist,
+                and ``create`` is `False`.
+            fs.errors.DirectoryExpected: if ``src_path`` or one of its
+                ancestors is not a directory.
+            fs.errors.OperationFailed: if ``dst_path`` is inside
+                ``src_path``.
+
+        """
+        self.check()
+        with self._lock:
+            if not create and not self.exists(dst_path):
+                raise fs.errors.ResourceNotFound(dst_path)
+            if not self.getinfo(src_path).is_dir:
+                raise fs.errors.DirectoryExpected(src_path)
+            stat = self.dsdrive_api.rename(src_path, dst_path, overwrite=True, preserve_timestamps=preserve_time)
+            if stat == 1:
+                raise fs.errors.ResourceNotFound(dst_path)
+            elif stat == 2:
+                raise fs.errors.DirectoryExpected(dst_path)
+            elif stat == 5:
+                raise fs.errors.OperationFailed(dst_path, msg="cannot move a directory into itself")
+            elif stat == 3:
+                # dst is a non-empty directory, merge into it
+                for info in list(self.scandir(src_path)):
+                    src_child = fs.path.join(src_path, info.name)
+                    dst_child = fs.path.join(dst_path, info.name)
+                    if info.is_dir:
+                        self.movedir(src_child, dst_child, create=True, preserve_time=preserve_time)
+                    else:
+                        self.move(src_child, dst_child, overwrite=True, preserve_time=preserve_time)
+                self.removedir(src_path)
+
     def remove(self, path):
         # type: (Text) -> None
         """Remove a file from the filesystem.
@@ -286,6 +506,37 @@ class DiscordFS(fs.base.FS):
         elif stat == 4:
             raise fs.errors.RemoveRootError(path)
 
+    def removetree(self, dir_path):
+        # type: (Text) -> None
+        """Recursively remove a directory and all its contents.
+
+        The whole subtree is removed with bulk metadata deletes rather
+        than walking the tree node by node.
+
+        Arguments:
+            dir_path (str): Path to a directory on the filesystem.
+
+        Raises:
+            fs.errors.ResourceNotFound: If ``dir_path`` does not exist.
+            fs.errors.DirectoryExpected: If ``dir_path`` is not a directory.
+
+        Caution:
+            A filesystem should never delete its root folder, so
+            ``FS.removetree("/")`` has different semantics: the
+            contents of the root folder will be deleted, but the
+            root will be untouched.
+
+        """
+        self.check()
+        keep_root = fs.path.abspath(fs.path.normpath(dir_path)) == "/"
+        stat = self.dsdrive_api.remove_tree(dir_path, keep_root=keep_root)
+        if stat == 1:
+            raise fs.errors.ResourceNotFound(dir_path)
+        elif stat == 2:
+            raise fs.errors.DirectoryExpected(dir_path)
+        elif stat == 4:
+            raise fs.errors.RemoveRootError(dir_path)
+
     def setinfo(self, path, info):
         # type: (Text, fs.info.RawInfo) -> None
         """Set info on a resource.
@@ -317,6 +568,158 @@ class DiscordFS(fs.base.FS):
         if stat == 1:
             raise fs.errors.ResourceNotFound(path)
     
+    def getusage(self, path):
+        # type: (Text) -> dict
+        """Get the number of bytes and files stored under a path.
+
+        Arguments:
+            path (str): A path to a resource on the filesystem.
+
+        Returns:
+            dict: the total ``size`` in bytes and the number of
+            ``files`` under ``path`` (a file counts itself).
+
+        Raises:
+            fs.errors.ResourceNotFound: If ``path`` does not exist.
+
+        """
+        self.check()
+        stat, usage = self.dsdrive_api.get_usage(path)
+        if stat == 1:
+            raise fs.errors.ResourceNotFound(path)
+        return usage
+
+    def gethashes(self, path, name):
+        # type: (Text, Text) -> Optional[dict]
+        """Get the digests of a file and of its chunks, recorded when it was written.
+
+        Arguments:
+            path (str): A path to a file on the filesystem.
+            name (str): The hash algorithm, ``"md5"`` or ``"sha1"``.
+
+        Returns:
+            dict: the hex digest of the whole ``file``, the ``chunk_size``
+            every chunk but the last holds, and the hex digests of the
+            ``chunks``, or `None` if the file has no such digests recorded.
+
+        Raises:
+            fs.errors.FileExpected: If ``path`` is not a file.
+            fs.errors.ResourceNotFound: If ``path`` does not exist.
+
+        """
+        self.check()
+        stat, hashes = self.dsdrive_api.get_hashes(path, name)
+        if stat == 1:
+            raise fs.errors.ResourceNotFound(path)
+        elif stat == 2:
+            raise fs.errors.FileExpected(path)
+        return hashes
+
+    def hash(self, path, name):
+        # type: (Text, Text) -> Text
+        """Get the hash of a file's contents.
+
+        The digest recorded when the file was written is returned when there
+        is one, otherwise the file is downloaded and hashed.
+
+        Arguments:
+            path (str): A path on the filesystem.
+            name (str): One of the algorithms supported by the `hashlib`
+                module, e.g. ``"md5"`` or ``"sha256"``.
+
+        Returns:
+            str: The hex digest of the hash.
+
+        Raises:
+            fs.errors.UnsupportedHash: If the requested hash is not supported.
+
+        """
+        hashes = self.gethashes(path, name)
+        if hashes is not None:
+            return hashes["file"]
+        return super(DiscordFS, self).hash(path, name)
+
+    def query(self, path="/", cursor=None, limit=100, **filters):
+        # type: (Text, Optional[Text], int, Any) -> Tuple[list, Optional[Text]]
+        """Find the files under a directory by size, modification time and name.
+
+        Arguments:
+            path (str): A path to a directory, searched recursively.
+            cursor (str, optional): The cursor returned with the previous
+                page, or `None` for the first page.
+            limit (int): The maximum number of files returned.
+            **filters: ``min_size``, ``max_size``, ``modified_after``,
+                ``modified_before`` (inclusive bounds, times are epoch
+                seconds), ``name_prefix``, ``sort`` (``"name"``,
+                ``"size"`` or ``"modified"``) and ``descending``.
+
+        Returns:
+            tuple: a list of ``(<path>, <info>)`` tuples, and the cursor
+            of the next page, or `None` if this is the last one.
+
+        Raises:
+            fs.errors.DirectoryExpected: If ``path`` is not a directory.
+            fs.errors.ResourceNotFound: If ``path`` does not exist.
+            ValueError: If ``sort`` is not a known field.
+
+        """
+        self.check()
+        stat, results, cursor = self.dsdrive_api.query(path, limit=limit, cursor=cursor, **filters)
+        if stat == 1:
+            raise fs.errors.ResourceNotFound(path)
+        elif stat == 2:
+            raise fs.errors.DirectoryExpected(path)
+        elif stat == 3:
+            raise ValueError("sort must be 'name', 'size' or 'modified'")
+        return [(p, fs.info.Info(self.dsdrive_api.raw_info(fn))) for p, fn in results], cursor
+
+    @property
+    def glob(self):
+        """`DiscordBoundGlobber`: a globber object, filtering file names in the database."""
+        return DiscordBoundGlobber(self)
+
+    def _scan_tree(self, path, patterns=None, max_depth=None):
+        """Read the listings of a directory and all its subdirectories.
+
+        Arguments:
+            path (str): A path to a directory on the filesystem.
+            patterns (list, optional): Wildcard patterns, only the files
+                matching one of them are listed.
+            max_depth (int, optional): How many levels to read, 1 only
+                lists ``path``.
+
+        Returns:
+            dict: The `Info` objects of the entries of each directory,
+            sorted by name, by the path of the directory.
+
+        Raises:
+            fs.errors.DirectoryExpected: If ``path`` is not a directory.
+            fs.errors.ResourceNotFound: If ``path`` does not exist.
+
+        """
+        self.check()
+        file_pattern = None
+        if patterns is not None:
+            file_pattern = "|".join(
+                "(?:%s)" % fs.wildcard._translate(p)
+                for p in patterns
+            )
+        stat, entries = self.dsdrive_api.scan_tree(path, file_pattern, max_depth)
+        if stat == 1:
+            raise fs.errors.ResourceNotFound(path)
+        elif stat == 2:
+            raise fs.errors.DirectoryExpected(path)
+
+        listings = {path: []}
+        for dir_path, fn in entries:
+            dir_path = fs.path.combine(path, dir_path) if dir_path else path
+            if fn["type"] == "folder":
+                listings[fs.path.combine(dir_path, fn["name"])] = []
+            listings[dir_path].append(fs.info.Info(self.dsdrive_api.raw_info(fn)))
+        for listing in listings.values():
+            listing.sort(key=lambda info: info.name)
+        return listings
+
     def validatepath(self, path: Text) -> Text:
         if not path.isprintable():
             raise fs.errors.InvalidCharsInPath(path)
@@ -325,10 +728,15 @@ class DiscordFS(fs.base.FS):
 
 if __name__ == "__main__":
     fulltest = True
-    configs = Config(config_filename=".conf/config.yaml", host_key_filename=".conf/host_key", webhooks_filename=".conf/webhooks.txt", bot_token_filename=".conf/bot_token")
-    hooks = HookTool(configs.webhooks)
+    in_memory = "--memory" in sys.argv  # run without MongoDB and Discord
+    if in_memory:
+        sys.argv.remove("--memory")
+        dsdriveapi = DSdriveApi(None, MemoryHookTool(), backend="memory")
+    else:
+        configs = Config(config_filename=".conf/config.yaml", host_key_filename=".conf/host_key", webhooks_filename=".conf/webhooks.txt", bot_token_filename=".conf/bot_token")
+        hooks = HookTool(configs.webhooks)
 
-    dsdriveapi = DSdriveApi(configs.mgdb_url, hooks, token=configs.bot_token)
+        dsdriveapi = DSdriveApi(configs.meta_url, hooks, url_expire_policy=EXPIRE_POLICIES[configs.refresh_policy], token=configs.bot_token, backend=configs.meta_backend, cache=configs.meta_cache, max_staleness=configs.meta_max_staleness, refresh=configs.refresh_options)
 
     # discord_fs = DiscordFS()
     # discord_fs.dsdrive_api = dsdriveapi
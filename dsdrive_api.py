@@ -1,25 +1,45 @@
 import os
+import io
 from io import BytesIO
 from hashlib import md5
 from zlib import crc32
 import time
 import base64
 import hashlib
+import itertools
+import json
+import math
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from typing import Union, Optional, Iterable
 from urllib.parse import urlparse
 
 import requests
-from pymongo import MongoClient
-import pymongo
 import fs.path
 
 from key_mgr import AESCipher
 from api_expire import ApiExpirePolicy
 from config_loader import Config
 from dsurl import DSUrl, BaseExpirePolicy
+from meta_store import make_meta_store, CachedMetaStore
+from url_refresher import UrlRefresher
 
 
 _CHUNK_SIZE = 24 * 1024 * 1024  # MB
+_LIST_BATCH_SIZE = 1000  # entries fetched per directory listing query
+_LOOK_AHEAD = 4  # chunks renewed ahead of a sequential read
+_MAX_READ_AHEAD = 4  # chunks downloaded ahead of a sequential read at most, each holds _CHUNK_SIZE in memory
+_READ_AHEAD_POOL = ThreadPoolExecutor(8, thread_name_prefix="read-ahead")  # shared by every file read ahead
+_READ_AHEAD_SLOTS = threading.BoundedSemaphore(16)  # chunks held by read ahead in the whole process, each up to _CHUNK_SIZE
+
+# Projections, so that metadata lookups never pull the chunk manifest of a file
+_ID_FIELDS = {"type": 1}  # enough to resolve a path component
+_INFO_FIELDS = {"name": 1, "parent": 1, "type": 1, "access": 1, "details": 1}
+_COPY_FIELDS = {**_INFO_FIELDS, "url_expire": 1, "hashes": 1}  # what a copy of a file keeps
+_OPEN_FIELDS = {**_INFO_FIELDS, "hashes.chunk_size": 1}  # what opening a file needs
+_HASH_FIELDS = {"type": 1, "hashes": 1}
+_HASH_NAMES = ("md5", "sha1")  # the digests recorded for each chunk and file
+_USAGE_FIELDS = {"type": 1, "parent": 1, "details.size": 1, "usage": 1}  # enough to know what a node weighs
 
 
 class HookTool:
@@ -106,6 +126,61 @@ class HookTool:
         return resp
 
 
+class MemoryHookTool(HookTool):
+    """
+    A HookTool that keeps the chunks in memory instead of sending them to Discord, for tests and benchmarks
+
+    The URLs it hands out look like Discord attachment URLs and never expire, so
+    no URL is ever renewed. Everything is lost when the process exits.
+
+    Attributes:
+        blobs (dict): The data of the chunks, by attachment ID
+    """
+
+    _NEVER = 0xFFFFFFFF  # expire timestamp of the URLs
+
+    def __init__(self):
+        super().__init__([])
+        self.blobs = {}
+        self._ids = itertools.count(1)
+
+    def send(self, *args, **kwargs):
+        """
+        Keep a file in memory
+
+        Args:
+            **kwargs: Keyword arguments as passed to HookTool.send, only "files" is used
+
+        Returns:
+            requests.Response: A response shaped like the one of a webhook message
+        """
+        name, buffer = kwargs["files"]["file"]
+        attachment_id = next(self._ids)
+        self.blobs[attachment_id] = buffer.read()
+        url = f"https://cdn.discordapp.com/attachments/0/{attachment_id}/{name}?ex={self._NEVER:x}&is=0&hm=00&"
+        return self._response({"id": str(attachment_id), "attachments": [{"url": url}]})
+
+    def get(self, url, *args, **kwargs):
+        """
+        Get a file kept in memory
+
+        Args:
+            url (Union[str, DSUrl]): The URL of the attachment
+
+        Returns:
+            requests.Response: The response, with the data of the file as content
+        """
+        attachment_id = int(urlparse(str(url)).path.split("/")[3])
+        return self._response(content=self.blobs[attachment_id])
+
+    @staticmethod
+    def _response(json_body=None, content: bytes=b""):
+        resp = requests.Response()
+        resp.status_code = 200
+        resp._content = content if json_body is None else json.dumps(json_body).encode()
+        return resp
+
+
 class DSFile(BytesIO):
     """
     A file-like object that can be used to read and write files on DSdrive
@@ -232,6 +307,246 @@ class DSFile(BytesIO):
 
 
 
+class ChunkReader:
+    """
+    Read byte ranges of a file, downloading and renewing only the chunks they cover
+
+    The chunk manifest is loaded on the first read, and the URL of a chunk is renewed
+    when the chunk is about to be downloaded, not when the file is opened. Once the
+    file is read in order past a chunk boundary, the URLs of the next look_ahead
+    chunks are renewed along with the one needed, so a sequential read renews in
+    batches rather than chunk by chunk. The last chunk downloaded is kept decrypted
+    for the reads that follow within it.
+
+    When told the file is read in order, see read_ahead, the next chunks are
+    downloaded in the background. The window is as many chunks as are read in the
+    time one takes to download, from 1 to max_read_ahead. Every chunk downloaded
+    ahead and not read yet takes one of _READ_AHEAD_SLOTS, shared by every file
+    open, and the window shrinks to the slots left, down to nothing.
+
+    Every chunk but the last holds the same number of bytes, as recorded with the
+    digests of the file. Files written before that are assumed to use _CHUNK_SIZE,
+    and if they were written with another one it's learned from the first full chunk
+    downloaded, or from the only chunk of the file.
+
+    Attributes:
+        dsdrive (DSdriveApi): The DSdriveApi object
+        file_id (ObjectId): The ID of the file
+        size (int): The size of the file
+        look_ahead (int): The number of chunks renewed ahead during sequential reads
+        max_read_ahead (int): The number of chunks downloaded ahead at most
+        chunk_size (int): The number of bytes in every chunk but the last
+    """
+
+    def __init__(self, dsdrive, file_id, size: int, look_ahead: int=_LOOK_AHEAD, max_read_ahead: int=_MAX_READ_AHEAD, chunk_size: Optional[int]=None):
+        self.dsdrive = dsdrive
+        self.file_id = file_id
+        self.size = size
+        self.look_ahead = look_ahead
+        self.max_read_ahead = max_read_ahead
+        self.chunk_size = chunk_size or _CHUNK_SIZE
+        self._chunks = None  # the manifest, loaded on the first read
+        self._urls = {}  # ordinal -> DSUrl, renewed ones replace the stored ones
+        self._last = None  # (ordinal, data) of the last chunk downloaded
+        self._next = None  # the ordinal a sequential read would download next
+        self._lock = threading.Lock()  # read ahead downloads look URLs up too
+        self._ahead = {}  # ordinal -> future of the data, downloading in the background
+        self._download_time = None  # seconds a chunk takes to download, averaged
+        self._run_start = None  # (time, offset) where the sequential read started
+
+    def _manifest(self):
+        with self._lock:
+            if self._chunks is None:
+                self._chunks = list(self.dsdrive.iter_chunks(self.file_id))
+                if self.dsdrive.refresher is not None:
+                    self.dsdrive.refresher.touch(self.file_id, min((c["url"][4] for c in self._chunks), default=None))
+            return self._chunks
+
+    def _url(self, ordinal: int) -> DSUrl:
+        manifest = self._manifest()
+        with self._lock:
+            url = self._urls.get(ordinal) or DSUrl(*manifest[ordinal]["url"])
+            if not self.dsdrive.url_expire_policy.is_expired(url):
+                return url
+            stop = ordinal + 1 + (self.look_ahead if ordinal == self._next else 0)
+        # a round trip, the downloads of other chunks don't wait on it
+        renewed = self.dsdrive.renew_file_urls(self.file_id, start=ordinal, stop=stop)
+        with self._lock:
+            for i, new in enumerate(renewed, ordinal):
+                self._urls[i] = new
+            return self._urls[ordinal]
+
+    def _download(self, ordinal: int) -> bytes:
+        url = self._url(ordinal)
+        started = time.monotonic()
+        data = self.dsdrive.decrypt(self.dsdrive.hook.get(url.full_url).content)
+        took = time.monotonic() - started
+        with self._lock:
+            self._download_time = took if self._download_time is None else 0.7 * self._download_time + 0.3 * took
+        return data
+
+    def chunk(self, ordinal: int) -> bytes:
+        """
+        Get the data of a chunk
+
+        Args:
+            ordinal (int): The ordinal of the chunk
+
+        Returns:
+            bytes: The decrypted data
+        """
+        if self._last is not None and self._last[0] == ordinal:
+            return self._last[1]
+        data = None
+        future = self._ahead.pop(ordinal, None)
+        if future is not None:
+            if not future.cancel():
+                try:
+                    data = future.result()
+                except Exception:
+                    pass  # downloaded again below, raising if it fails again
+            _READ_AHEAD_SLOTS.release()
+        if data is None:
+            data = self._download(ordinal)
+        if ordinal < len(self._manifest()) - 1 or len(data) > self.chunk_size:
+            # only the last chunk may be shorter, none is longer
+            self.chunk_size = len(data)
+        self._last = (ordinal, data)
+        self._next = ordinal + 1
+        return data
+
+    def read(self, offset: int, size: int) -> bytes:
+        """
+        Read a range of the file
+
+        Args:
+            offset (int): Where the range starts
+            size (int): The length of the range, cut at the end of the file
+
+        Returns:
+            bytes: The data
+        """
+        size = min(size, self.size - offset)
+        pieces = []
+        while size > 0:
+            chunk_size = self.chunk_size
+            ordinal, skip = divmod(offset, chunk_size)
+            if ordinal >= len(self._manifest()):
+                ordinal = 0  # the chunks are larger than assumed, learn their size
+            data = self.chunk(ordinal)
+            if self.chunk_size != chunk_size:
+                continue  # the ordinal was worked out with the wrong size
+            piece = data[skip:skip + size]
+            if not piece:
+                raise OSError(f"Chunk {ordinal} of {self.file_id} is shorter than expected")
+            pieces.append(piece)
+            offset += len(piece)
+            size -= len(piece)
+        return b"".join(pieces)
+
+    def read_ahead(self, offset: int):
+        """
+        Download the chunks after offset in the background, the file is being read in order
+
+        Args:
+            offset (int): Where the sequential read is
+        """
+        now = time.monotonic()
+        if self._run_start is None or offset < self._run_start[1]:
+            self._run_start = (now, offset)
+        ordinal = offset // self.chunk_size
+        for behind in [i for i in self._ahead if i < ordinal]:
+            self._ahead.pop(behind).cancel()
+            _READ_AHEAD_SLOTS.release()
+        window = 1
+        elapsed = now - self._run_start[0]
+        if self._download_time and elapsed > 0 and offset > self._run_start[1]:
+            # chunks read while one downloads
+            chunk_time = self.chunk_size * elapsed / (offset - self._run_start[1])
+            window = math.ceil(self._download_time / chunk_time)
+        window = max(1, min(self.max_read_ahead, window))
+        for i in range(ordinal + 1, min(ordinal + 1 + window, len(self._manifest()))):
+            if i not in self._ahead and (self._last is None or self._last[0] != i):
+                if not _READ_AHEAD_SLOTS.acquire(blocking=False):
+                    break  # the other files read ahead hold every slot
+                self._ahead[i] = _READ_AHEAD_POOL.submit(self._download, i)
+
+    def cancel_read_ahead(self):
+        """Drop the chunks downloading in the background, the reads are not in order anymore"""
+        for future in self._ahead.values():
+            future.cancel()
+            _READ_AHEAD_SLOTS.release()
+        self._ahead.clear()
+        self._run_start = None
+
+
+class DSReadFile(io.RawIOBase):
+    """
+    A read-only file on DSdrive, whose chunks are downloaded as they are read
+
+    Attributes:
+        path (str): The path of the file
+        reader (ChunkReader): Where the data comes from
+    """
+
+    def __init__(self, path, reader: ChunkReader):
+        super().__init__()
+        self.path = path
+        self.mode = "rb"
+        self.reader = reader
+        self._pos = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        data = self.reader.read(self._pos, len(b))
+        b[:len(data)] = data
+        self._pos += len(data)
+        return len(data)
+
+    def readall(self) -> bytes:
+        data = self.reader.read(self._pos, self.reader.size - self._pos)
+        self._pos += len(data)
+        return data
+
+    def write(self, b):
+        raise io.UnsupportedOperation("File not writable")
+
+    def read_ahead(self):
+        """Download the data after the position in the background, see ChunkReader.read_ahead"""
+        if self._pos < self.reader.size:
+            self.reader.read_ahead(self._pos)
+
+    def cancel_read_ahead(self):
+        self.reader.cancel_read_ahead()
+
+    def close(self):
+        if not self.closed:
+            self.reader.cancel_read_ahead()
+        super().close()
+
+    def seek(self, offset: int, whence: int=io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == io.SEEK_END:
+            pos = self.reader.size + offset
+        else:
+            raise ValueError(f"invalid whence ({whence})")
+        if pos < 0:
+            raise ValueError(f"negative seek position {pos}")
+        self._pos = pos
+        return pos
+
+    def tell(self) -> int:
+        return self._pos
+
+
 class DSdriveApi:
     """A wrapper class for DSdriveApiWebhook and DSdriveApiBot"""
 
@@ -257,6 +572,8 @@ class DSdriveApi:
 
 class DSdriveApiBase:
     """A base class for DSdrive API implementations"""
+    open_fields = _OPEN_FIELDS  # the fields open_binary needs of a file found by the caller
+
     def __init__(self) -> None:
         pass
 
@@ -302,22 +619,32 @@ class DSdriveApiBase:
         paths = list(filter(None, paths))
         return paths
 
-    def open_binary(self, path: str, mode: str= "r"):
+    def open_binary(self, path: str, mode: str= "r", fn: Optional[dict]=None):
         """
         Open a file
 
         Args:
             path (str): The path of the file
             mode (str): The mode of the file
+            fn (Optional[dict]): The file, with the open_fields, if the caller found it already
 
         Returns:
-            IO (DSFile): The file-like object
+            IO (Union[DSFile, DSReadFile]): The file-like object, a DSReadFile if opened read only
         """
         # check if the file size is 0
-        stat, fn = self.find(self.path_splitter(path), return_obj=True)
+        if fn is not None:
+            stat = 0
+        else:
+            stat, fn = self.find(self.path_splitter(path), return_obj=True, projection=_OPEN_FIELDS)
         if stat == 0:
             if fn["type"] == "folder":
                 raise OSError("Path is a folder")
+            if "r" in mode and "+" not in mode:
+                if "t" in mode:
+                    raise ValueError("text mode not supported")
+                # read only, the chunks are downloaded when they are read
+                chunk_size = (fn.get("hashes") or {}).get("chunk_size")
+                return DSReadFile(path, ChunkReader(self, fn["_id"], fn["details"]["size"], chunk_size=chunk_size))
             if fn["details"]["size"] == 0:
                 return DSFile(path, self, mode, zero_size=True)
         else:
@@ -331,9 +658,10 @@ class DSdriveApiWebhook(DSdriveApiBase):
     A class to interact with Discord's file storage system
 
     Attributes:
-        db (pymongo.database.Database): The database object
+        store (BaseMetaStore): Where the tree and the chunk manifests are stored
         hook (HookTool): The HookTool object
-        root_id (bson.objectid.ObjectId): The ID of the root directory
+        root_id (Union[bson.objectid.ObjectId, int]): The ID of the root directory
+        refresher (Optional[UrlRefresher]): Renews the URLs of hot files in the background, if enabled
 
     Methods:
         clear: Clear the database, very dangerous
@@ -343,32 +671,50 @@ class DSdriveApiWebhook(DSdriveApiBase):
         send_file: Send a file to DSdrive
         open_binary: Open a file
         get_file_urls: Get the URLs of a file
+        renew_file_urls: Get the URLs of a file, renewing and storing the expired ones
+        pin: Keep the URLs of a file fresh in the background
+        get_hashes: Get the digests of a file and of its chunks
+        iter_chunks: Iterate over the chunk manifest of a file
         download_file: Download a file
         list_dir: List a directory
+        iter_children: Iterate over the children of a directory in batches
         remove_file: Remove a file
         remove_dir: Remove a directory
         remove_tree: Remove a tree
+        iter_subtree: Iterate over all the descendants of a directory
+        scan_tree: List a whole directory tree with a few queries
+        copy_tree: Copy the contents of a directory
+        get_usage: Get the number of bytes and files stored under a path
+        query: Find files by size, modification time and name
+        rebuild_usage: Recompute the usage of the folders under a folder
         get_info: Get the info of a file or directory
+        raw_info: Convert a database document into pyfilesystem raw info
         set_info: Set the info of a file or directory
     """
 
-    def __init__(self, url: str, hook: HookTool, url_expire_policy: BaseExpirePolicy=ApiExpirePolicy, token: Optional[str]=None, key: Union[str, bytes]="despacito") -> None:
+    def __init__(self, url: str, hook: HookTool, url_expire_policy: BaseExpirePolicy=ApiExpirePolicy, token: Optional[str]=None, key: Union[str, bytes]="despacito", backend: str="mongodb", cache: bool=False, max_staleness: float=5.0, refresh: Optional[dict]=None) -> None:
         """
         Create a DSdriveApi object, creates the root directory if it doesn't exist
 
         Args:
-            url (str): The URL of the MongoDB database
-            hook (HookTool): The HookTool object
+            url (str): The URL of the MongoDB database, or the path of the SQLite database, unused by the memory backend
+            hook (HookTool): The HookTool object, a MemoryHookTool keeps the data in memory too
+            backend (str): Where the metadata is stored, "mongodb", "sqlite" or "memory"
+            cache (bool): Whether to cache nodes and chunk manifests, kept coherent with the other clients of the database
+            max_staleness (float): How long a cached entry is trusted when the changes of the database can't be followed, in seconds
+            refresh (Optional[dict]): The keyword arguments of a UrlRefresher renewing the URLs of hot files in the background, or None to renew on reads only
         """
-        client = MongoClient(url)
-        self.db = client["dsdrive"]
+        self.store = make_meta_store(backend, url)
+        if cache:
+            self.store = CachedMetaStore(self.store, max_staleness)
+        self.store.setup()
         self.hook: HookTool = hook
         self.key = key
         self.url_expire_policy = url_expire_policy()
         self.url_expire_policy.setup(token)
-        root = self.db["tree"].find_one({"name": "", "parent": None})
+        root = self.store.get_child(None, "", _ID_FIELDS)
         if not root:
-            root = self.db["tree"].insert_one(
+            self.root_id = self.store.insert(
                 {
                     "name": "",
                     "parent": None,
@@ -396,21 +742,25 @@ class DSdriveApiWebhook(DSdriveApiBase):
                         "size": 0,
                         "type": 1,  # Folder
                     },
+                    "usage": {"size": 0, "files": 0},
                 }
             )
-            self.root_id = root.inserted_id
         else:
             self.root_id = root["_id"]
 
-        self.db["tree"].create_index("parent")
+        if not self.store.is_migrated("usage"):
+            self.rebuild_usage()
+
+        self.refresher = None
+        if refresh is not None:
+            self.refresher = UrlRefresher(self, self.url_expire_policy, **refresh)
+            self.refresher.start()
 
     def clear(self):
         """
         Clear the database safely
         """
-        root = self.db["tree"].find_one({"name": "", "parent": None})
-        self.db["tree"].drop()
-        self.db["tree"].insert_one(root)
+        self.store.clear(self.root_id)
 
     def makedirs(self, paths: list, allow_many: bool=False, exist_ok: bool=False):
         """
@@ -429,7 +779,7 @@ class DSdriveApiWebhook(DSdriveApiBase):
         already_exist_counter = 0
         resource_not_found_counter = 0
         for i in paths:
-            fs = self.db["tree"].find_one({"name": i, "parent": parent_id})
+            fs = self.store.get_child(parent_id, i, _ID_FIELDS)
             if fs:
                 if fs["type"] != "folder":
                     return 3, None  # Path already exists, but is not a folder
@@ -438,7 +788,7 @@ class DSdriveApiWebhook(DSdriveApiBase):
             else:
                 if not allow_many and len(paths) - resource_not_found_counter > 1:
                     return 1, None  # Only one directory allowed, resource not found
-                o = self.db["tree"].insert_one(
+                parent_id = self.store.insert(
                     {
                         "name": i,
                         "parent": parent_id,
@@ -466,43 +816,43 @@ class DSdriveApiWebhook(DSdriveApiBase):
                             "size": 0,
                             "type": 1,  # Folder
                         },
+                        "usage": {"size": 0, "files": 0},
                     }
                 )
-                parent_id = o.inserted_id
                 already_exist_counter += 1
         if (not exist_ok) and already_exist_counter == 0:
             return 2, None  # No directories created, already exists
         return 0, parent_id
 
-    def find(self, paths: str, return_obj: bool=False):
+    def find(self, paths: str, return_obj: bool=False, projection: Optional[dict]=None):
         """
         Find a path
 
         Args:
             paths (list): The list of directories to find
             return_obj (bool): Whether to return the object found or the ID of the object found
+            projection (Optional[dict]): The fields of the object to return, defaults to the metadata fields, never the chunk manifest
 
         Returns:
             code (int): An error code, or 0 if successful
             found_id (Union[ObjectID, None]): The ID of the last position found
         """
         # paths = os.path.normpath(path).split(os.sep)
-        parent_id = self.root_id
-        for i, j in zip(paths, range(len(paths), 0, -1)):
-            fs = self.db["tree"].find_one({"name": i, "parent": parent_id})
-            if fs:
-                parent_id = fs["_id"]
-                continue
-            else:
-                if j == 1:
-                    return 1, None  # Path not found, but at the end
-                return 2, None  # Path not found, and not at the end
+        if projection is None:
+            projection = _INFO_FIELDS
         if paths == []:  # Root directory
-            fs = self.db["tree"].find_one({"_id": self.root_id})
-            parent_id = self.root_id
+            if return_obj:
+                return 0, self.store.get(self.root_id, projection)
+            return 0, self.root_id
+        # the whole path in one lookup, where the store can
+        nodes = self.store.resolve(self.root_id, paths, projection if return_obj else _ID_FIELDS)
+        if len(nodes) < len(paths):
+            if len(nodes) == len(paths) - 1:
+                return 1, None  # Path not found, but at the end
+            return 2, None  # Path not found, and not at the end
         if return_obj:
-            return 0, fs
-        return 0, parent_id
+            return 0, nodes[-1]
+        return 0, nodes[-1]["_id"]
 
     def send_file(self, path: str, file_obj: Union[str, BytesIO, DSFile, None]=None):
         """
@@ -530,49 +880,58 @@ class DSdriveApiWebhook(DSdriveApiBase):
 
         paths = self.path_splitter(path)
         _, parent_id = self.makedirs(paths[:-1], allow_many=True, exist_ok=True)
-        urls = []
-        chunk_sizes = []
+        chunks = []
+        # digests of the plaintext, so it can be checked later without downloading it
+        file_hashes = {name: hashlib.new(name) for name in _HASH_NAMES}
 
         while chunk:
+            chunk_hashes = {}
+            for name, file_hash in file_hashes.items():
+                file_hash.update(chunk)
+                chunk_hashes[name] = hashlib.new(name, chunk).hexdigest()
             chunk = self.encrypt(chunk)
             with BytesIO(chunk) as buffer:
                 fname = (
                     md5(chunk).hexdigest() + "-" + crc32(chunk).to_bytes(4, "big").hex()
                 )
                 resp = self.hook.send(files={"file": (fname, buffer)})
-                urls.append(DSUrl.from_url(resp.json()["attachments"][0]["url"], int(resp.json()["id"])).save_format)
-                chunk_sizes.append(len(chunk))
+                url = DSUrl.from_url(resp.json()["attachments"][0]["url"], int(resp.json()["id"])).save_format
+                chunks.append({"url": url, "size": len(chunk), **chunk_hashes})
 
             chunk = file.read(_CHUNK_SIZE)
 
+        hashes = {name: file_hash.hexdigest() for name, file_hash in file_hashes.items()}
+        hashes["chunk_size"] = _CHUNK_SIZE
+
+        url_expire = min((c["url"][4] for c in chunks), default=None)  # found through an index by the refresher
         try:
             # dirname = os.path.dirname(path)
 
-            finder = self.db["tree"].find_one({"name": paths[-1], "parent": parent_id})
+            finder = self.store.get_child(parent_id, paths[-1], _USAGE_FIELDS)
             if finder:
                 if finder["type"] == "file":
                     # print(resp.json())
-                    self.db["tree"].update_one(
-                        {"_id": finder["_id"]},
+                    self.store.write_chunks(finder["_id"], chunks)
+                    self._inc_usage(parent_id, size - finder["details"]["size"], 0)
+                    self.store.update(
+                        finder["_id"],
                         {
-                            "$set": {
-                                "urls": urls,
-                                "chunk_sizes": chunk_sizes,
-                                "details.modified": time.time(),
-                                "details.size": size,
-                            }
+                            "details.modified": time.time(),
+                            "details.size": size,
+                            "url_expire": url_expire,
+                            "hashes": hashes,
                         },
                     )
                 else:
                     print("File already exists, and is a folder, skipping")
             else:
                 info = {
+                    "_id": self.store.new_id(),
                     "name": paths[-1],
                     "type": "file",
-                    # "hashes": fname,
-                    "urls": urls,
+                    "hashes": hashes,
                     "parent": parent_id,
-                    "chunk_sizes": chunk_sizes,
+                    "url_expire": url_expire,
                 }
                 info["access"] = {
                     "group": "staff",
@@ -597,7 +956,10 @@ class DSdriveApiWebhook(DSdriveApiBase):
                     "size": size,
                     "type": 2,  # File
                 }
-                self.db["tree"].insert_one(info)
+                # write the manifest first, so the file never shows up without its chunks
+                self.store.write_chunks(info["_id"], chunks)
+                self.store.insert(info)
+                self._inc_usage(parent_id, size, 1)
         except Exception as e:
             print("Error sending file")
             print(e)
@@ -606,6 +968,20 @@ class DSdriveApiWebhook(DSdriveApiBase):
         if file_obj is None:
             file.close()
 
+    def iter_chunks(self, file_id, start: int=0, stop: Optional[int]=None):
+        """
+        Iterate over the chunk manifest of a file
+
+        Args:
+            file_id (ObjectId): The ID of the file
+            start (int): The ordinal of the first chunk
+            stop (Optional[int]): The ordinal after the last chunk, or None to read to the end
+
+        Yields:
+            dict: The chunk documents, in order
+        """
+        return self.store.iter_chunks(file_id, start, stop)
+
     def get_file_urls(self, path: str):
         """
         Get the URLs of a file
@@ -618,18 +994,103 @@ class DSdriveApiWebhook(DSdriveApiBase):
         """
         paths = self.path_splitter(path)
 
-        stat, fn = self.find(paths, return_obj=True)
+        stat, fn = self.find(paths, return_obj=True, projection=_ID_FIELDS)
         if stat != 0:
             return None
         if fn:
-            urls = (DSUrl(*u) for u in fn["urls"])
-            # update urls if expired
-            urls = self.url_expire_policy.renew_url(urls)
-            # print(urls)
+            urls = self.renew_file_urls(fn["_id"])
+            if self.refresher is not None:
+                self.refresher.touch(fn["_id"], min((url.expire for url in urls), default=None))
             return urls
         else:
             return None
 
+    def renew_file_urls(self, file_id, within: float=0, policy: Optional[BaseExpirePolicy]=None, start: int=0, stop: Optional[int]=None):
+        """
+        Get the URLs of a file, or of a range of its chunks, renewing the expired ones
+
+        Renewed URLs are written back to the chunk manifest, so each URL is renewed
+        once per expiry window, not on every read. Before renewing, the manifest is
+        read again past the cache, in case another client renewed it already.
+
+        Args:
+            file_id (ObjectId): The ID of the file
+            within (float): Also renew the URLs expiring within this many seconds
+            policy (Optional[BaseExpirePolicy]): The expire policy to renew with, instead of url_expire_policy
+            start (int): The ordinal of the first chunk
+            stop (Optional[int]): The ordinal after the last chunk, or None for the whole rest of the file
+
+        Returns:
+            urls (list): The DSUrls of the chunks, in order
+        """
+        policy = policy or self.url_expire_policy
+        chunks = list(self.iter_chunks(file_id, start, stop))
+        urls = [DSUrl(*c["url"]) for c in chunks]
+        if not any(policy.is_expired(url, within) for url in urls):
+            return urls
+        self.store.invalidate(file_id)
+        chunks = list(self.iter_chunks(file_id, start, stop))
+        urls = [DSUrl(*c["url"]) for c in chunks]
+        renewed = list(policy.renew_url(urls, within))
+        changed = [
+            (c["ordinal"], new.save_format)
+            for c, old, new in zip(chunks, urls, renewed)
+            if new.expire != old.expire
+        ]
+        if changed:
+            self.store.update_chunk_urls(file_id, changed)
+            if start == 0 and stop is None:
+                # a range doesn't tell when the rest of the file expires
+                self.store.update(file_id, {"url_expire": min(url.expire for url in renewed)})
+        return renewed
+
+    def pin(self, path: str, pinned: bool=True):
+        """
+        Pin a file, so that the background refresher keeps its URLs fresh even when it's not read
+
+        Args:
+            path (str): The path of the file
+            pinned (bool): Whether to pin or unpin the file
+
+        Returns:
+            code (int): An error code, or 0 if successful
+        """
+        stat, fn = self.find(self.path_splitter(path), return_obj=True, projection=_ID_FIELDS)
+        if stat != 0:
+            return 1  # Path not found
+        if fn["type"] != "file":
+            return 2  # Not a file
+        # files written before the expiry was tracked don't have it yet
+        url_expire = min((c["url"][4] for c in self.iter_chunks(fn["_id"])), default=None)
+        self.store.update(fn["_id"], {"pinned": pinned, "url_expire": url_expire})
+        return 0
+
+    def get_hashes(self, path: str, name: str):
+        """
+        Get the digests of a file and of its chunks, recorded when the file was sent
+
+        Args:
+            path (str): The path of the file
+            name (str): The hash algorithm, "md5" or "sha1"
+
+        Returns:
+            code (int): An error code, or 0 if successful, 3 if the file has no such digests recorded
+            hashes (Union[dict, None]): "file", the hex digest of the whole file, "chunk_size", the bytes
+                held by every chunk but the last, and "chunks", the hex digest of each chunk
+        """
+        stat, fn = self.find(self.path_splitter(path), return_obj=True, projection=_HASH_FIELDS)
+        if stat != 0:
+            return 1, None  # Path not found
+        if fn["type"] != "file":
+            return 2, None  # Not a file
+        hashes = fn.get("hashes") or {}
+        if name not in hashes:
+            return 3, None  # Sent before digests were recorded, or an unknown algorithm
+        chunks = [c.get(name) for c in self.iter_chunks(fn["_id"])]
+        if None in chunks:
+            return 3, None
+        return 0, {"file": hashes[name], "chunk_size": hashes["chunk_size"], "chunks": chunks}
+
     def download_file(self, path_src: str, path_dst: Optional[str]=None):
         """
         Download a file from Discord to the local filesystem
@@ -647,38 +1108,58 @@ class DSdriveApiWebhook(DSdriveApiBase):
                     pass
             with open(path_dst, "wb") as file:
                 for i, url in enumerate(urls):
-                    resp = self.hook.get(url)
+                    resp = self.hook.get(url.full_url)
                     chunk = self.decrypt(resp.content)
                     file.write(chunk)
         elif isinstance(path_dst, BytesIO) or isinstance(path_dst, DSFile):
             for i, url in enumerate(urls):
-                resp = self.hook.get(url)
+                resp = self.hook.get(url.full_url)
                 # print(resp.content)
                 chunk = self.decrypt(resp.content)
                 path_dst.write(chunk)
 
-    def list_dir(self, path: str):
+    def list_dir(self, path: str, batch_size: int=_LIST_BATCH_SIZE, start_after: Optional[str]=None):
         """
         List a directory
 
         Args:
             path (str): The path of the directory
+            batch_size (int): The number of entries fetched from the database per query
+            start_after (Optional[str]): Only list entries whose name sorts after this one, used to resume a listing
 
         Returns:
             code (int): an error code, or 0 if successful
-            filelist (Union[Iterable, None]): A list of files and directories, or None if an error occured
+            filelist (Union[Iterable, None]): A generator of files and directories sorted by name, or None if an error occured
         """
         paths = self.path_splitter(path)
         if paths == []:  # Root directory
-            return 0, self.db["tree"].find({"parent": self.root_id})
-        stat, parent = self.find(paths, return_obj=True)
+            return 0, self.iter_children(self.root_id, batch_size, start_after)
+        stat, parent = self.find(paths, return_obj=True, projection=_ID_FIELDS)
         if stat != 0:
             return 1, None  # Path not found
         if parent["type"] == "file":
             return 2, None  # Path is a file
 
-        fn = self.db["tree"].find({"parent": parent["_id"]})
-        return 0, fn
+        return 0, self.iter_children(parent["_id"], batch_size, start_after)
+
+    def iter_children(self, parent_id, batch_size: int=_LIST_BATCH_SIZE, start_after: Optional[str]=None):
+        """
+        Iterate over the children of a directory, one sorted batch at a time
+
+        Args:
+            parent_id (ObjectId): The ID of the directory
+            batch_size (int): The number of entries fetched from the database per query
+            start_after (Optional[str]): Only yield entries whose name sorts after this one
+
+        Yields:
+            dict: The documents of the entries, sorted by name
+        """
+        while True:
+            batch = list(self.store.iter_children(parent_id, start_after, batch_size, _INFO_FIELDS))
+            yield from batch
+            if len(batch) < batch_size:
+                return
+            start_after = batch[-1]["name"]
 
     def remove_file(self, path: str):
         """
@@ -691,12 +1172,14 @@ class DSdriveApiWebhook(DSdriveApiBase):
             code (int): An error code, or 0 if successful
         """
         paths = self.path_splitter(path)
-        stat, fn = self.find(paths, return_obj=True)
+        stat, fn = self.find(paths, return_obj=True, projection=_USAGE_FIELDS)
         if stat != 0:
             return 1  # Path not found
         if fn["type"] != "file":
             return 2  # Path is not a file
-        self.db["tree"].delete_one({"_id": fn["_id"]})
+        self.store.delete([fn["_id"]])
+        self.store.delete_chunks([fn["_id"]])
+        self._inc_usage(fn["parent"], -fn["details"]["size"], -1)
         return 0
 
     def remove_dir(self, path: str):
@@ -715,33 +1198,102 @@ class DSdriveApiWebhook(DSdriveApiBase):
         stat, parent_id = self.find(paths[:-1])
         if stat != 0:
             return 1  # Path not found
-        fn = self.db["tree"].find_one({"name": paths[-1], "parent": parent_id})
+        fn = self.store.get_child(parent_id, paths[-1], _ID_FIELDS)
         if not fn:
             return 1  # Path not found
         # check if is folder
         if fn["type"] != "folder":
             return 2  # Path is not a folder
-        if self.db["tree"].find_one({"parent": fn["_id"]}):
+        if self.store.has_children(fn["_id"]):
             return 3  # Folder not empty
-        self.db["tree"].delete_one({"_id": fn["_id"]})
+        self.store.delete([fn["_id"]])
 
-    def remove_tree(self, path: str):
+    def remove_tree(self, path: str, keep_root: bool=False):
         """
-        Remove a tree, not implemented yet
+        Remove a tree, the whole subtree is collected with one query per level and deleted in bulk
 
         Args:
             path (str): The path of the tree
+            keep_root (bool): Whether to only remove the contents of the directory, and keep the directory itself
 
         Returns:
             code (int): An error code, or 0 if successful
         """
         paths = self.path_splitter(path)
-        if len(paths) == 0:
+        if len(paths) == 0 and not keep_root:
             return 4  # Root directory cannot be deleted
-        stat, parent_id = self.find(paths[:-1])
+        stat, fn = self.find(paths, return_obj=True, projection=_USAGE_FIELDS)
         if stat != 0:
-            return 1
-        fn = self.db["tree"].find_one({"name": paths[-1], "parent": parent_id})
+            return 1  # Path not found
+        if fn["type"] != "folder":
+            return 2  # Path is not a folder
+
+        size, files = self._usage_of(fn)
+        if keep_root:
+            self._inc_usage(fn["_id"], -size, -files)
+        else:
+            self._inc_usage(fn["parent"], -size, -files)
+        node_ids = [] if keep_root else [fn["_id"]]
+        file_ids = []
+        for node in self.iter_subtree(fn["_id"]):
+            node_ids.append(node["_id"])
+            if node["type"] == "file":
+                file_ids.append(node["_id"])
+
+        # the top of the tree goes first, so the subtree is unreachable from then on
+        self.store.delete(node_ids)
+        self.store.delete_chunks(file_ids)
+        return 0
+
+    def iter_subtree(self, root_id, projection: Optional[dict]=None, folders_only: bool=False, file_pattern: Optional[str]=None, max_depth: Optional[int]=None):
+        """
+        Iterate over all the descendants of a directory, breadth first
+
+        The subtree is fetched in a few queries, one per level on MongoDB and a single
+        recursive one on SQLite, rather than one per node.
+
+        Args:
+            root_id (ObjectId): The ID of the directory
+            projection (Optional[dict]): The fields to return, defaults to the ID, type and parent
+            folders_only (bool): Whether to skip files
+            file_pattern (Optional[str]): A regular expression, only the files whose whole name matches it are returned
+            max_depth (Optional[int]): How many levels to go down, 1 only returns the children of the directory
+
+        Yields:
+            dict: The documents of the descendants, level by level
+        """
+        if projection is None:
+            projection = _ID_FIELDS
+        return self.store.iter_subtree(root_id, projection, folders_only, file_pattern, max_depth)
+
+    def scan_tree(self, path: str, file_pattern: Optional[str]=None, max_depth: Optional[int]=None):
+        """
+        List a whole directory tree with a few queries, the filters are applied by the database
+
+        Args:
+            path (str): The path of the directory
+            file_pattern (Optional[str]): A regular expression, only the files whose whole name matches it are listed
+            max_depth (Optional[int]): How many levels to go down, 1 only lists the directory itself
+
+        Returns:
+            code (int): An error code, or 0 if successful
+            entries (Union[Iterable, None]): A generator of (directory, document) tuples breadth first, where directory is the path of the parent relative to path, "" for path itself
+        """
+        stat, fn = self.find(self.path_splitter(path), return_obj=True, projection=_ID_FIELDS)
+        if stat != 0:
+            return 1, None  # Path not found
+        if fn["type"] != "folder":
+            return 2, None  # Path is a file
+        return 0, self._iter_tree(fn["_id"], file_pattern, max_depth)
+
+    def _iter_tree(self, root_id, file_pattern: Optional[str], max_depth: Optional[int]):
+        dir_paths = {root_id: ""}
+        # breadth first, so every folder is met before its children
+        for fn in self.iter_subtree(root_id, _INFO_FIELDS, file_pattern=file_pattern, max_depth=max_depth):
+            dir_path = dir_paths[fn["parent"]]
+            if fn["type"] == "folder":
+                dir_paths[fn["_id"]] = fs.path.join(dir_path, fn["name"])
+            yield dir_path, fn
 
     def rename(
         self,
@@ -750,13 +1302,18 @@ class DSdriveApiWebhook(DSdriveApiBase):
         overwrite: bool=False,
         create_dirs: bool=False,
         preserve_timestamps: bool=False,
+        files_only: bool=False,
     ):
         """
-        Rename a file or directory
+        Rename a file or directory, directories are moved as a whole by relinking them to their new parent
 
         Args:
             path_src (str): The path of the file or directory
             path_dst (str): The new path of the file or directory
+            overwrite (bool): Whether to replace an existing file, or an existing empty directory
+            create_dirs (bool): Whether to create the missing parent directories of path_dst
+            preserve_timestamps (bool): Whether to keep the modification time
+            files_only (bool): Whether to refuse renaming directories
 
         Returns:
             code (int): An error code, or 0 if successful
@@ -766,42 +1323,178 @@ class DSdriveApiWebhook(DSdriveApiBase):
 
         if len(paths_src) == 0 or len(paths_dst) == 0:
             return 2  # Root directory is not a file
-        stat, src_fn = self.find(paths_src, return_obj=True)
+        stat, src_fn = self.find(paths_src, return_obj=True, projection=_USAGE_FIELDS)
         if stat != 0:
             return 1  # Path not found
+        if files_only and not (src_fn["type"] == "file"):
+            return 2  # src is a folder
 
+        # refused before any missing folder is created, so a refusal leaves nothing behind
         stat, parent_id_dst = self.find(paths_dst[:-1])
         if stat != 0:
-            if create_dirs:
-                _, parent_id_dst = self.makedirs(
-                    paths_dst[:-1], allow_many=True, exist_ok=True
-                )
-            else:
+            if not create_dirs:
                 return 1  # Path not found
+            if src_fn["type"] == "folder" and self._is_inside(self._deepest_node(paths_dst[:-1]), src_fn["_id"]):
+                return 5  # Cannot move a folder into itself
+            stat, parent_id_dst = self.makedirs(
+                paths_dst[:-1], allow_many=True, exist_ok=True
+            )
+            if stat != 0:
+                return 1  # A file is in the way
+        if src_fn["type"] == "folder" and self._is_inside(parent_id_dst, src_fn["_id"]):
+            return 5  # Cannot move a folder into itself
 
-        if not (src_fn["type"] == "file"):
-            return 2  # src is a folder
-
-        dst_fn = self.db["tree"].find_one(
-            {"name": paths_dst[-1], "parent": parent_id_dst}
-        )
+        dst_fn = self.store.get_child(parent_id_dst, paths_dst[-1], _USAGE_FIELDS)
         if dst_fn:
             if not overwrite:
                 return 3  # Path already exists
-            if not (dst_fn["type"] == "file"):
-                return 2  # src and dst are not both files
-            self.db["tree"].delete_one({"_id": dst_fn["_id"]})
-
-        self.db["tree"].update_one(
-            {"_id": src_fn["_id"]},
-            {"$set": {"name": paths_dst[-1], "parent": parent_id_dst}},
-        )
+            if dst_fn["_id"] == src_fn["_id"]:
+                return 0  # Renamed to itself
+            if not (dst_fn["type"] == src_fn["type"]):
+                return 2  # src and dst are not of the same type
+            if dst_fn["type"] == "folder" and self.store.has_children(dst_fn["_id"]):
+                return 3  # Folder not empty
+            self.store.delete([dst_fn["_id"]])
+            self.store.delete_chunks([dst_fn["_id"]])
+            self._inc_usage(parent_id_dst, *(-i for i in self._usage_of(dst_fn)))
+
+        self.store.update(src_fn["_id"], {"name": paths_dst[-1], "parent": parent_id_dst})
+        if src_fn["parent"] != parent_id_dst:
+            size, files = self._usage_of(src_fn)
+            self._inc_usage(src_fn["parent"], -size, -files)
+            self._inc_usage(parent_id_dst, size, files)
         if not preserve_timestamps:
-            self.db["tree"].update_one(
-                {"_id": src_fn["_id"]}, {"$set": {"details.modified": time.time()}}
-            )
+            self.store.update(src_fn["_id"], {"details.modified": time.time()})
         return 0
 
+    def _deepest_node(self, paths: list):
+        """
+        Find the deepest node that exists along a path
+
+        Args:
+            paths (list): The names along the path
+
+        Returns:
+            node_id (ObjectId): The ID of the last node found, the root directory if none is
+        """
+        nodes = self.store.resolve(self.root_id, paths, _ID_FIELDS) if paths else []
+        return nodes[-1]["_id"] if nodes else self.root_id
+
+    def _is_inside(self, node_id, ancestor_id):
+        """
+        Check whether a node is a folder or one of its descendants, by following the parent links up to the root
+
+        Args:
+            node_id (ObjectId): The ID of the node
+            ancestor_id (ObjectId): The ID of the folder
+
+        Returns:
+            bool: True if node_id is ancestor_id or lies under it
+        """
+        return ancestor_id in self._ancestors(node_id)
+
+    def _ancestors(self, node_id):
+        """
+        Get the IDs of a node and all its ancestors, by following the parent links up to the root
+
+        Args:
+            node_id (ObjectId): The ID of the node
+
+        Returns:
+            list: The IDs, starting with node_id and ending with the root
+        """
+        ids = []
+        while node_id is not None:
+            ids.append(node_id)
+            node = self.store.get(node_id, {"parent": 1})
+            if not node:
+                break
+            node_id = node["parent"]
+        return ids
+
+    @staticmethod
+    def _usage_of(fn: dict):
+        """
+        Get what a node weighs in the usage of its ancestors
+
+        Args:
+            fn (dict): The document of the node, with the fields of _USAGE_FIELDS
+
+        Returns:
+            size (int): The number of bytes stored under the node
+            files (int): The number of files under the node
+        """
+        if fn["type"] == "file":
+            return fn["details"]["size"], 1
+        usage = fn.get("usage", {})
+        return usage.get("size", 0), usage.get("files", 0)
+
+    def _inc_usage(self, folder_id, size: int, files: int):
+        """
+        Add to the usage of a folder and all its ancestors
+
+        Args:
+            folder_id (ObjectId): The ID of the folder
+            size (int): The number of bytes to add, may be negative
+            files (int): The number of files to add, may be negative
+        """
+        if not size and not files:
+            return
+        self.store.inc_usage(self._ancestors(folder_id), size, files)
+
+    def get_usage(self, path: str):
+        """
+        Get the number of bytes and files stored under a path
+
+        Args:
+            path (str): The path of the file or directory
+
+        Returns:
+            code (int): An error code, or 0 if successful
+            usage (Union[dict, None]): The usage, as a dict with "size" and "files"
+        """
+        stat, fn = self.find(self.path_splitter(path), return_obj=True, projection=_USAGE_FIELDS)
+        if stat != 0:
+            return 1, None  # Path not found
+        size, files = self._usage_of(fn)
+        return 0, {"size": size, "files": files}
+
+    def rebuild_usage(self, folder_id=None):
+        """
+        Recompute the usage of a folder and every folder under it
+
+        The direct usage of each folder is summed by the database,
+        then added up the tree from the deepest folders. Ancestors of folder_id
+        are left untouched.
+
+        Args:
+            folder_id (Optional[ObjectId]): The ID of the folder, defaults to the root directory
+
+        Returns:
+            usage (dict): The usage of the folder, as a dict with "size" and "files"
+        """
+        if folder_id is None:
+            folder_id = self.root_id
+        parents = {folder_id: None}
+        for fn in self.iter_subtree(folder_id, projection={"type": 1, "parent": 1}, folders_only=True):
+            parents[fn["_id"]] = fn["parent"]
+
+        totals = {i: [0, 0] for i in parents}
+        folder_ids = list(parents)
+        for parent_id, size, files in self.store.sum_files(folder_ids):
+            totals[parent_id] = [size, files]
+
+        # parents were collected breadth first, so going backwards visits children before their parent
+        for i in reversed(folder_ids[1:]):
+            totals[parents[i]][0] += totals[i][0]
+            totals[parents[i]][1] += totals[i][1]
+
+        self.store.set_usage((i, size, files) for i, (size, files) in totals.items())
+        if folder_id == self.root_id:
+            self.store.set_migrated("usage")
+        size, files = totals[folder_id]
+        return {"size": size, "files": files}
+
     def copy(
         self,
         path_src: str,
@@ -825,7 +1518,7 @@ class DSdriveApiWebhook(DSdriveApiBase):
 
         if len(paths_dst) == 0:
             return 2  # Root directory is not a file
-        stat, src_fn = self.find(paths_src, return_obj=True)
+        stat, src_fn = self.find(paths_src, return_obj=True, projection=_COPY_FIELDS)
         if stat != 0:
             return 1  # Path not found
 
@@ -841,33 +1534,275 @@ class DSdriveApiWebhook(DSdriveApiBase):
         if not (src_fn["type"] == "file"):
             return 2  # src is a folder
 
-        dst_fn = self.db["tree"].find_one(
-            {"name": paths_dst[-1], "parent": parent_id_dst}
-        )
+        dst_fn = self.store.get_child(parent_id_dst, paths_dst[-1], _USAGE_FIELDS)
         if dst_fn:
             if not overwrite:
                 return 3  # Path already exists
             if not (dst_fn["type"] == "file"):
                 return 2  # src and dst are not both files
-            self.db["tree"].delete_one({"_id": dst_fn["_id"]})
+            self.store.delete([dst_fn["_id"]])
+            self.store.delete_chunks([dst_fn["_id"]])
+            self._inc_usage(parent_id_dst, -dst_fn["details"]["size"], -1)
 
-        self.db["tree"].insert_one(
+        dst_id = self.store.new_id()
+        self.store.copy_chunks([(src_fn["_id"], dst_id)])
+        details = dict(src_fn["details"])
+        if not preserve_timestamps:
+            details["modified"] = time.time()
+        self.store.insert(
             {
+                "_id": dst_id,
                 "name": paths_dst[-1],
                 "type": src_fn["type"],
-                "urls": src_fn["urls"].copy(),
-                "chunk_sizes": src_fn["chunk_sizes"].copy(),
                 "access": src_fn["access"],
-                "details": src_fn["details"],
+                "details": details,
                 "parent": parent_id_dst,
+                "url_expire": src_fn.get("url_expire"),
+                "hashes": src_fn.get("hashes"),
             }
         )
-        if not preserve_timestamps:
-            self.db["tree"].update_one(
-                {"_id": src_fn["_id"]}, {"$set": {"details.modified": time.time()}}
-            )
+        self._inc_usage(parent_id_dst, src_fn["details"]["size"], 1)
         return 0
 
+    def copy_tree(
+        self,
+        path_src: str,
+        path_dst: str,
+        create_dirs: bool=False,
+        preserve_timestamps: bool=False,
+    ):
+        """
+        Copy the contents of a directory into another directory, chunks are shared and no data is transferred
+
+        The source subtree is read one level at a time and recreated under the destination
+        with bulk inserts. Folders that already exist in the destination are merged, and
+        files that already exist are overwritten.
+
+        Args:
+            path_src (str): The path of the source directory
+            path_dst (str): The path of the destination directory
+            create_dirs (bool): Whether to create the destination directory if it doesn't exist, its parent must exist
+            preserve_timestamps (bool): Whether to keep the modification times of the copied resources
+
+        Returns:
+            code (int): An error code, or 0 if successful
+        """
+        stat, src_fn = self.find(self.path_splitter(path_src), return_obj=True, projection=_ID_FIELDS)
+        if stat != 0:
+            return 1  # Source not found
+        if src_fn["type"] != "folder":
+            return 2  # Source is not a folder
+        paths_dst = self.path_splitter(path_dst)
+        stat, dst_fn = self.find(paths_dst, return_obj=True, projection=_USAGE_FIELDS)
+        if stat != 0:
+            if not create_dirs:
+                return 4  # Destination not found
+            # checked before the destination is created, so a refusal leaves nothing behind
+            if self._is_inside(self._deepest_node(paths_dst), src_fn["_id"]):
+                return 5  # Cannot copy a folder into itself
+            stat, dst_id = self.makedirs(paths_dst, allow_many=False, exist_ok=True)
+            if stat != 0:
+                return 4  # Parent of the destination not found
+            merged = set()  # nothing to merge into a new folder
+            dst_fn = {"_id": dst_id, "type": "folder"}
+        else:
+            if dst_fn["type"] != "folder":
+                return 3  # Destination is a file
+            dst_id = dst_fn["_id"]
+            merged = {dst_id}
+            if self._is_inside(dst_id, src_fn["_id"]):
+                return 5  # Cannot copy a folder into itself
+            # nothing is overwritten unless the whole copy can go through
+            if self._merge_conflict(src_fn["_id"], dst_id):
+                return 3  # A file and a folder share the same name
+
+        code = 0
+        now = time.time()
+        id_map = {src_fn["_id"]: dst_id}
+        frontier = [src_fn["_id"]]
+        while frontier:
+            children = list(self.store.find_children(frontier, _COPY_FIELDS))
+            # only folders that existed before the copy can hold conflicting names
+            merge_parents = [id_map[p] for p in frontier if id_map[p] in merged]
+            existing = {}
+            for fn in self.store.find_children(merge_parents, {"name": 1, "parent": 1, "type": 1}):
+                existing[(fn["parent"], fn["name"])] = fn
+
+            new_docs = []
+            file_pairs = []
+            replaced = []
+            frontier = []
+            for fn in children:
+                parent_id = id_map[fn["parent"]]
+                old = existing.get((parent_id, fn["name"]))
+                if old:
+                    if old["type"] != fn["type"]:
+                        code = 3  # A file and a folder share the same name, made by someone else since the check
+                        continue
+                    if old["type"] == "folder":
+                        id_map[fn["_id"]] = old["_id"]
+                        merged.add(old["_id"])
+                        frontier.append(fn["_id"])
+                        continue
+                    replaced.append(old["_id"])
+                details = dict(fn["details"])
+                if not preserve_timestamps:
+                    details["modified"] = now
+                doc = {
+                    "_id": self.store.new_id(),
+                    "name": fn["name"],
+                    "parent": parent_id,
+                    "type": fn["type"],
+                    "access": fn["access"],
+                    "details": details,
+                }
+                if fn["type"] == "folder":
+                    doc["usage"] = {"size": 0, "files": 0}
+                else:
+                    doc["url_expire"] = fn.get("url_expire")
+                    doc["hashes"] = fn.get("hashes")
+                id_map[fn["_id"]] = doc["_id"]
+                new_docs.append(doc)
+                if fn["type"] == "folder":
+                    frontier.append(fn["_id"])
+                else:
+                    file_pairs.append((fn["_id"], doc["_id"]))
+            # manifests first, so no file shows up without its chunks, and the files replaced go right before their copies
+            self.store.copy_chunks(file_pairs)
+            if replaced:
+                self.store.delete(replaced)
+                self.store.delete_chunks(replaced)
+            self.store.insert_many(new_docs)
+
+        # recount the destination, whatever was merged or overwritten, and pass the difference up
+        size, files = self._usage_of(dst_fn)
+        usage = self.rebuild_usage(dst_id)
+        if dst_id != self.root_id:
+            self._inc_usage(self.store.get(dst_id, {"parent": 1})["parent"], usage["size"] - size, usage["files"] - files)
+        return code
+
+    def _merge_conflict(self, src_id, dst_id) -> bool:
+        """
+        Check whether copying a folder into another would put a file where a folder is, or the other way around
+
+        Only the folders present on both sides are walked, a folder new to the destination can't clash.
+
+        Args:
+            src_id (ObjectId): The ID of the source folder
+            dst_id (ObjectId): The ID of the destination folder
+
+        Returns:
+            bool: True if a file and a folder would share a name
+        """
+        fields = {"name": 1, "parent": 1, "type": 1}
+        frontier = {src_id: dst_id}  # source folder -> the destination folder it merges into
+        while frontier:
+            existing = {(fn["parent"], fn["name"]): fn for fn in self.store.find_children(list(frontier.values()), fields)}
+            merging = {}
+            for fn in self.store.find_children(list(frontier), fields):
+                old = existing.get((frontier[fn["parent"]], fn["name"]))
+                if old is None:
+                    continue
+                if old["type"] != fn["type"]:
+                    return True
+                if old["type"] == "folder":
+                    merging[fn["_id"]] = old["_id"]
+            frontier = merging
+        return False
+
+    def query(
+        self,
+        path: str="/",
+        min_size: Optional[int]=None,
+        max_size: Optional[int]=None,
+        modified_after: Optional[float]=None,
+        modified_before: Optional[float]=None,
+        name_prefix: Optional[str]=None,
+        sort: str="name",
+        descending: bool=False,
+        limit: int=100,
+        cursor: Optional[str]=None,
+    ):
+        """
+        Find the files under a directory by size, modification time and name, all bounds are inclusive
+
+        The filters and the sort are answered from the indexes of the metadata store,
+        and pages are resumed from the last file of the previous page rather than
+        skipped over, so every page costs the same.
+
+        Args:
+            path (str): The path of the directory to search, recursively
+            min_size (Optional[int]): The smallest size
+            max_size (Optional[int]): The largest size
+            modified_after (Optional[float]): The earliest modification time
+            modified_before (Optional[float]): The latest modification time
+            name_prefix (Optional[str]): What the names start with
+            sort (str): The field to sort by, "name", "size" or "modified"
+            descending (bool): Whether to sort in descending order
+            limit (int): The maximum number of files returned
+            cursor (Optional[str]): The cursor returned with the previous page
+
+        Returns:
+            code (int): An error code, or 0 if successful
+            results (Union[list, None]): (path, document) tuples
+            cursor (Union[str, None]): The cursor of the next page, or None if this is the last one
+        """
+        if sort not in ("name", "size", "modified"):
+            return 3, None, None  # Unknown sort field
+        stat, fn = self.find(self.path_splitter(path), return_obj=True, projection=_ID_FIELDS)
+        if stat != 0:
+            return 1, None, None  # Path not found
+        if fn["type"] != "folder":
+            return 2, None, None  # Path is a file
+
+        dir_paths = {fn["_id"]: fs.path.abspath(fs.path.normpath(path))}
+        parent_ids = None
+        if fn["_id"] != self.root_id:
+            # no ancestors index, so the subtree is narrowed down to its folders
+            for folder in self.iter_subtree(fn["_id"], {"name": 1}, folders_only=True):
+                dir_paths[folder["_id"]] = fs.path.combine(dir_paths[folder["parent"]], folder["name"])
+            parent_ids = list(dir_paths)
+
+        after = None
+        if cursor is not None:
+            value, node_id = json.loads(cursor)
+            after = (value, self.store.parse_id(node_id))
+        docs = list(self.store.query_files(
+            parent_ids, min_size, max_size, modified_after, modified_before,
+            name_prefix, sort, descending, after, limit,
+        ))
+
+        results = [(fs.path.combine(self._dir_path(fn["parent"], dir_paths), fn["name"]), fn) for fn in docs]
+        next_cursor = None
+        if len(docs) == limit:
+            last = docs[-1]
+            value = last["name"] if sort == "name" else last["details"][sort]
+            next_cursor = json.dumps([value, str(last["_id"])])
+        return 0, results, next_cursor
+
+    def _dir_path(self, folder_id, dir_paths: dict):
+        """
+        Get the path of a folder by following the parent links, up to a folder whose path is known
+
+        Args:
+            folder_id (ObjectId): The ID of the folder
+            dir_paths (dict): Known paths by folder ID, the root must be in it, and new paths are added to it
+
+        Returns:
+            str: The path of the folder
+        """
+        chain = []
+        node_id = folder_id
+        while node_id not in dir_paths:
+            fn = self.store.get(node_id, {"name": 1, "parent": 1})
+            chain.append(fn)
+            node_id = fn["parent"]
+        path = dir_paths[node_id]
+        for fn in reversed(chain):
+            path = fs.path.combine(path, fn["name"])
+            dir_paths[fn["_id"]] = path
+        return path
+
     def get_info(self, path: str):
         """
         Get the info of a file or directory
@@ -881,17 +1816,26 @@ class DSdriveApiWebhook(DSdriveApiBase):
         """
         paths = self.path_splitter(path)
         if paths == []:  # Root directory
-            fn = self.db["tree"].find_one({"_id": self.root_id})
-            return 0, {
-                "access": fn["access"],
-                "basic": {"name": fn["name"], "is_dir": True},
-                "details": fn["details"],
-            }
+            fn = self.store.get(self.root_id, _INFO_FIELDS)
+            return 0, self.raw_info(fn)
 
         stat, fn = self.find(paths, return_obj=True)
         if stat != 0:
             return 1, None  # Path not found
-        raw_info = {
+        return 0, self.raw_info(fn)
+
+    @staticmethod
+    def raw_info(fn: dict):
+        """
+        Convert a database document into the raw info format of pyfilesystem
+
+        Args:
+            fn (dict): The document of the file or directory
+
+        Returns:
+            info (dict): The raw info of the file or directory
+        """
+        return {
             "access": fn["access"],
             "basic": {
                 "name": fn["name"],
@@ -899,7 +1843,6 @@ class DSdriveApiWebhook(DSdriveApiBase):
             },
             "details": fn["details"],
         }
-        return 0, raw_info
 
     def _set_info_by_fn(self, fn, info: dict):
         out_info = {}
@@ -920,7 +1863,7 @@ class DSdriveApiWebhook(DSdriveApiBase):
                 else:
                     out_info["type"] = "file"
 
-        self.db["tree"].update_one({"_id": fn["_id"]}, {"$set": out_info})
+        self.store.update(fn["_id"], out_info)
         return 0
 
     def set_info(self, path: str, info: dict):
@@ -937,13 +1880,13 @@ class DSdriveApiWebhook(DSdriveApiBase):
 
         paths = self.path_splitter(path)
         if paths == []:  # Root directory
-            fn = self.db["tree"].find_one({"_id": self.root_id})
+            fn = self.store.get(self.root_id, _INFO_FIELDS)
         else:
             stat, parent_id = self.find(paths[:-1])
             if stat != 0:
                 return 1
 
-            fn = self.db["tree"].find_one({"name": paths[-1], "parent": parent_id})
+            fn = self.store.get_child(parent_id, paths[-1], _INFO_FIELDS)
             if not fn:
                 return 1
 
@@ -69,7 +69,7 @@ class DSUrl:
         """the full url of the file"""
         if self.filename is None or self.expire is None or self.issue is None or self.signature is None:
             raise ValueError(f"Required attribute is not set: filename={self.filename}, expire={self.expire}, issue={self.issue}, signature={self.signature}")
-        return f"https://cdn.discordapp.com/attachments/{self.channel_id}/{self.message_id}/{self.attachment_id}/{self.filename.decode()}?ex={self.expire:x}&is={self.issue:x}&hm={self.signature.hex()}"
+        return f"https://cdn.discordapp.com/attachments/{self.channel_id}/{self.attachment_id}/{self.filename.decode()}?ex={self.expire:x}&is={self.issue:x}&hm={self.signature.hex()}"
     
     def __str__(self) -> str:
         return self.url
@@ -83,15 +83,15 @@ class BaseExpirePolicy:
     def __init__(self):
         pass
 
-    def is_expired(self, dsurl):
-        """check if the url is expired, will be True if the url will expire in 10 minutes"""
+    def is_expired(self, dsurl, within: float=0):
+        """check if the url is expired, will be True if the url will expire in 10 minutes, plus within seconds"""
         timenow = int(time.time())
-        return timenow > dsurl.expire - 600
+        return timenow + within > dsurl.expire - 600
     
     def setup(self, *args, **kwargs):
         """setup the expire policy"""
         pass
 
-    def renew_url(self, dsurls: Iterable[DSUrl]):
-        """renew the url"""
+    def renew_url(self, dsurls: Iterable[DSUrl], within: float=0):
+        """renew the urls that are expired, or will be within seconds from now"""
         raise NotImplementedError()
\ No newline at end of file
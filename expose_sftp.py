@@ -32,6 +32,7 @@ SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 # modified from https://github.com/PyFilesystem/pyfilesystem to make it support pyfilesystem2
 
 import os
+import socket
 import stat as statinfo
 import time
 import socketserver
@@ -40,10 +41,16 @@ import datetime
 import copy
 import struct
 import argparse
+import itertools
+import json
+import hashlib
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from functools import wraps
 
 import paramiko
-from paramiko.sftp import _VERSION, CMD_EXTENDED, CMD_INIT, CMD_VERSION, SFTP_OP_UNSUPPORTED, SFTPError
+from paramiko.sftp import _VERSION, CMD_EXTENDED, CMD_EXTENDED_REPLY, CMD_INIT, CMD_OPEN, CMD_OPENDIR, CMD_VERSION, SFTP_BAD_MESSAGE, SFTP_OP_UNSUPPORTED, SFTPError
 from paramiko.message import Message
 import yaml
 
@@ -52,11 +59,38 @@ from fs.errors import *
 
 from discord_fs import DiscordFS
 from dsdrive_api import DSdriveApi, HookTool
+from api_expire import EXPIRE_POLICIES
+from rate_limit import RateLimiter, MongoRateLease
+from prefork import PreforkSupervisor
+from transport_profile import TRANSPORT_PROFILES, make_profiles
 from config_loader import Config
 
 
 FSFactory = DiscordFS  # can be replaced with whatever FS class
 
+# statvfs@openssh.com figures, Discord storage has no fixed capacity
+STATVFS_BLOCK_SIZE = 4096
+STATVFS_FREE_BLOCKS = (1 << 50) // STATVFS_BLOCK_SIZE  # report 1 PiB free
+STATVFS_FREE_FILES = 1 << 32
+STATVFS_NAME_MAX = 255
+
+# how far a read may land from where the previous one ended and still count as sequential,
+# clients pipeline their reads and fill the short ones again
+SEQUENTIAL_SLACK = 1 << 20
+
+# sent before closing the connections the server has no room for
+BUSY_BANNER = b"Server busy, try again later\r\n"
+
+# limits@openssh.com figures, clients size their reads and writes after them instead of 32 KiB
+SFTP_MAX_READ_LENGTH = 1 << 20
+SFTP_MAX_WRITE_LENGTH = 1 << 20
+SFTP_MAX_PACKET_LENGTH = SFTP_MAX_WRITE_LENGTH + 1024  # room for the header of a write
+SFTP_MAX_OPEN_HANDLES = 256  # per session, files and folders together
+
+# check-file algorithms, the digests recorded for every file and chunk
+CHECK_FILE_HASHES = ("md5", "sha1")
+CHECK_FILE_MIN_BLOCK = 256
+
 
 # Default host key used by BaseSFTPServer
 
@@ -96,6 +130,29 @@ def permission_to_list(permission):
     permission_list = [d for i, d in enumerate(permission_list[::-1]) if permission & (1 << i)]
     return permission_list
 
+def stored_digest(hashes, size, offset, length):
+    """
+    Find the recorded digest of a range of a file, if it's the whole file or one of its chunks.
+
+    Args:
+        hashes (Optional[dict]): The digests of the file, as returned by DiscordFS.gethashes
+        size (int): The size of the file
+        offset (int): Where the range starts
+        length (int): The length of the range
+
+    Returns:
+        Optional[bytes]: The digest, None if none was recorded for the range
+    """
+    if hashes is None:
+        return None
+    if offset == 0 and length == size:
+        return bytes.fromhex(hashes["file"])
+    ordinal, skip = divmod(offset, hashes["chunk_size"])
+    if skip == 0 and ordinal < len(hashes["chunks"]) and length == min(hashes["chunk_size"], size - offset):
+        return bytes.fromhex(hashes["chunks"][ordinal])
+    return None
+
+
 def report_sftp_errors(func):
     """Decorator to catch and report FS errors as SFTP error codes.
 
@@ -132,11 +189,13 @@ class SFTPServerInterface(paramiko.SFTPServerInterface):
     paramiko server infrastructure.
     """
 
-    def __init__(self, server, fs, encoding=None, *args, **kwds):
+    def __init__(self, server, fs, encoding=None, recursive_rmdir=False, *args, **kwds):
         self.fs = fs
         if encoding is None:
             encoding = "utf+8"
         self.encoding = encoding
+        # remove non-empty directories on RMDIR instead of failing
+        self.recursive_rmdir = recursive_rmdir
         super(SFTPServerInterface,self).__init__(server, *args, **kwds)
 
     def close(self):
@@ -154,17 +213,19 @@ class SFTPServerInterface(paramiko.SFTPServerInterface):
         return SFTPHandle(self, path, flags)
 
     @report_sftp_errors
-    def list_folder(self, path):
+    def open_folder(self, path):
         self.renew()
         if not isinstance(path, str):
             path = path.decode(self.encoding)
-        stats = []
-        for entry in self.fs.listdir(path, absolute=True):
-            stat = self.stat(join(path, entry))
-            if not isinstance(stat, int):
-                stats.append(stat)
-        
-        return stats
+        entries = self.fs.scandir(path, namespaces=["details"])
+        return SFTPFolderHandle(self.make_stat(info) for info in entries)
+
+    @report_sftp_errors
+    def list_folder(self, path):
+        folder = self.open_folder(path)
+        if isinstance(folder, int):
+            return folder
+        return list(folder.entries)
 
     @report_sftp_errors
     def stat(self, path):
@@ -172,10 +233,15 @@ class SFTPServerInterface(paramiko.SFTPServerInterface):
         if not isinstance(path, str):
             path = path.decode(self.encoding)
 
-        info = self.fs.getinfo(path)
+        info = self.fs.getinfo(path, namespaces=["details"])
+        stat = self.make_stat(info)
+        stat.filename = basename(path)  # .encode(self.encoding)
+        return stat
 
+    def make_stat(self, info):
+        """Build SFTPAttributes out of an Info object, without querying the FS again."""
         stat = paramiko.SFTPAttributes()
-        stat.filename = basename(path)  # .encode(self.encoding)
+        stat.filename = info.name
         stat.st_size = info.get("details", "size")
 
         accessed = info.get("details", "accessed")
@@ -191,8 +257,7 @@ class SFTPServerInterface(paramiko.SFTPServerInterface):
         elif isinstance(modified, float):
             stat.st_mtime = time.mktime(datetime.datetime.fromtimestamp(modified).timetuple())
 
-
-        if self.fs.isdir(path):  # isdir(self.fs, path, info):  # check is dir
+        if info.is_dir:
             stat.st_mode = 0o777 | statinfo.S_IFDIR
         else:
             stat.st_mode = 0o777 | statinfo.S_IFREG
@@ -222,6 +287,19 @@ class SFTPServerInterface(paramiko.SFTPServerInterface):
             self.fs.movedir(oldpath, newpath, create=True)
         return paramiko.SFTP_OK
 
+    @report_sftp_errors
+    def posix_rename(self, oldpath, newpath):
+        self.renew()
+        if not isinstance(oldpath, str):
+            oldpath = oldpath.decode(self.encoding)
+        if not isinstance(newpath, str):
+            newpath = newpath.decode(self.encoding)
+        if self.fs.isfile(oldpath):
+            self.fs.move(oldpath, newpath, overwrite=True)
+        else:
+            self.fs.movedir(oldpath, newpath, create=True)
+        return paramiko.SFTP_OK
+
     @report_sftp_errors
     def mkdir(self, path, attr):
         self.renew()
@@ -238,9 +316,54 @@ class SFTPServerInterface(paramiko.SFTPServerInterface):
         self.renew()
         if not isinstance(path, str):
             path = path.decode(self.encoding)
-        self.fs.removedir(path)
+        if self.recursive_rmdir and self.canonicalize(path) != "/":
+            self.fs.removetree(path)
+        else:
+            self.fs.removedir(path)
         return paramiko.SFTP_OK
 
+    @report_sftp_errors
+    def statvfs(self, path):
+        """Return the statvfs@openssh.com fields for the subtree at path, taken from its stored usage."""
+        self.renew()
+        if not isinstance(path, str):
+            path = path.decode(self.encoding)
+        usage = self.fs.getusage(path)
+        used_blocks = -(-usage["size"] // STATVFS_BLOCK_SIZE)
+        return (
+            STATVFS_BLOCK_SIZE,  # f_bsize
+            STATVFS_BLOCK_SIZE,  # f_frsize
+            used_blocks + STATVFS_FREE_BLOCKS,  # f_blocks
+            STATVFS_FREE_BLOCKS,  # f_bfree
+            STATVFS_FREE_BLOCKS,  # f_bavail
+            usage["files"] + STATVFS_FREE_FILES,  # f_files
+            STATVFS_FREE_FILES,  # f_ffree
+            STATVFS_FREE_FILES,  # f_favail
+            0,  # f_fsid
+            0,  # f_flag
+            STATVFS_NAME_MAX,  # f_namemax
+        )
+
+    @report_sftp_errors
+    def query(self, path, request):
+        """Answer a query@dsdrive request, a JSON object of DiscordFS.query arguments, with a JSON page of results."""
+        self.renew()
+        if not isinstance(path, str):
+            path = path.decode(self.encoding)
+        if not isinstance(request, str):
+            request = request.decode(self.encoding)
+        try:
+            kwargs = json.loads(request)
+            results, cursor = self.fs.query(path, **kwargs)
+        except (ValueError, TypeError):
+            print(traceback.format_exc())
+            return paramiko.SFTP_BAD_MESSAGE
+        files = [
+            {"path": p, "size": info.size, "modified": info.raw["details"]["modified"]}
+            for p, info in results
+        ]
+        return json.dumps({"files": files, "cursor": cursor})
+
     def canonicalize(self, path):
         try:
             return abspath(normpath(path))  # .encode(self.encoding)
@@ -291,6 +414,9 @@ class SFTPHandle(paramiko.SFTPHandle):
 
     This is a simple file wrapper for SFTPServerInterface, passing read
     and write requests directly through the to underlying file from the FS.
+
+    Once a few reads in a row continue where the previous ones ended, files that
+    can read ahead, such as DSReadFile, are told to, and told to stop on a seek.
     """
 
     def __init__(self, owner, path, flags):
@@ -301,7 +427,12 @@ class SFTPHandle(paramiko.SFTPHandle):
         if not isinstance(path, str):
             path = path.decode(self.owner.encoding)
         self.path = path
-        self._file = owner.fs.open(path, mode)
+        # unbuffered, the buffer would be dropped on every seek anyway
+        self._file = owner.fs.openbin(path, mode)
+        self._read_only = "r" in mode and "+" not in mode
+        self._can_read_ahead = hasattr(self._file, "read_ahead")
+        self._next_offset = 0  # where a sequential read goes on
+        self._sequential = 0  # the sequential reads in a row
 
     @report_sftp_errors
     def close(self):
@@ -311,7 +442,22 @@ class SFTPHandle(paramiko.SFTPHandle):
     @report_sftp_errors
     def read(self, offset, length):
         self._file.seek(offset)
-        return self._file.read(length)
+        if self._can_read_ahead:
+            if abs(offset - self._next_offset) <= SEQUENTIAL_SLACK:
+                self._sequential += 1
+                if self._sequential >= 2:
+                    self._file.read_ahead()
+            else:
+                self._sequential = 0
+                self._file.cancel_read_ahead()
+            self._next_offset = offset + length
+        return self.read_at(offset, length)
+
+    @report_sftp_errors
+    def read_at(self, offset, length):
+        """Read without counting as a read of the client, so the read ahead of the handle is left as it is"""
+        self._file.seek(offset)
+        return self._file.read(min(length, SFTP_MAX_READ_LENGTH))
 
     @report_sftp_errors
     def write(self, offset, data):
@@ -322,10 +468,37 @@ class SFTPHandle(paramiko.SFTPHandle):
     def stat(self):
         return self.owner.stat(self.path)
 
+    def hashes(self, name):
+        """The digests recorded for the file, None if there are none or they may not match what the handle reads"""
+        gethashes = getattr(self.owner.fs, "gethashes", None)
+        if gethashes is None or not self._read_only:
+            return None
+        try:
+            return gethashes(self.path, name)
+        except FSError:
+            return None
+
     def chattr(self,attr):
         return self.owner.chattr(self.path, attr)
 
 
+class SFTPFolderHandle(paramiko.SFTPHandle):
+    """Directory handle that pulls entries lazily from an iterator.
+
+    Each READDIR request consumes at most ``batch_size`` entries, so large
+    directories are paged out to the client as they are read from the FS
+    instead of being materialised when the directory is opened.
+    """
+    batch_size = 100
+
+    def __init__(self, entries):
+        super(SFTPFolderHandle, self).__init__()
+        self.entries = iter(entries)
+
+    def _get_next_files(self):
+        return list(itertools.islice(self.entries, self.batch_size))
+
+
 class SFTPServer(paramiko.SFTPServer):
     """
     An SFTPServer class that closes the filesystem when done.
@@ -338,7 +511,7 @@ class SFTPServer(paramiko.SFTPServer):
             raise SFTPError("Incompatible sftp protocol")
         version = struct.unpack(">I", data[:4])[0]
         # advertise that we support "check-file"
-        extension_pairs = ["copy-data", "1", "check-file", "md5,sha1"]
+        extension_pairs = ["copy-data", "1", "check-file", "md5,sha1", "posix-rename@openssh.com", "1", "statvfs@openssh.com", "2", "limits@openssh.com", "1", "query@dsdrive", "1"]
         msg = Message()
         msg.add_int(_VERSION)
         msg.add(*extension_pairs)
@@ -346,7 +519,100 @@ class SFTPServer(paramiko.SFTPServer):
         return version
 
     def _process(self, t, request_number, msg):
-        if t == CMD_EXTENDED:
+        manager = getattr(self.get_server(), "manager", None)
+        if manager is None:
+            return self._dispatch(t, request_number, msg)
+        # filesystem work runs in the manager's workers, this thread waits and reads no more requests
+        manager.run(
+            self._dispatch, t, request_number, msg,
+            busy=lambda: self._send_status(request_number, paramiko.SFTP_FAILURE, "Server busy, try again later"),
+        )
+
+    def _check_file(self, request_number, msg):
+        # blocks covering the whole file or one of its chunks are answered from the digests
+        # recorded when it was written, only the other blocks are read and hashed
+        handle = msg.get_binary()
+        alg_list = msg.get_list()
+        start = msg.get_int64()
+        length = msg.get_int64()
+        block_size = msg.get_int()
+        if handle not in self.file_table:
+            self._send_status(request_number, SFTP_BAD_MESSAGE, "Invalid handle")
+            return
+        f = self.file_table[handle]
+        algname = next((name for name in alg_list if name in CHECK_FILE_HASHES), None)
+        if algname is None:
+            self._send_status(request_number, paramiko.SFTP_FAILURE, "No supported hash types found")
+            return
+        st = f.stat()
+        if not isinstance(st, paramiko.SFTPAttributes):
+            self._send_status(request_number, st, "Unable to stat file")
+            return
+        end = st.st_size if length == 0 else min(start + length, st.st_size)
+        if block_size == 0:
+            block_size = max(end - start, CHECK_FILE_MIN_BLOCK)
+        if block_size < CHECK_FILE_MIN_BLOCK:
+            self._send_status(request_number, paramiko.SFTP_FAILURE, "Block size too small")
+            return
+
+        hashes = f.hashes(algname) if isinstance(f, SFTPHandle) else None
+        # the client may be streaming from the handle, hashing mustn't start or stop its read ahead
+        read = f.read_at if isinstance(f, SFTPHandle) else f.read
+        sum_out = []
+        for offset in range(start, max(end, start + 1), block_size):
+            blocklen = max(0, min(block_size, end - offset))
+            digest = stored_digest(hashes, st.st_size, offset, blocklen)
+            if digest is None:
+                hash_obj = hashlib.new(algname)
+                position = offset
+                while position < offset + blocklen:
+                    data = read(position, min(offset + blocklen - position, SFTP_MAX_READ_LENGTH))
+                    if not isinstance(data, bytes):
+                        self._send_status(request_number, data, "Unable to hash file")
+                        return
+                    if not data:
+                        break
+                    hash_obj.update(data)
+                    position += len(data)
+                digest = hash_obj.digest()
+            sum_out.append(digest)
+
+        reply = Message()
+        reply.add_int(request_number)
+        reply.add_string("check-file")
+        reply.add_string(algname)
+        reply.add_bytes(b"".join(sum_out))
+        self._send_packet(CMD_EXTENDED_REPLY, reply)
+
+    def _read_all(self, n):
+        if isinstance(self.sock, socket.socket):
+            return super(SFTPServer, self)._read_all(n)
+        # joined once, adding up the pieces of a large write would copy it over and over
+        pieces = []
+        while n > 0:
+            x = self.sock.recv(n)
+            if len(x) == 0:
+                raise EOFError()
+            pieces.append(x)
+            n -= len(x)
+        return b"".join(pieces)
+
+    def _write_all(self, out):
+        # a channel takes a window at a time, sent from a view instead of a copy of what's left
+        out = memoryview(out)
+        while len(out) > 0:
+            n = self.sock.send(out)
+            if n <= 0:
+                raise EOFError()
+            out = out[n:]
+
+    def _dispatch(self, t, request_number, msg):
+        if t in (CMD_OPEN, CMD_OPENDIR) and len(self.file_table) + len(self.folder_table) >= SFTP_MAX_OPEN_HANDLES:
+            self._send_status(request_number, paramiko.SFTP_FAILURE, "Too many open handles")
+        elif t == CMD_OPENDIR:
+            path = msg.get_text()
+            self._send_handle_response(request_number, self.server.open_folder(path), True)
+        elif t == CMD_EXTENDED:
             # Copy of CMD_EXTENDED implementation from SFTPServer._process
             tag = msg.get_text()
             # print(tag)
@@ -358,6 +624,36 @@ class SFTPServer(paramiko.SFTPServer):
                 self._send_status(
                     request_number, self.server.posix_rename(oldpath, newpath)
                 )
+            elif tag == "statvfs@openssh.com":
+                path = msg.get_text()
+                resp = self.server.statvfs(path)
+                if isinstance(resp, int):
+                    self._send_status(request_number, resp)
+                else:
+                    reply = Message()
+                    reply.add_int(request_number)
+                    for field in resp:
+                        reply.add_int64(field)
+                    self._send_packet(CMD_EXTENDED_REPLY, reply)
+            elif tag == "limits@openssh.com":
+                reply = Message()
+                reply.add_int(request_number)
+                reply.add_int64(SFTP_MAX_PACKET_LENGTH)
+                reply.add_int64(SFTP_MAX_READ_LENGTH)
+                reply.add_int64(SFTP_MAX_WRITE_LENGTH)
+                reply.add_int64(SFTP_MAX_OPEN_HANDLES)
+                self._send_packet(CMD_EXTENDED_REPLY, reply)
+            elif tag == "query@dsdrive":
+                path = msg.get_text()
+                request = msg.get_text()
+                resp = self.server.query(path, request)
+                if isinstance(resp, int):
+                    self._send_status(request_number, resp)
+                else:
+                    reply = Message()
+                    reply.add_int(request_number)
+                    reply.add_string(resp)
+                    self._send_packet(CMD_EXTENDED_REPLY, reply)
             elif tag == "copy-data":
                 oldpath = msg.get_text()
                 newpath = msg.get_text()
@@ -370,7 +666,10 @@ class SFTPServer(paramiko.SFTPServer):
                 print("ashsjhdjh  ", oldpath, newpath)
                 
                 try:
-                    self.server.fs.copy(oldpath, newpath)
+                    if self.server.fs.isdir(oldpath):
+                        self.server.fs.copydir(oldpath, newpath, create=True)
+                    else:
+                        self.server.fs.copy(oldpath, newpath)
                     self._send_status(request_number, paramiko.SFTP_OK)
                 except:
                     print(traceback.format_exc())
@@ -384,9 +683,149 @@ class SFTPServer(paramiko.SFTPServer):
     def finish_subsystem(self):
         # Close the SFTPServerInterface, it will close the pyfs file system.
         self.server.close()
+        end_session = getattr(self.get_server(), "end_session", None)
+        if end_session is not None:
+            end_session(self.get_channel().get_id())
         super(SFTPServer, self).finish_subsystem()
 
 
+class ManagedTransport(paramiko.Transport):
+    """A paramiko Transport calling on_close once its thread is done with the connection."""
+    on_close = None
+
+    def run(self):
+        try:
+            super(ManagedTransport, self).run()
+        finally:
+            if self.on_close is not None:
+                self.on_close()
+
+
+class ConnectionManager:
+    """
+    Bound the connections, sessions and filesystem work a BaseSFTPServer takes on at once.
+
+    Every SSH connection holds one of max_connections slots from accept to close.
+    The connections accepted while all slots are taken wait in a queue of up to
+    accept_queue, and the ones beyond are sent BUSY_BANNER and closed. Key exchange
+    and authentication wait in a pool of handshake_workers threads.
+
+    A user opens up to max_sessions_per_user sessions across connections, the
+    channels over are refused with a resource shortage.
+
+    The SFTP requests of every session run in a pool of fs_workers threads, apart
+    from paramiko's transport threads. A session waits for its request before
+    reading the next one, so a busy server slows clients down through SSH flow
+    control instead of buffering their requests. A request still waiting for a
+    worker after busy_timeout seconds is answered with a failure.
+    """
+
+    def __init__(self, max_connections=100, max_sessions_per_user=10, accept_queue=200, handshake_workers=8, fs_workers=16, busy_timeout=30.0):
+        self.max_connections = max_connections
+        self.max_sessions_per_user = max_sessions_per_user
+        self.accept_queue = accept_queue
+        self.busy_timeout = busy_timeout
+        self._handshakes = ThreadPoolExecutor(handshake_workers, thread_name_prefix="sftp-handshake")
+        self._workers = ThreadPoolExecutor(fs_workers, thread_name_prefix="sftp-fs")
+        self._lock = threading.Lock()
+        self._active = set()  # the sockets holding a slot
+        self._queue = collections.deque()  # (socket, start) waiting for a slot
+        self._user_sessions = collections.Counter()
+        self._counters = collections.Counter()
+
+    @property
+    def metrics(self):
+        """The connections and sessions served now, and the totals of the ones accepted and turned away."""
+        with self._lock:
+            return {
+                "connections": len(self._active),
+                "queued": len(self._queue),
+                "sessions": sum(self._user_sessions.values()),
+                "accepted": self._counters["accepted"],
+                "rejected_connections": self._counters["rejected_connections"],
+                "rejected_sessions": self._counters["rejected_sessions"],
+                "busy_requests": self._counters["busy_requests"],
+            }
+
+    def accept(self, request, start):
+        """Call start() in a handshake worker once request holds a slot, release must follow."""
+        with self._lock:
+            if len(self._active) < self.max_connections:
+                self._active.add(request)
+                self._counters["accepted"] += 1
+            elif len(self._queue) < self.accept_queue:
+                self._queue.append((request, start))
+                return
+            else:
+                self._counters["rejected_connections"] += 1
+                start = None
+        if start is None:
+            try:
+                request.sendall(BUSY_BANNER)
+            except OSError:
+                pass
+            request.close()
+            return
+        self._handshakes.submit(self._handshake, request, start)
+
+    def _handshake(self, request, start):
+        try:
+            start()
+        except Exception:
+            print(traceback.format_exc())
+            request.close()
+            self.release(request)
+
+    def release(self, request):
+        """Free the slot of a closed connection for the next one queued, once per connection."""
+        with self._lock:
+            if request not in self._active:
+                return
+            self._active.remove(request)
+            if not self._queue:
+                return
+            request, start = self._queue.popleft()
+            self._active.add(request)
+            self._counters["accepted"] += 1
+        self._handshakes.submit(self._handshake, request, start)
+
+    def open_session(self, username):
+        """Count a session of a user, False if the user has no session left."""
+        with self._lock:
+            if self._user_sessions[username] >= self.max_sessions_per_user:
+                self._counters["rejected_sessions"] += 1
+                return False
+            self._user_sessions[username] += 1
+            return True
+
+    def close_session(self, username):
+        with self._lock:
+            self._user_sessions[username] -= 1
+            if self._user_sessions[username] <= 0:
+                del self._user_sessions[username]
+
+    def run(self, fn, *args, busy=None):
+        """Run fn(*args) in a filesystem worker and wait for it, or return busy() if no worker took it in time."""
+        future = self._workers.submit(fn, *args)
+        try:
+            return future.result(timeout=self.busy_timeout)
+        except FutureTimeoutError:
+            if not future.cancel():
+                return future.result()  # started, so it's not the queue that's slow
+            with self._lock:
+                self._counters["busy_requests"] += 1
+            return busy() if busy is not None else None
+
+    def close(self):
+        with self._lock:
+            queued = list(self._queue)
+            self._queue.clear()
+        for request, _ in queued:
+            request.close()
+        self._handshakes.shutdown(wait=False)
+        self._workers.shutdown(wait=False)
+
+
 class SFTPRequestHandler(socketserver.BaseRequestHandler):
     """SocketServer RequestHandler subclass for BaseSFTPServer.
 
@@ -399,15 +838,13 @@ class SFTPRequestHandler(socketserver.BaseRequestHandler):
 
     def setup(self):
         """
-        Creates the SSH transport. Sets security options.
+        Creates the SSH transport. Sets security options from the transport profile of the server.
         """
-        self.transport = paramiko.Transport(self.request)
-        self.transport.load_server_moduli()
-        so = self.transport.get_security_options()
-        so.digests = ('hmac-sha1', )
-        so.compression = ('zlib@openssh.com', 'none')
+        profile = self.server.profile
+        self.transport = ManagedTransport(self.request, **profile.transport_options())
+        profile.apply(self.transport)
         self.transport.add_server_key(self.server.host_key)
-        self.transport.set_subsystem_handler("sftp", SFTPServer, SFTPServerInterface, self.server.fs, encoding=self.server.encoding)
+        self.transport.set_subsystem_handler("sftp", SFTPServer, SFTPServerInterface, self.server.fs, encoding=self.server.encoding, recursive_rmdir=self.server.recursive_rmdir)
 
     def handle(self):
         """
@@ -416,6 +853,8 @@ class SFTPRequestHandler(socketserver.BaseRequestHandler):
         interface = BaseServerInterface()
         interface.set_auths(self.server.auths)
         interface.noauth = self.server.noauth
+        interface.manager = self.server.manager
+        self.transport.on_close = lambda: self.connection_closed(interface)
         self.transport.start_server(server=interface)
         # TODO: I like the code below _in theory_ but it does not work as I expected.
         # Figure out how to actually time out a new client if they fail to auth in a
@@ -424,6 +863,14 @@ class SFTPRequestHandler(socketserver.BaseRequestHandler):
         #if chan is None:
         #    self.transport.close()
 
+    def connection_closed(self, interface):
+        """
+        Called from the transport thread once the connection is closed.
+        """
+        interface.end_sessions()
+        if self.server.manager is not None:
+            self.server.manager.release(self.request)
+
     def handle_timeout(self):
         try:
             self.transport.close()
@@ -436,7 +883,7 @@ class ThreadedTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
     pass
 
 
-class BaseSFTPServer(ThreadedTCPServer):
+class BaseSFTPServer(socketserver.TCPServer):
     """SocketServer.TCPServer subclass exposing an FS via SFTP.
 
     Operation is in the standard SocketServer style.  The target FS object
@@ -444,21 +891,51 @@ class BaseSFTPServer(ThreadedTCPServer):
 
         server = BaseSFTPServer((hostname,port),fs)
         server.serve_forever()
+
+    Connections are served within the bounds of a ConnectionManager, built from
+    the limits dict of its keyword arguments, or the manager given, shared with
+    the servers of other listeners. The SSH algorithms and flow control come from
+    the TransportProfile given, the built in "default" one otherwise. With
+    reuse_port, other servers can bind the same address, see PreforkSupervisor.
     """
     # If the server stops/starts quickly, don't fail because of
     # "port in use" error.
     allow_reuse_address = True
+    # let bursts of clients wait in the kernel instead of being refused
+    request_queue_size = 128
 
-    def __init__(self, address, fs=None, encoding=None, host_key=None, RequestHandlerClass=None, auths=None, noauth=False):
+    def __init__(self, address, fs=None, encoding=None, host_key=None, RequestHandlerClass=None, auths=None, noauth=False, recursive_rmdir=False, limits=None, reuse_port=False, profile=None, manager=None):
         self.fs = fs  # if change fs, also change here
         self.encoding = encoding
         self.auths = auths if auths is not None else []
         self.noauth = noauth
+        self.recursive_rmdir = recursive_rmdir
         self.host_key = host_key
+        self._owns_manager = manager is None
+        self.manager = ConnectionManager(**(limits or {})) if manager is None else manager
+        self.profile = profile if profile is not None else TRANSPORT_PROFILES["default"]
+        self.allow_reuse_port = reuse_port
+        # once for all connections, paramiko reloads the class-wide moduli on each call
+        paramiko.Transport.load_server_moduli()
         if RequestHandlerClass is None:
             RequestHandlerClass = SFTPRequestHandler
         socketserver.TCPServer.__init__(self, address, RequestHandlerClass)
 
+    def server_bind(self):
+        # socketserver only sets SO_REUSEPORT itself from Python 3.11
+        if self.allow_reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        socketserver.TCPServer.server_bind(self)
+
+    def process_request(self, request, client_address):
+        # serve it in a handshake worker, once it has a slot
+        self.manager.accept(request, lambda: self.finish_request(request, client_address))
+
+    def server_close(self):
+        socketserver.TCPServer.server_close(self)
+        if self._owns_manager:
+            self.manager.close()
+
     def shutdown_request(self, request):
         # Prevent TCPServer from closing the connection prematurely
         return
@@ -468,6 +945,38 @@ class BaseSFTPServer(ThreadedTCPServer):
         return
 
 
+class SFTPListeners:
+    """
+    The servers of several listeners, served together
+
+    The first server runs in the thread calling serve_forever, the others in
+    threads of their own. They share the ConnectionManager of the first one, so
+    the limits hold across listeners.
+
+    Attributes:
+        servers (list): The BaseSFTPServers, the one owning the manager first
+        manager (ConnectionManager): The manager of the first server
+    """
+
+    def __init__(self, servers):
+        self.servers = servers
+        self.manager = servers[0].manager
+
+    def serve_forever(self):
+        for server in self.servers[1:]:
+            threading.Thread(target=server.serve_forever, name="sftp-listener-%s:%d" % server.server_address[:2], daemon=True).start()
+        self.servers[0].serve_forever()
+
+    def shutdown(self):
+        for server in self.servers:
+            server.shutdown()
+
+    def server_close(self):
+        # the first server closes the shared manager, once the others are closed
+        for server in reversed(self.servers):
+            server.server_close()
+
+
 class BaseServerInterface(paramiko.ServerInterface):
     """
     Paramiko ServerInterface implementation that performs user authentication.
@@ -482,30 +991,57 @@ class BaseServerInterface(paramiko.ServerInterface):
         * check_auth_publickey Check auth with a public key
     """
 
+    manager = None
+    username = None
+
+    def __init__(self):
+        self.sessions = set()  # the IDs of the channels counted by the manager
+
     def set_auths(self, auths, noauth=False):
         self.auths = auths
         self.noauth = noauth
 
     def check_channel_request(self, kind, chanid):
         if kind == 'session':
+            if self.manager is not None:
+                if not self.manager.open_session(self.username):
+                    return paramiko.OPEN_FAILED_RESOURCE_SHORTAGE
+                self.sessions.add(chanid)
             return paramiko.OPEN_SUCCEEDED
         return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def end_session(self, chanid):
+        """Give the session of a closed channel back to the manager."""
+        try:
+            self.sessions.remove(chanid)
+        except KeyError:
+            return
+        self.manager.close_session(self.username)
+
+    def end_sessions(self):
+        """Give back all sessions, the connection is closed."""
+        for chanid in list(self.sessions):
+            self.end_session(chanid)
+
+    def _authenticated(self, username):
+        self.username = username
+        return paramiko.AUTH_SUCCESSFUL
     
     def check_auth_none(self, username):
         """Check whether the user can proceed without authentication."""
         if self.noauth:
-            return paramiko.AUTH_SUCCESSFUL
+            return self._authenticated(username)
         for auth in self.auths:
             if auth["Username"] == username:
                 if auth.get("Password", False) is None:
-                    return paramiko.AUTH_SUCCESSFUL
+                    return self._authenticated(username)
         return paramiko.AUTH_FAILED
 
     def check_auth_publickey(self, username, key):
         """Check whether the given public key is valid for authentication."""
         # remove key comment
         if self.noauth:
-            return paramiko.AUTH_SUCCESSFUL
+            return self._authenticated(username)
         
         # key = " ".join(key.split()[:2])
         # key = paramiko.PKey.from_private_key(StringIO(key))
@@ -514,17 +1050,17 @@ class BaseServerInterface(paramiko.ServerInterface):
             if auth["Username"] == username:
                 auth_key = auth.get("PubKey", None)
                 if auth_key is not None and auth_key.split()[1] == key.get_base64():
-                    return paramiko.AUTH_SUCCESSFUL
+                    return self._authenticated(username)
         return paramiko.AUTH_FAILED
 
     def check_auth_password(self, username, password):
         """Check whether the given password is valid for authentication."""
         if self.noauth:
-            return paramiko.AUTH_SUCCESSFUL
+            return self._authenticated(username)
         for auth in self.auths:
             if auth["Username"] == username:
                 if auth.get("Password", None) == password:
-                    return paramiko.AUTH_SUCCESSFUL
+                    return self._authenticated(username)
         return paramiko.AUTH_FAILED
 
     def get_allowed_auths(self, username):
@@ -556,29 +1092,71 @@ if __name__ == "__main__":
     _hook = HookTool(configs.webhooks)
     
     parser = argparse.ArgumentParser()
-    parser.add_argument("-m", "--mongo-url", type=str, default=configs.mgdb_url, 
-                        help="set mongodb url")
+    parser.add_argument("-m", "--mongo-url", type=str, default=configs.meta_url, 
+                        help="set mongodb url, or the sqlite database path with the sqlite backend")
+    parser.add_argument("-b", "--backend", type=str, default=configs.meta_backend, choices=["mongodb", "sqlite"],
+                        help="set metadata backend")
     parser.add_argument("-H", "--host", type=str, default=configs.sftp_host,
                         help="set sftp host")
     parser.add_argument("-P", "--port", type=int, default=configs.sftp_port,
                         help="set sftp port")
+    parser.add_argument("-w", "--workers", type=int, default=configs.sftp_workers,
+                        help="set the number of worker processes")
+    parser.add_argument("-p", "--profile", type=str, default=configs.sftp_profile,
+                        help="set the transport profile of the sftp host and port")
     
     args = parser.parse_args()
     mgdb_url = args.mongo_url
     sftp_host = args.host
     sftp_port = args.port
-    
-    dsdriveapi = DSdriveApi(mgdb_url, _hook, token=configs.bot_token)
-    dsfs = FSFactory(dsdrive_api=dsdriveapi)  # can be replaced with whatever FS class
-    server = BaseSFTPServer((sftp_host, sftp_port), fs=dsfs, host_key=configs.sftp_host_key, auths=configs.sftp_auths, noauth=configs.sftp_noauth)
-    try:
-        #import rpdb2; rpdb2.start_embedded_debugger('password')
-        print("Serving SFTP on %s:%d" % (sftp_host, sftp_port))
-        server.serve_forever()
-    except (SystemExit, KeyboardInterrupt):
-        server.server_close()
-    except:
-        print("Caught unexpected exception, shutting down.")
-        print(traceback.format_exc())
-        server.server_close()
-
+    workers = args.workers
+    profiles = make_profiles(configs.transport_profiles)
+    listeners = [(sftp_host, sftp_port, args.profile)] + [(l["host"], l["port"], l["profile"]) for l in configs.sftp_listeners]
+    for _, _, profile in listeners:
+        if profile not in profiles:
+            parser.error("unknown transport profile %s, the profiles are %s" % (profile, ", ".join(profiles)))
+    if workers > 1 and not PreforkSupervisor.supported():
+        print("Worker processes need fork and SO_REUSEPORT, serving from this process only.")
+        workers = 1
+
+    def make_server(index=0):
+        # called in each worker, after the fork: clients and threads can't be shared between processes
+        limiter = RateLimiter.shared(configs.bot_token)
+        limiter.rate, limiter.burst = configs.rate_limit, configs.rate_burst
+        if configs.rate_lease:
+            limiter.use_lease(MongoRateLease(configs.mgdb_url, configs.bot_token))
+        else:
+            limiter.rate /= workers
+        refresh = configs.refresh_options
+        if refresh is not None:
+            refresh = dict(refresh, pinned=index == 0)  # one worker is enough for the pinned files
+        dsdriveapi = DSdriveApi(mgdb_url, _hook, url_expire_policy=EXPIRE_POLICIES[configs.refresh_policy], token=configs.bot_token, backend=args.backend, cache=configs.meta_cache, max_staleness=configs.meta_max_staleness, refresh=refresh)
+        dsfs = FSFactory(dsdrive_api=dsdriveapi)  # can be replaced with whatever FS class
+        servers = []
+        for host, port, profile in listeners:
+            # the listeners share the connection limits of the first one
+            manager = servers[0].manager if servers else None
+            servers.append(BaseSFTPServer((host, port), fs=dsfs, host_key=configs.sftp_host_key, auths=configs.sftp_auths, noauth=configs.sftp_noauth, recursive_rmdir=configs.sftp_recursive_rmdir, limits=configs.sftp_limits, reuse_port=workers > 1, profile=profiles[profile], manager=manager))
+        return servers[0] if len(servers) == 1 else SFTPListeners(servers)
+
+    addresses = ", ".join("%s:%d (%s)" % listener for listener in listeners)
+
+    if workers > 1:
+        supervisor = PreforkSupervisor(make_server, workers)
+        print("Serving SFTP on %s with %d workers" % (addresses, workers))
+        try:
+            supervisor.serve_forever()
+        except (SystemExit, KeyboardInterrupt):
+            pass
+    else:
+        server = make_server()
+        try:
+            #import rpdb2; rpdb2.start_embedded_debugger('password')
+            print("Serving SFTP on %s" % addresses)
+            server.serve_forever()
+        except (SystemExit, KeyboardInterrupt):
+            server.server_close()
+        except:
+            print("Caught unexpected exception, shutting down.")
+            print(traceback.format_exc())
+            server.server_close()
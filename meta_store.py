@@ -0,0 +1,1487 @@
+import bisect
+import itertools
+import json
+import random
+import re
+import sqlite3
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Optional, Iterable
+
+import pymongo
+import pymongo.errors
+from pymongo import MongoClient
+from bson import ObjectId
+
+
+_BATCH_SIZE = 1000  # ids per "$in" query, documents per bulk operation
+_RESOLVE_FANOUT = 1000  # nodes a single round trip path lookup may gather before it goes level by level
+_QUERY_FIELDS = {"name": "name", "size": "details.size", "modified": "details.modified"}  # what query_files sorts by
+_SQLITE_BATCH_SIZE = 500  # ids per "IN" query, below the bound variable limit of old SQLite builds
+
+
+def _batches(items: list, size: int):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def migrate_manifests(db, batch_size: int=_BATCH_SIZE):
+    """
+    Move the chunk manifests embedded in ``tree`` documents into the ``chunks`` collection
+
+    Files written before manifests had their own collection keep their chunks in
+    the ``urls`` and ``chunk_sizes`` arrays of their ``tree`` document. This moves
+    them out, one document per chunk, and unsets the arrays. It is idempotent and
+    can be interrupted and run again.
+
+    Args:
+        db (pymongo.database.Database): The database object
+        batch_size (int): The number of chunk documents written per bulk operation
+
+    Returns:
+        count (int): The number of files migrated
+    """
+    count = 0
+    legacy = db["tree"].find({"urls": {"$exists": True}}, {"urls": 1, "chunk_sizes": 1})
+    for fn in legacy:
+        ops = [
+            pymongo.ReplaceOne(
+                {"file_id": fn["_id"], "ordinal": ordinal},
+                {"file_id": fn["_id"], "ordinal": ordinal, "url": url, "size": size},
+                upsert=True,
+            )
+            for ordinal, (url, size) in enumerate(zip(fn["urls"], fn["chunk_sizes"]))
+        ]
+        for i in range(0, len(ops), batch_size):
+            db["chunks"].bulk_write(ops[i:i + batch_size], ordered=False)
+        db["tree"].update_one({"_id": fn["_id"]}, {"$unset": {"urls": "", "chunk_sizes": ""}})
+        count += 1
+    db["migrations"].update_one({"_id": "chunk_manifests"}, {"$set": {"done": time.time()}}, upsert=True)
+    return count
+
+
+def make_meta_store(backend: str, url: str):
+    """
+    Create a metadata store
+
+    Args:
+        backend (str): The name of the backend, "mongodb", "sqlite" or "memory"
+        url (str): The URL of the MongoDB database, or the path of the SQLite database, unused by the memory backend
+
+    Returns:
+        store (BaseMetaStore): The metadata store, not set up yet
+    """
+    if backend == "mongodb":
+        return MongoMetaStore(url)
+    if backend == "sqlite":
+        return SqliteMetaStore(url)
+    if backend == "memory":
+        return MemoryMetaStore()
+    raise ValueError(f"Unknown metadata backend: {backend}")
+
+
+class BaseMetaStore:
+    """
+    Where the metadata of DSdrive lives: the tree of files and folders, and the chunk manifests
+
+    Nodes are dicts shaped like the MongoDB documents, with "_id", "name", "parent",
+    "type", "access", "details" and, for folders, "usage". Nested fields are addressed
+    with dotted keys, as in "details.modified". The ``fields`` argument of the lookups
+    lists the fields the caller needs, a store may return more.
+
+    Files sent since their digests are recorded also have "hashes", the hex digests
+    of their plaintext by algorithm and the "chunk_size" it was cut in.
+
+    Chunks are dicts with "file_id", "ordinal", "url" (a DSUrl save format) and "size",
+    and "md5" and "sha1", the hex digests of their plaintext, when recorded.
+
+    Methods:
+        setup: Connect and create the schema
+        new_id: Generate the ID of a node that is not inserted yet
+        is_migrated: Whether a migration has run
+        set_migrated: Mark a migration as done
+        clear: Remove every node but the root, and every chunk
+        get: Get a node by ID
+        get_child: Get a child of a folder by name
+        resolve: Follow a path down from a folder
+        has_children: Whether a folder has children
+        iter_children: Iterate over the children of a folder, sorted by name
+        find_children: Iterate over the children of many folders, in no particular order
+        iter_subtree: Iterate over all the descendants of a folder, breadth first
+        insert: Insert a node
+        insert_many: Insert many nodes
+        update: Set fields of a node
+        inc_usage: Add to the usage of many folders
+        set_usage: Set the usage of many folders
+        delete: Delete many nodes
+        sum_files: Sum the size and count of the files directly under many folders
+        write_chunks: Replace the chunk manifest of a file
+        iter_chunks: Iterate over the chunk manifest of a file
+        update_chunk_urls: Store renewed URLs in the chunk manifest of a file
+        copy_chunks: Copy the chunk manifests of many files
+        delete_chunks: Delete the chunk manifests of many files
+        invalidate: Drop what is cached about a node
+        watch: Follow the changes made to the tree by every client of the database
+        query_files: Find files by size, modification time and name
+        iter_pinned: Iterate over the pinned files whose URLs expire soon
+        parse_id: Read back an ID converted to a string
+    """
+
+    def setup(self):
+        pass
+
+    def new_id(self):
+        raise NotImplementedError()
+
+    def is_migrated(self, name: str) -> bool:
+        raise NotImplementedError()
+
+    def set_migrated(self, name: str):
+        raise NotImplementedError()
+
+    def clear(self, root_id):
+        raise NotImplementedError()
+
+    def get(self, node_id, fields: Optional[dict]=None):
+        raise NotImplementedError()
+
+    def get_child(self, parent_id, name: str, fields: Optional[dict]=None):
+        raise NotImplementedError()
+
+    def resolve(self, root_id, names: list, fields: Optional[dict]=None) -> list:
+        """
+        Follow a path down from a folder
+
+        One get_child per name, stores that can do it in a single round trip override it.
+
+        Args:
+            root_id: The ID of the folder the path starts from
+            names (list): The names along the path
+            fields (Optional[dict]): The fields to return
+
+        Returns:
+            list: The nodes along the path, in order, it ends early at the first name not found
+        """
+        nodes = []
+        parent_id = root_id
+        for name in names:
+            node = self.get_child(parent_id, name, fields)
+            if node is None:
+                break
+            nodes.append(node)
+            parent_id = node["_id"]
+        return nodes
+
+    def has_children(self, parent_id) -> bool:
+        raise NotImplementedError()
+
+    def iter_children(self, parent_id, start_after: Optional[str]=None, limit: Optional[int]=None, fields: Optional[dict]=None):
+        raise NotImplementedError()
+
+    def find_children(self, parent_ids: list, fields: Optional[dict]=None, folders_only: bool=False, file_pattern: Optional[str]=None):
+        raise NotImplementedError()
+
+    def iter_subtree(self, root_id, fields: Optional[dict]=None, folders_only: bool=False, file_pattern: Optional[str]=None, max_depth: Optional[int]=None):
+        """
+        Iterate over all the descendants of a folder, breadth first
+
+        Each level of the tree is fetched with find_children, so the number of round
+        trips grows with the depth of the tree rather than with the number of nodes.
+
+        Args:
+            root_id: The ID of the folder
+            fields (Optional[dict]): The fields to return, "_id", "type" and "parent" are always returned
+            folders_only (bool): Whether to skip files
+            file_pattern (Optional[str]): A regular expression, only the files whose whole name matches it are returned
+            max_depth (Optional[int]): How many levels to go down, 1 only returns the children of the folder
+
+        Yields:
+            dict: The descendants, level by level
+        """
+        if fields is not None:
+            fields = {**fields, "type": 1, "parent": 1}
+        frontier = [root_id]
+        depth = 0
+        while frontier and (max_depth is None or depth < max_depth):
+            next_frontier = []
+            for node in self.find_children(frontier, fields, folders_only, file_pattern):
+                if node["type"] == "folder":
+                    next_frontier.append(node["_id"])
+                yield node
+            frontier = next_frontier
+            depth += 1
+
+    def insert(self, doc: dict):
+        raise NotImplementedError()
+
+    def insert_many(self, docs: list):
+        raise NotImplementedError()
+
+    def update(self, node_id, values: dict):
+        raise NotImplementedError()
+
+    def inc_usage(self, node_ids: list, size: int, files: int):
+        raise NotImplementedError()
+
+    def set_usage(self, usages: Iterable):
+        raise NotImplementedError()
+
+    def delete(self, node_ids: list):
+        raise NotImplementedError()
+
+    def sum_files(self, parent_ids: list):
+        raise NotImplementedError()
+
+    def write_chunks(self, file_id, chunks: list):
+        raise NotImplementedError()
+
+    def iter_chunks(self, file_id, start: int=0, stop: Optional[int]=None):
+        raise NotImplementedError()
+
+    def update_chunk_urls(self, file_id, urls: list):
+        """
+        Store renewed URLs in the chunk manifest of a file
+
+        A URL only replaces the stored one if it points to the same attachment and
+        expires later, so a renewal racing with a rewrite of the file or with another
+        renewal never goes backwards.
+
+        Args:
+            file_id: The ID of the file
+            urls (list): (ordinal, DSUrl save format) tuples
+        """
+        raise NotImplementedError()
+
+    def copy_chunks(self, pairs: list):
+        raise NotImplementedError()
+
+    def delete_chunks(self, file_ids: list):
+        raise NotImplementedError()
+
+    def invalidate(self, node_id):
+        """Drop what is cached about a node, stores without a cache have nothing to do"""
+        pass
+
+    def query_files(
+        self,
+        parent_ids: Optional[list]=None,
+        min_size: Optional[int]=None,
+        max_size: Optional[int]=None,
+        modified_after: Optional[float]=None,
+        modified_before: Optional[float]=None,
+        name_prefix: Optional[str]=None,
+        sort: str="name",
+        descending: bool=False,
+        after: Optional[tuple]=None,
+        limit: int=100,
+    ):
+        """
+        Find files by size, modification time and name, all bounds are inclusive
+
+        Args:
+            parent_ids (Optional[list]): Only find the files in these folders, or anywhere if None
+            min_size (Optional[int]): The smallest size
+            max_size (Optional[int]): The largest size
+            modified_after (Optional[float]): The earliest modification time
+            modified_before (Optional[float]): The latest modification time
+            name_prefix (Optional[str]): What the names start with
+            sort (str): The field to sort by, "name", "size" or "modified"
+            descending (bool): Whether to sort in descending order
+            after (Optional[tuple]): The (sort value, ID) of the last file of the previous page
+            limit (int): The maximum number of files
+
+        Returns:
+            Iterator: The documents of the files, sorted by the sort field then by ID
+        """
+        raise NotImplementedError()
+
+    def iter_pinned(self, expire_before: float, fields: Optional[dict]=None, limit: Optional[int]=None):
+        """
+        Iterate over the pinned files whose earliest URL expires before a time
+
+        Files carry "pinned" when they should be kept readable without waiting on URL
+        renewal, and "url_expire", the earliest expire timestamp of their chunks.
+
+        Args:
+            expire_before (float): The time, as a UNIX timestamp
+            fields (Optional[dict]): The fields needed
+            limit (Optional[int]): The maximum number of files
+
+        Returns:
+            Iterator: The documents of the files, the earliest to expire first
+        """
+        raise NotImplementedError()
+
+    def parse_id(self, text: str):
+        return int(text)
+
+    def watch(self):
+        """
+        Follow the changes made to the tree by every client of the database
+
+        The changes are followed from the moment this is called, and a change of the
+        chunk manifest of a file always comes with a change of the file node. Renewed
+        URLs are the exception, they are not reported, and whoever finds an expired URL
+        invalidates the manifest and reads it again before renewing it.
+
+        Returns:
+            Iterator: The IDs of the changed nodes, None when anything may have changed
+
+        Raises:
+            NotImplementedError: If the store can't tell about changes
+        """
+        raise NotImplementedError()
+
+
+class MongoMetaStore(BaseMetaStore):
+    """
+    Metadata stored in MongoDB, in the ``tree``, ``chunks`` and ``migrations`` collections
+
+    Attributes:
+        db (pymongo.database.Database): The database object
+    """
+
+    def __init__(self, url: str):
+        """
+        Args:
+            url (str): The URL of the MongoDB database
+        """
+        self.db = MongoClient(url)["dsdrive"]
+
+    def setup(self):
+        self._create_indexes()
+        if not self.is_migrated("chunk_manifests"):
+            migrate_manifests(self.db)
+
+    def _create_indexes(self):
+        self.db["tree"].create_index([("parent", pymongo.ASCENDING), ("name", pymongo.ASCENDING)])
+        # for query_files, equality on the type first, then the sorted or ranged field
+        for field in _QUERY_FIELDS.values():
+            self.db["tree"].create_index([("type", pymongo.ASCENDING), (field, pymongo.ASCENDING), ("_id", pymongo.ASCENDING)])
+        self.db["tree"].create_index([("pinned", pymongo.ASCENDING), ("url_expire", pymongo.ASCENDING)], sparse=True)
+        self.db["chunks"].create_index([("file_id", pymongo.ASCENDING), ("ordinal", pymongo.ASCENDING)], unique=True)
+
+    def new_id(self):
+        return ObjectId()
+
+    def is_migrated(self, name: str) -> bool:
+        return self.db["migrations"].find_one({"_id": name}) is not None
+
+    def set_migrated(self, name: str):
+        self.db["migrations"].update_one({"_id": name}, {"$set": {"done": time.time()}}, upsert=True)
+
+    def clear(self, root_id):
+        root = self.db["tree"].find_one({"_id": root_id})
+        self.db["tree"].drop()
+        self.db["chunks"].drop()
+        root["usage"] = {"size": 0, "files": 0}
+        self.db["tree"].insert_one(root)
+        self._create_indexes()
+
+    def get(self, node_id, fields: Optional[dict]=None):
+        return self.db["tree"].find_one({"_id": node_id}, fields)
+
+    def get_child(self, parent_id, name: str, fields: Optional[dict]=None):
+        return self.db["tree"].find_one({"name": name, "parent": parent_id}, fields)
+
+    def resolve(self, root_id, names: list, fields: Optional[dict]=None) -> list:
+        if len(names) < 2:
+            return super().resolve(root_id, names, fields)
+        # one round trip: every node named like a step of the path, reachable through such nodes, then the chain is picked.
+        # That's every folder of the path's names below the ones before, so names repeated all over the tree, like
+        # /a/a/a, can gather far more nodes than the path has; past _RESOLVE_FANOUT it's done one level at a time
+        projection = {"nodes": 1}
+        if fields is not None:
+            # the chain is picked through _id, parent and name, the rest of each node is only carried for the caller
+            projection = {f"nodes.{field}": 1 for field, keep in fields.items() if keep}
+            projection.update({"nodes._id": 1, "nodes.parent": 1, "nodes.name": 1})
+        try:
+            found = next(self.db["tree"].aggregate([
+                {"$match": {"_id": root_id}},
+                {"$graphLookup": {
+                    "from": "tree",
+                    "startWith": "$_id",
+                    "connectFromField": "_id",
+                    "connectToField": "parent",
+                    "as": "nodes",
+                    "maxDepth": len(names) - 1,
+                    "restrictSearchWithMatch": {"name": {"$in": list(set(names))}},
+                }},
+                {"$project": projection},
+                {"$project": {"nodes": {"$slice": ["$nodes", _RESOLVE_FANOUT + 1]}}},
+            ]), None)
+        except pymongo.errors.OperationFailure:
+            # the gathered nodes outgrew the memory or document size limits of the server
+            return super().resolve(root_id, names, fields)
+        if found is None:
+            return []
+        if len(found["nodes"]) > _RESOLVE_FANOUT:
+            return super().resolve(root_id, names, fields)
+        by_step = {(node["parent"], node["name"]): node for node in found["nodes"]}
+        nodes = []
+        parent_id = root_id
+        for name in names:
+            node = by_step.get((parent_id, name))
+            if node is None:
+                break
+            nodes.append(node)
+            parent_id = node["_id"]
+        return nodes
+
+    def has_children(self, parent_id) -> bool:
+        return self.db["tree"].find_one({"parent": parent_id}, {"_id": 1}) is not None
+
+    def iter_children(self, parent_id, start_after: Optional[str]=None, limit: Optional[int]=None, fields: Optional[dict]=None):
+        query = {"parent": parent_id}
+        if start_after is not None:
+            query["name"] = {"$gt": start_after}
+        cursor = self.db["tree"].find(query, fields).sort("name", pymongo.ASCENDING)
+        if limit is not None:
+            cursor = cursor.limit(limit)
+        yield from cursor
+
+    def find_children(self, parent_ids: list, fields: Optional[dict]=None, folders_only: bool=False, file_pattern: Optional[str]=None):
+        for batch in _batches(parent_ids, _BATCH_SIZE):
+            query = {"parent": {"$in": batch}}
+            if folders_only:
+                query["type"] = "folder"
+            elif file_pattern is not None:
+                query["$or"] = [{"type": "folder"}, {"name": {"$regex": f"^(?:{file_pattern})$"}}]
+            yield from self.db["tree"].find(query, fields)
+
+    def insert(self, doc: dict):
+        return self.db["tree"].insert_one(doc).inserted_id
+
+    def insert_many(self, docs: list):
+        for batch in _batches(docs, _BATCH_SIZE):
+            self.db["tree"].insert_many(batch)
+
+    def update(self, node_id, values: dict):
+        self.db["tree"].update_one({"_id": node_id}, {"$set": values})
+
+    def inc_usage(self, node_ids: list, size: int, files: int):
+        self.db["tree"].update_many(
+            {"_id": {"$in": node_ids}},
+            {"$inc": {"usage.size": size, "usage.files": files}},
+        )
+
+    def set_usage(self, usages: Iterable):
+        ops = [
+            pymongo.UpdateOne({"_id": i}, {"$set": {"usage": {"size": size, "files": files}}})
+            for i, size, files in usages
+        ]
+        for batch in _batches(ops, _BATCH_SIZE):
+            self.db["tree"].bulk_write(batch, ordered=False)
+
+    def delete(self, node_ids: list):
+        for batch in _batches(node_ids, _BATCH_SIZE):
+            self.db["tree"].delete_many({"_id": {"$in": batch}})
+
+    def sum_files(self, parent_ids: list):
+        for batch in _batches(parent_ids, _BATCH_SIZE):
+            pipeline = [
+                {"$match": {"type": "file", "parent": {"$in": batch}}},
+                {"$group": {"_id": "$parent", "size": {"$sum": "$details.size"}, "files": {"$sum": 1}}},
+            ]
+            for direct in self.db["tree"].aggregate(pipeline):
+                yield direct["_id"], direct["size"], direct["files"]
+
+    def write_chunks(self, file_id, chunks: list):
+        ops = [
+            pymongo.ReplaceOne(
+                {"file_id": file_id, "ordinal": ordinal},
+                {"file_id": file_id, "ordinal": ordinal, **c},
+                upsert=True,
+            )
+            for ordinal, c in enumerate(chunks)
+        ]
+        for batch in _batches(ops, _BATCH_SIZE):
+            self.db["chunks"].bulk_write(batch, ordered=False)
+        # drop the tail left over from a longer previous version
+        self.db["chunks"].delete_many({"file_id": file_id, "ordinal": {"$gte": len(chunks)}})
+
+    def iter_chunks(self, file_id, start: int=0, stop: Optional[int]=None):
+        ordinal = {"$gte": start}
+        if stop is not None:
+            ordinal["$lt"] = stop
+        yield from self.db["chunks"].find(
+            {"file_id": file_id, "ordinal": ordinal}, {"_id": 0}
+        ).sort("ordinal", pymongo.ASCENDING)
+
+    def update_chunk_urls(self, file_id, urls: list):
+        ops = [
+            pymongo.UpdateOne(
+                {"file_id": file_id, "ordinal": ordinal, "url.2": url[2], "url.4": {"$lt": url[4]}},
+                {"$set": {"url": url}},
+            )
+            for ordinal, url in urls
+        ]
+        for batch in _batches(ops, _BATCH_SIZE):
+            self.db["chunks"].bulk_write(batch, ordered=False)
+
+    def copy_chunks(self, pairs: list):
+        batch = []
+        for pair_batch in _batches(pairs, _BATCH_SIZE):
+            dst_ids = dict(pair_batch)
+            for c in self.db["chunks"].find({"file_id": {"$in": list(dst_ids)}}, {"_id": 0}):
+                c["file_id"] = dst_ids[c["file_id"]]
+                batch.append(c)
+                if len(batch) >= _BATCH_SIZE:
+                    self.db["chunks"].insert_many(batch)
+                    batch = []
+        if batch:
+            self.db["chunks"].insert_many(batch)
+
+    def delete_chunks(self, file_ids: list):
+        for batch in _batches(file_ids, _BATCH_SIZE):
+            self.db["chunks"].delete_many({"file_id": {"$in": batch}})
+
+    def query_files(
+        self,
+        parent_ids: Optional[list]=None,
+        min_size: Optional[int]=None,
+        max_size: Optional[int]=None,
+        modified_after: Optional[float]=None,
+        modified_before: Optional[float]=None,
+        name_prefix: Optional[str]=None,
+        sort: str="name",
+        descending: bool=False,
+        after: Optional[tuple]=None,
+        limit: int=100,
+    ):
+        query = {"type": "file"}
+        if parent_ids is not None:
+            query["parent"] = {"$in": parent_ids}
+        for field, low, high in (("details.size", min_size, max_size), ("details.modified", modified_after, modified_before)):
+            bounds = {}
+            if low is not None:
+                bounds["$gte"] = low
+            if high is not None:
+                bounds["$lte"] = high
+            if bounds:
+                query[field] = bounds
+        if name_prefix:
+            # an anchored prefix regex is answered from the index
+            query["name"] = {"$regex": "^" + re.escape(name_prefix)}
+        key = _QUERY_FIELDS[sort]
+        if after is not None:
+            op = "$lt" if descending else "$gt"
+            query = {"$and": [query, {"$or": [{key: {op: after[0]}}, {key: after[0], "_id": {op: after[1]}}]}]}
+        direction = pymongo.DESCENDING if descending else pymongo.ASCENDING
+        yield from self.db["tree"].find(query).sort([(key, direction), ("_id", direction)]).limit(limit)
+
+    def iter_pinned(self, expire_before: float, fields: Optional[dict]=None, limit: Optional[int]=None):
+        cursor = self.db["tree"].find({"pinned": True, "url_expire": {"$lt": expire_before}}, fields)
+        yield from cursor.sort("url_expire", pymongo.ASCENDING).limit(limit or 0)
+
+    def parse_id(self, text: str):
+        return ObjectId(text)
+
+    def watch(self):
+        # change streams need a replica set, a standalone server refuses to open one
+        try:
+            stream = self.db["tree"].watch()
+        except pymongo.errors.OperationFailure as e:
+            if e.code in (40573, 40324):  # not a replica set, unknown stage
+                raise NotImplementedError(f"The MongoDB server doesn't support change streams: {e}")
+            raise
+        return self._iter_changes(stream)
+
+    @staticmethod
+    def _iter_changes(stream):
+        with stream:
+            for change in stream:
+                if "documentKey" in change:
+                    yield change["documentKey"]["_id"]
+                else:
+                    yield None  # drop, rename or invalidate
+                    if change["operationType"] == "invalidate":
+                        return
+
+
+_SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tree (
+    id INTEGER PRIMARY KEY,
+    parent INTEGER,
+    name TEXT NOT NULL,
+    type TEXT NOT NULL,
+    usage_size INTEGER NOT NULL DEFAULT 0,
+    usage_files INTEGER NOT NULL DEFAULT 0,
+    data TEXT NOT NULL,
+    size INTEGER GENERATED ALWAYS AS (json_extract(data, '$.details.size')) VIRTUAL,
+    modified REAL GENERATED ALWAYS AS (json_extract(data, '$.details.modified')) VIRTUAL
+);
+CREATE INDEX IF NOT EXISTS tree_parent_name ON tree (parent, name);
+CREATE INDEX IF NOT EXISTS tree_type_name ON tree (type, name);
+CREATE INDEX IF NOT EXISTS tree_type_size ON tree (type, size);
+CREATE INDEX IF NOT EXISTS tree_type_modified ON tree (type, modified);
+CREATE TABLE IF NOT EXISTS chunks (
+    file_id INTEGER NOT NULL,
+    ordinal INTEGER NOT NULL,
+    channel_id INTEGER,
+    message_id INTEGER,
+    attachment_id INTEGER,
+    filename BLOB,
+    expire INTEGER,
+    issue INTEGER,
+    signature BLOB,
+    size INTEGER NOT NULL,
+    PRIMARY KEY (file_id, ordinal)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS migrations (
+    name TEXT PRIMARY KEY,
+    done REAL NOT NULL
+);
+"""
+
+# columns added to the tables after their first version, ALTER TABLE adds them to older databases
+_SQLITE_ADDED_COLUMNS = {
+    "tree": {
+        "pinned": "pinned INTEGER GENERATED ALWAYS AS (json_extract(data, '$.pinned')) VIRTUAL",
+        "url_expire": "url_expire INTEGER GENERATED ALWAYS AS (json_extract(data, '$.url_expire')) VIRTUAL",
+    },
+    "chunks": {
+        "md5": "md5 TEXT",
+        "sha1": "sha1 TEXT",
+    },
+}
+_SQLITE_ADDED_INDEXES = """
+CREATE INDEX IF NOT EXISTS tree_pinned_url_expire ON tree (pinned, url_expire);
+"""
+
+_TREE_COLUMNS = "id, parent, name, type, usage_size, usage_files, data"
+_QUERY_COLUMNS = {"name": "name", "size": "size", "modified": "modified"}
+_CHUNK_COLUMNS = "file_id, ordinal, channel_id, message_id, attachment_id, filename, expire, issue, signature, size, md5, sha1"
+_NODE_KEYS = {"_id", "parent", "name", "type", "usage"}  # the fields kept in their own columns
+
+
+class SqliteMetaStore(BaseMetaStore):
+    """
+    Metadata stored in an SQLite database file, for single node deployments without a MongoDB server
+
+    The database runs in WAL mode, so readers never wait for the writer, and each
+    thread gets its own connection. Statements are constant strings, so sqlite3
+    keeps them prepared in its per-connection statement cache. Subtrees are walked
+    with a recursive CTE in a single query.
+
+    Node IDs are random 63 bit integers, so they can be handed out before the node
+    is inserted, like ObjectIds.
+
+    Attributes:
+        path (str): The path of the database file
+    """
+
+    def __init__(self, path: str):
+        """
+        Args:
+            path (str): The path of the database file
+        """
+        self.path = path
+        self._local = threading.local()
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False, cached_statements=256)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=10000")
+            conn.create_function("regexp", 2, self._regexp, deterministic=True)
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _regexp(pattern, string):
+        return re.fullmatch(pattern, string) is not None
+
+    @contextmanager
+    def _transaction(self):
+        conn = self.conn
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def setup(self):
+        conn = self.conn
+        conn.executescript(_SQLITE_SCHEMA)
+        for table, added in _SQLITE_ADDED_COLUMNS.items():
+            columns = {row[1] for row in conn.execute(f"PRAGMA table_xinfo({table})")}
+            for name, definition in added.items():
+                if name not in columns:
+                    conn.execute(f"ALTER TABLE {table} ADD COLUMN {definition}")
+        conn.executescript(_SQLITE_ADDED_INDEXES)
+
+    def new_id(self):
+        return random.getrandbits(63)
+
+    def is_migrated(self, name: str) -> bool:
+        return self.conn.execute("SELECT 1 FROM migrations WHERE name = ?", (name,)).fetchone() is not None
+
+    def set_migrated(self, name: str):
+        self.conn.execute("INSERT OR REPLACE INTO migrations (name, done) VALUES (?, ?)", (name, time.time()))
+
+    def clear(self, root_id):
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM tree WHERE id != ?", (root_id,))
+            conn.execute("DELETE FROM chunks")
+            conn.execute("UPDATE tree SET usage_size = 0, usage_files = 0 WHERE id = ?", (root_id,))
+
+    @staticmethod
+    def _to_doc(row, fields: Optional[dict]=None):
+        if row is None:
+            return None
+        doc = {"_id": row[0], "parent": row[1], "name": row[2], "type": row[3]}
+        if row[3] == "folder":
+            doc["usage"] = {"size": row[4], "files": row[5]}
+        # skip decoding the JSON when the caller only needs the columns
+        if fields is None or any(k.split(".")[0] not in _NODE_KEYS for k in fields):
+            doc.update(json.loads(row[6]))
+        return doc
+
+    @staticmethod
+    def _to_row(doc: dict):
+        usage = doc.get("usage", {})
+        data = {k: v for k, v in doc.items() if k not in _NODE_KEYS}
+        return (doc["_id"], doc["parent"], doc["name"], doc["type"], usage.get("size", 0), usage.get("files", 0), json.dumps(data))
+
+    def get(self, node_id, fields: Optional[dict]=None):
+        row = self.conn.execute(f"SELECT {_TREE_COLUMNS} FROM tree WHERE id = ?", (node_id,)).fetchone()
+        return self._to_doc(row, fields)
+
+    def get_child(self, parent_id, name: str, fields: Optional[dict]=None):
+        row = self.conn.execute(f"SELECT {_TREE_COLUMNS} FROM tree WHERE parent IS ? AND name = ?", (parent_id, name)).fetchone()
+        return self._to_doc(row, fields)
+
+    def resolve(self, root_id, names: list, fields: Optional[dict]=None) -> list:
+        if not names:
+            return []
+        # the names go in as a JSON array, each step of the recursion matches the next one
+        path = json.dumps(names)
+        rows = self.conn.execute(
+            f"""
+            WITH RECURSIVE walk({_TREE_COLUMNS}, depth) AS (
+                SELECT {_TREE_COLUMNS}, 0 FROM tree t WHERE t.parent IS ? AND t.name = json_extract(?, '$[0]')
+                UNION ALL
+                SELECT t.id, t.parent, t.name, t.type, t.usage_size, t.usage_files, t.data, walk.depth + 1
+                FROM walk JOIN tree t ON t.parent = walk.id AND t.name = json_extract(?, '$[' || (walk.depth + 1) || ']')
+            )
+            SELECT {_TREE_COLUMNS} FROM walk ORDER BY depth
+            """,
+            (root_id, path, path),
+        ).fetchall()
+        return [self._to_doc(row, fields) for row in rows]
+
+    def has_children(self, parent_id) -> bool:
+        return self.conn.execute("SELECT 1 FROM tree WHERE parent = ? LIMIT 1", (parent_id,)).fetchone() is not None
+
+    def iter_children(self, parent_id, start_after: Optional[str]=None, limit: Optional[int]=None, fields: Optional[dict]=None):
+        rows = self.conn.execute(
+            f"SELECT {_TREE_COLUMNS} FROM tree WHERE parent = ? AND name > ? ORDER BY name LIMIT ?",
+            (parent_id, "" if start_after is None else start_after, -1 if limit is None else limit),
+        ).fetchall()
+        for row in rows:
+            yield self._to_doc(row, fields)
+
+    @staticmethod
+    def _type_filter(folders_only: bool, file_pattern: Optional[str]):
+        """The condition on the type and name of the rows of tree t, and its parameters"""
+        if folders_only:
+            return " AND t.type = 'folder'", []
+        if file_pattern is not None:
+            return " AND (t.type = 'folder' OR t.name REGEXP ?)", [file_pattern]
+        return "", []
+
+    def find_children(self, parent_ids: list, fields: Optional[dict]=None, folders_only: bool=False, file_pattern: Optional[str]=None):
+        type_filter, params = self._type_filter(folders_only, file_pattern)
+        for batch in _batches(parent_ids, _SQLITE_BATCH_SIZE):
+            rows = self.conn.execute(
+                f"SELECT {_TREE_COLUMNS} FROM tree t WHERE t.parent IN ({','.join('?' * len(batch))}){type_filter}",
+                [*batch, *params],
+            ).fetchall()
+            for row in rows:
+                yield self._to_doc(row, fields)
+
+    def iter_subtree(self, root_id, fields: Optional[dict]=None, folders_only: bool=False, file_pattern: Optional[str]=None, max_depth: Optional[int]=None):
+        # without an ORDER BY, the recursive CTE runs as a FIFO queue, so rows come out breadth first
+        type_filter, params = self._type_filter(folders_only, file_pattern)
+        rows = self.conn.execute(
+            f"""
+            WITH RECURSIVE sub({_TREE_COLUMNS}, depth) AS (
+                SELECT {_TREE_COLUMNS}, 1 FROM tree t WHERE t.parent = ?{type_filter}
+                UNION ALL
+                SELECT t.id, t.parent, t.name, t.type, t.usage_size, t.usage_files, t.data, sub.depth + 1
+                FROM tree t JOIN sub ON t.parent = sub.id
+                WHERE sub.type = 'folder' AND sub.depth < ?{type_filter}
+            )
+            SELECT {_TREE_COLUMNS} FROM sub
+            """,
+            [root_id, *params, 1 << 30 if max_depth is None else max_depth, *params],
+        ).fetchall()
+        for row in rows:
+            yield self._to_doc(row, fields)
+
+    def query_files(
+        self,
+        parent_ids: Optional[list]=None,
+        min_size: Optional[int]=None,
+        max_size: Optional[int]=None,
+        modified_after: Optional[float]=None,
+        modified_before: Optional[float]=None,
+        name_prefix: Optional[str]=None,
+        sort: str="name",
+        descending: bool=False,
+        after: Optional[tuple]=None,
+        limit: int=100,
+    ):
+        where = ["type = 'file'"]
+        params = []
+        if parent_ids is not None:
+            where.append("parent IN (SELECT value FROM json_each(?))")
+            params.append(json.dumps(parent_ids))
+        for condition, value in (
+            ("size >= ?", min_size),
+            ("size <= ?", max_size),
+            ("modified >= ?", modified_after),
+            ("modified <= ?", modified_before),
+        ):
+            if value is not None:
+                where.append(condition)
+                params.append(value)
+        if name_prefix:
+            # a range rather than LIKE, so the index is used
+            where.append("name >= ? AND name < ?")
+            params.extend((name_prefix, name_prefix[:-1] + chr(ord(name_prefix[-1]) + 1)))
+        column = _QUERY_COLUMNS[sort]
+        direction = "DESC" if descending else "ASC"
+        if after is not None:
+            where.append(f"({column}, id) {'<' if descending else '>'} (?, ?)")
+            params.extend(after)
+        rows = self.conn.execute(
+            f"SELECT {_TREE_COLUMNS} FROM tree WHERE {' AND '.join(where)} ORDER BY {column} {direction}, id {direction} LIMIT ?",
+            [*params, limit],
+        ).fetchall()
+        for row in rows:
+            yield self._to_doc(row)
+
+    def iter_pinned(self, expire_before: float, fields: Optional[dict]=None, limit: Optional[int]=None):
+        rows = self.conn.execute(
+            f"SELECT {_TREE_COLUMNS} FROM tree WHERE pinned = 1 AND url_expire < ? ORDER BY url_expire LIMIT ?",
+            (expire_before, -1 if limit is None else limit),
+        ).fetchall()
+        for row in rows:
+            yield self._to_doc(row, fields)
+
+    def insert(self, doc: dict):
+        if "_id" not in doc:
+            doc["_id"] = self.new_id()
+        self.conn.execute(f"INSERT INTO tree ({_TREE_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?)", self._to_row(doc))
+        return doc["_id"]
+
+    def insert_many(self, docs: list):
+        with self._transaction() as conn:
+            conn.executemany(f"INSERT INTO tree ({_TREE_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?)", [self._to_row(d) for d in docs])
+
+    def update(self, node_id, values: dict):
+        columns, column_params = [], []
+        paths, path_params = [], []
+        for key, value in values.items():
+            if key in ("name", "parent", "type"):
+                columns.append(f"{key} = ?")
+                column_params.append(value)
+            elif key == "usage":
+                columns.append("usage_size = ?, usage_files = ?")
+                column_params.extend((value.get("size", 0), value.get("files", 0)))
+            elif key in ("usage.size", "usage.files"):
+                columns.append(f"usage_{key[len('usage.'):]} = ?")
+                column_params.append(value)
+            else:
+                paths.append(f"'$.{key}', json(?)")
+                path_params.append(json.dumps(value))
+        if paths:
+            columns.append(f"data = json_set(data, {', '.join(paths)})")
+        if columns:
+            self.conn.execute(f"UPDATE tree SET {', '.join(columns)} WHERE id = ?", [*column_params, *path_params, node_id])
+
+    def inc_usage(self, node_ids: list, size: int, files: int):
+        with self._transaction() as conn:
+            for batch in _batches(node_ids, _SQLITE_BATCH_SIZE):
+                conn.execute(
+                    f"UPDATE tree SET usage_size = usage_size + ?, usage_files = usage_files + ? WHERE id IN ({','.join('?' * len(batch))})",
+                    [size, files, *batch],
+                )
+
+    def set_usage(self, usages: Iterable):
+        with self._transaction() as conn:
+            conn.executemany(
+                "UPDATE tree SET usage_size = ?, usage_files = ? WHERE id = ?",
+                [(size, files, i) for i, size, files in usages],
+            )
+
+    def delete(self, node_ids: list):
+        with self._transaction() as conn:
+            for batch in _batches(node_ids, _SQLITE_BATCH_SIZE):
+                conn.execute(f"DELETE FROM tree WHERE id IN ({','.join('?' * len(batch))})", batch)
+
+    def sum_files(self, parent_ids: list):
+        for batch in _batches(parent_ids, _SQLITE_BATCH_SIZE):
+            rows = self.conn.execute(
+                f"SELECT parent, SUM(size), COUNT(*) FROM tree WHERE type = 'file' AND parent IN ({','.join('?' * len(batch))}) GROUP BY parent",
+                batch,
+            ).fetchall()
+            yield from rows
+
+    def write_chunks(self, file_id, chunks: list):
+        with self._transaction() as conn:
+            conn.executemany(
+                f"INSERT OR REPLACE INTO chunks ({_CHUNK_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [(file_id, ordinal, *c["url"], c["size"], c.get("md5"), c.get("sha1")) for ordinal, c in enumerate(chunks)],
+            )
+            # drop the tail left over from a longer previous version
+            conn.execute("DELETE FROM chunks WHERE file_id = ? AND ordinal >= ?", (file_id, len(chunks)))
+
+    def iter_chunks(self, file_id, start: int=0, stop: Optional[int]=None):
+        rows = self.conn.execute(
+            f"SELECT {_CHUNK_COLUMNS} FROM chunks WHERE file_id = ? AND ordinal >= ? AND ordinal < ? ORDER BY ordinal",
+            (file_id, start, (1 << 62) if stop is None else stop),
+        ).fetchall()
+        for row in rows:
+            yield {"file_id": row[0], "ordinal": row[1], "url": list(row[2:9]), "size": row[9], "md5": row[10], "sha1": row[11]}
+
+    def update_chunk_urls(self, file_id, urls: list):
+        with self._transaction() as conn:
+            conn.executemany(
+                "UPDATE chunks SET channel_id = ?, message_id = ?, attachment_id = ?, filename = ?, expire = ?, issue = ?, signature = ? "
+                "WHERE file_id = ? AND ordinal = ? AND attachment_id = ? AND expire < ?",
+                [(*url, file_id, ordinal, url[2], url[4]) for ordinal, url in urls],
+            )
+
+    def copy_chunks(self, pairs: list):
+        with self._transaction() as conn:
+            conn.executemany(
+                f"INSERT INTO chunks ({_CHUNK_COLUMNS}) SELECT ?, {_CHUNK_COLUMNS[9:]} FROM chunks WHERE file_id = ?",
+                [(dst_id, src_id) for src_id, dst_id in pairs],
+            )
+
+    def delete_chunks(self, file_ids: list):
+        with self._transaction() as conn:
+            for batch in _batches(file_ids, _SQLITE_BATCH_SIZE):
+                conn.execute(f"DELETE FROM chunks WHERE file_id IN ({','.join('?' * len(batch))})", batch)
+
+
+class MemoryMetaStore(BaseMetaStore):
+    """
+    Metadata kept in the memory of the process, for tests and benchmarks that should not need a database
+
+    Nodes live in a dict by ID, and each folder maps the names of its children to
+    their IDs, so looking up a child is a dict access. Nodes are copied on the way
+    in and out, so callers can't change the store by mutating what they got.
+    Everything is lost when the process exits.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._ids = itertools.count(1)
+        self.nodes = {}
+        self.children = {}  # folder ID -> {name: child ID}
+        self.chunks = {}  # file ID -> list of chunks, by ordinal
+        self.migrations = set()
+
+    @staticmethod
+    def _copy(doc: dict):
+        return {k: (dict(v) if isinstance(v, dict) else v) for k, v in doc.items()}
+
+    def new_id(self):
+        return next(self._ids)
+
+    def is_migrated(self, name: str) -> bool:
+        return name in self.migrations
+
+    def set_migrated(self, name: str):
+        self.migrations.add(name)
+
+    def clear(self, root_id):
+        with self._lock:
+            root = self.nodes[root_id]
+            root["usage"] = {"size": 0, "files": 0}
+            self.nodes = {root_id: root}
+            self.children = {root_id: {}}
+            self.chunks = {}
+
+    def get(self, node_id, fields: Optional[dict]=None):
+        doc = self.nodes.get(node_id)
+        return None if doc is None else self._copy(doc)
+
+    def get_child(self, parent_id, name: str, fields: Optional[dict]=None):
+        if parent_id is None:
+            # only the root has no parent
+            for doc in self.nodes.values():
+                if doc["parent"] is None and doc["name"] == name:
+                    return self._copy(doc)
+            return None
+        child_id = self.children.get(parent_id, {}).get(name)
+        return None if child_id is None else self._copy(self.nodes[child_id])
+
+    def has_children(self, parent_id) -> bool:
+        return bool(self.children.get(parent_id))
+
+    def iter_children(self, parent_id, start_after: Optional[str]=None, limit: Optional[int]=None, fields: Optional[dict]=None):
+        with self._lock:
+            children = self.children.get(parent_id, {})
+            names = sorted(children)
+            start = 0 if start_after is None else bisect.bisect_right(names, start_after)
+            stop = None if limit is None else start + limit
+            docs = [self._copy(self.nodes[children[name]]) for name in names[start:stop]]
+        yield from docs
+
+    def find_children(self, parent_ids: list, fields: Optional[dict]=None, folders_only: bool=False, file_pattern: Optional[str]=None):
+        match = None if file_pattern is None else re.compile(file_pattern).fullmatch
+        with self._lock:
+            docs = [
+                self._copy(node)
+                for parent_id in parent_ids
+                for node in map(self.nodes.__getitem__, self.children.get(parent_id, {}).values())
+                if node["type"] == "folder" or not (folders_only or (match and not match(node["name"])))
+            ]
+        yield from docs
+
+    def query_files(
+        self,
+        parent_ids: Optional[list]=None,
+        min_size: Optional[int]=None,
+        max_size: Optional[int]=None,
+        modified_after: Optional[float]=None,
+        modified_before: Optional[float]=None,
+        name_prefix: Optional[str]=None,
+        sort: str="name",
+        descending: bool=False,
+        after: Optional[tuple]=None,
+        limit: int=100,
+    ):
+        def sort_key(doc):
+            return (doc["name"] if sort == "name" else doc["details"][sort], doc["_id"])
+
+        parents = None if parent_ids is None else set(parent_ids)
+        with self._lock:
+            docs = [
+                doc for doc in self.nodes.values()
+                if doc["type"] == "file"
+                and (parents is None or doc["parent"] in parents)
+                and (min_size is None or doc["details"]["size"] >= min_size)
+                and (max_size is None or doc["details"]["size"] <= max_size)
+                and (modified_after is None or doc["details"]["modified"] >= modified_after)
+                and (modified_before is None or doc["details"]["modified"] <= modified_before)
+                and (not name_prefix or doc["name"].startswith(name_prefix))
+                and (after is None or (sort_key(doc) < tuple(after) if descending else sort_key(doc) > tuple(after)))
+            ]
+            docs.sort(key=sort_key, reverse=descending)
+            docs = [self._copy(doc) for doc in docs[:limit]]
+        yield from docs
+
+    def iter_pinned(self, expire_before: float, fields: Optional[dict]=None, limit: Optional[int]=None):
+        with self._lock:
+            docs = [
+                doc for doc in self.nodes.values()
+                if doc.get("pinned") and doc.get("url_expire") is not None and doc["url_expire"] < expire_before
+            ]
+            docs.sort(key=lambda doc: doc["url_expire"])
+            docs = [self._copy(doc) for doc in docs[:limit]]
+        yield from docs
+
+    def insert(self, doc: dict):
+        with self._lock:
+            if "_id" not in doc:
+                doc["_id"] = self.new_id()
+            self.nodes[doc["_id"]] = self._copy(doc)
+            if doc["parent"] is not None:
+                self.children.setdefault(doc["parent"], {})[doc["name"]] = doc["_id"]
+            if doc["type"] == "folder":
+                self.children.setdefault(doc["_id"], {})
+        return doc["_id"]
+
+    def insert_many(self, docs: list):
+        for doc in docs:
+            self.insert(doc)
+
+    def update(self, node_id, values: dict):
+        with self._lock:
+            doc = self.nodes[node_id]
+            if "name" in values or "parent" in values:
+                del self.children[doc["parent"]][doc["name"]]
+                self.children.setdefault(values.get("parent", doc["parent"]), {})[values.get("name", doc["name"])] = node_id
+            for key, value in values.items():
+                *path, last = key.split(".")
+                target = doc
+                for part in path:
+                    target = target.setdefault(part, {})
+                target[last] = dict(value) if isinstance(value, dict) else value
+
+    def inc_usage(self, node_ids: list, size: int, files: int):
+        with self._lock:
+            for node_id in node_ids:
+                usage = self.nodes[node_id].setdefault("usage", {"size": 0, "files": 0})
+                usage["size"] += size
+                usage["files"] += files
+
+    def set_usage(self, usages: Iterable):
+        with self._lock:
+            for node_id, size, files in usages:
+                self.nodes[node_id]["usage"] = {"size": size, "files": files}
+
+    def delete(self, node_ids: list):
+        with self._lock:
+            for node_id in node_ids:
+                doc = self.nodes.pop(node_id, None)
+                if doc is None:
+                    continue
+                siblings = self.children.get(doc["parent"], {})
+                if siblings.get(doc["name"]) == node_id:
+                    del siblings[doc["name"]]
+                self.children.pop(node_id, None)
+
+    def sum_files(self, parent_ids: list):
+        for parent_id in parent_ids:
+            files = [
+                self.nodes[i] for i in self.children.get(parent_id, {}).values()
+                if self.nodes[i]["type"] == "file"
+            ]
+            if files:
+                yield parent_id, sum(fn["details"]["size"] for fn in files), len(files)
+
+    def write_chunks(self, file_id, chunks: list):
+        self.chunks[file_id] = [
+            {"file_id": file_id, "ordinal": ordinal, **c} for ordinal, c in enumerate(chunks)
+        ]
+
+    def iter_chunks(self, file_id, start: int=0, stop: Optional[int]=None):
+        for c in self.chunks.get(file_id, [])[start:stop]:
+            yield dict(c)
+
+    def update_chunk_urls(self, file_id, urls: list):
+        with self._lock:
+            chunks = self.chunks.get(file_id, [])
+            for ordinal, url in urls:
+                if ordinal < len(chunks):
+                    stored = chunks[ordinal]["url"]
+                    if stored[2] == url[2] and stored[4] < url[4]:
+                        chunks[ordinal] = {**chunks[ordinal], "url": list(url)}
+
+    def copy_chunks(self, pairs: list):
+        with self._lock:
+            for src_id, dst_id in pairs:
+                self.chunks[dst_id] = [{**c, "file_id": dst_id} for c in self.chunks.get(src_id, [])]
+
+    def delete_chunks(self, file_ids: list):
+        with self._lock:
+            for file_id in file_ids:
+                self.chunks.pop(file_id, None)
+
+
+class CachedMetaStore(BaseMetaStore):
+    """
+    A cache of nodes, child lookups and chunk manifests in front of another store
+
+    Nodes are fetched with the fields asked for and kept with the names of those
+    fields, a cached node only answers a later lookup it has every field of. The
+    chunks of a file are only kept when all of them were read at once, a range is
+    read from the store.
+
+    Writes go through to the store and drop the entries they touch. To see the
+    writes of other processes sharing the database, the cache follows the changes
+    of the store (MongoDB change streams) and drops the entries of the nodes that
+    changed. When the store can't do that, or while the change stream is down,
+    entries are only trusted for max_staleness seconds, after which they are
+    fetched again. Listings and subtree walks are never cached.
+
+    Attributes:
+        store (BaseMetaStore): The store being cached
+        max_staleness (float): How long an entry is trusted when changes are not followed, in seconds
+        max_entries (int): How many nodes and manifests are kept
+        watching (bool): Whether the changes of the store are being followed
+    """
+
+    _WATCH_RETRY = 5  # seconds between attempts to reopen a broken change stream
+
+    def __init__(self, store: BaseMetaStore, max_staleness: float=5.0, max_entries: int=100000):
+        """
+        Args:
+            store (BaseMetaStore): The store to cache
+            max_staleness (float): How long an entry is trusted when changes are not followed, in seconds
+            max_entries (int): How many nodes and manifests are kept
+        """
+        self.store = store
+        self.max_staleness = max_staleness
+        self.max_entries = max_entries
+        self.watching = False
+        self._lock = threading.RLock()
+        self._nodes = OrderedDict()  # ID -> (fetched at, document, the fields fetched or None for all of them)
+        self._lookups = {}  # (parent ID, name) -> ID
+        self._chunks = OrderedDict()  # file ID -> (fetched at, chunks)
+        self._generation = 0  # bumped by every invalidation, so a fetch racing one is not cached
+
+    def setup(self):
+        self.store.setup()
+        threading.Thread(target=self._follow_changes, daemon=True).start()
+
+    def _follow_changes(self):
+        while True:
+            try:
+                changes = self.store.watch()
+            except NotImplementedError:
+                print("Metadata changes can't be followed, cached entries expire after %s seconds" % self.max_staleness)
+                return
+            except Exception:
+                print(traceback.format_exc())
+                time.sleep(self._WATCH_RETRY)
+                continue
+            # anything may have changed while nobody was listening
+            self.invalidate_all()
+            self.watching = True
+            try:
+                for node_id in changes:
+                    if node_id is None:
+                        self.invalidate_all()
+                    else:
+                        self.invalidate(node_id)
+            except Exception:
+                print(traceback.format_exc())
+            self.watching = False
+            time.sleep(self._WATCH_RETRY)
+
+    def invalidate(self, node_id):
+        """
+        Drop the cached node, child lookup and chunk manifest of a node
+
+        Args:
+            node_id: The ID of the node
+        """
+        with self._lock:
+            self._generation += 1
+            entry = self._nodes.pop(node_id, None)
+            if entry is not None:
+                self._lookups.pop((entry[1]["parent"], entry[1]["name"]), None)
+            self._chunks.pop(node_id, None)
+
+    def invalidate_all(self):
+        """Drop every cached entry"""
+        with self._lock:
+            self._generation += 1
+            self._nodes.clear()
+            self._lookups.clear()
+            self._chunks.clear()
+
+    def _fresh(self, entry) -> bool:
+        return self.watching or time.monotonic() - entry[0] < self.max_staleness
+
+    @staticmethod
+    def _field_names(fields: Optional[dict]):
+        """The names of the fields a projection asks for, None for all of them"""
+        if fields is None:
+            return None
+        return frozenset(field for field, keep in fields.items() if keep and field != "_id")
+
+    @staticmethod
+    def _has_fields(cached, wanted) -> bool:
+        """Whether the fields cached hold every field wanted, details covers details.size"""
+        if cached is None:
+            return True
+        if wanted is None:
+            return False
+        return all(any(".".join(field.split(".")[:i]) in cached for i in range(1, field.count(".") + 2)) for field in wanted)
+
+    @staticmethod
+    def _fetch_fields(fields: Optional[dict]):
+        """The projection to fetch nodes with, parent and name are needed to cache the lookup"""
+        if fields is None:
+            return None
+        return {**fields, "parent": 1, "name": 1}
+
+    def _cached_node(self, node_id, fields: Optional[dict]=None):
+        with self._lock:
+            entry = self._nodes.get(node_id)
+            if entry is None:
+                return None
+            if not self._fresh(entry):
+                self.invalidate(node_id)
+                return None
+            if not self._has_fields(entry[2], self._field_names(fields)):
+                return None
+            self._nodes.move_to_end(node_id)
+            return MemoryMetaStore._copy(entry[1])
+
+    def _cache_node(self, doc: dict, generation: int, fields: Optional[dict]=None):
+        with self._lock:
+            if generation != self._generation:
+                return
+            fetched_at, names = time.monotonic(), self._field_names(fields)
+            doc = MemoryMetaStore._copy(doc)
+            entry = self._nodes.get(doc["_id"])
+            if names is not None and entry is not None and self._fresh(entry):
+                # the fields of both fetches, as old as the older one
+                fetched_at, cached, cached_names = entry
+                for key, value in doc.items():
+                    cached[key] = {**cached[key], **value} if isinstance(value, dict) and isinstance(cached.get(key), dict) else value
+                doc, names = cached, None if cached_names is None else cached_names | names
+            self._nodes[doc["_id"]] = (fetched_at, doc, names)
+            self._lookups[(doc["parent"], doc["name"])] = doc["_id"]
+            while len(self._nodes) > self.max_entries:
+                _, (_, old, _) = self._nodes.popitem(last=False)
+                self._lookups.pop((old["parent"], old["name"]), None)
+
+    def new_id(self):
+        return self.store.new_id()
+
+    def is_migrated(self, name: str) -> bool:
+        return self.store.is_migrated(name)
+
+    def set_migrated(self, name: str):
+        self.store.set_migrated(name)
+
+    def clear(self, root_id):
+        self.store.clear(root_id)
+        self.invalidate_all()
+
+    def get(self, node_id, fields: Optional[dict]=None):
+        doc = self._cached_node(node_id, fields)
+        if doc is not None:
+            return doc
+        generation = self._generation
+        fields = self._fetch_fields(fields)
+        doc = self.store.get(node_id, fields)
+        if doc is not None:
+            self._cache_node(doc, generation, fields)
+        return doc
+
+    def get_child(self, parent_id, name: str, fields: Optional[dict]=None):
+        node_id = self._lookups.get((parent_id, name))
+        if node_id is not None:
+            doc = self._cached_node(node_id, fields)
+            if doc is not None and doc["parent"] == parent_id and doc["name"] == name:
+                return doc
+        generation = self._generation
+        fields = self._fetch_fields(fields)
+        doc = self.store.get_child(parent_id, name, fields)
+        if doc is not None:
+            self._cache_node(doc, generation, fields)
+        return doc
+
+    def resolve(self, root_id, names: list, fields: Optional[dict]=None) -> list:
+        # as far as the cache goes, then the rest of the path in one call to the store
+        nodes = []
+        parent_id = root_id
+        for name in names:
+            node_id = self._lookups.get((parent_id, name))
+            doc = None if node_id is None else self._cached_node(node_id, fields)
+            if doc is None or doc["parent"] != parent_id or doc["name"] != name:
+                break
+            nodes.append(doc)
+            parent_id = doc["_id"]
+        if len(nodes) < len(names):
+            generation = self._generation
+            fields = self._fetch_fields(fields)
+            rest = self.store.resolve(parent_id, names[len(nodes):], fields)
+            for doc in rest:
+                self._cache_node(doc, generation, fields)
+            nodes.extend(rest)
+        return nodes
+
+    def has_children(self, parent_id) -> bool:
+        return self.store.has_children(parent_id)
+
+    def iter_children(self, parent_id, start_after: Optional[str]=None, limit: Optional[int]=None, fields: Optional[dict]=None):
+        return self.store.iter_children(parent_id, start_after, limit, fields)
+
+    def find_children(self, parent_ids: list, fields: Optional[dict]=None, folders_only: bool=False, file_pattern: Optional[str]=None):
+        return self.store.find_children(parent_ids, fields, folders_only, file_pattern)
+
+    def iter_subtree(self, root_id, fields: Optional[dict]=None, folders_only: bool=False, file_pattern: Optional[str]=None, max_depth: Optional[int]=None):
+        return self.store.iter_subtree(root_id, fields, folders_only, file_pattern, max_depth)
+
+    def insert(self, doc: dict):
+        return self.store.insert(doc)
+
+    def insert_many(self, docs: list):
+        self.store.insert_many(docs)
+
+    def update(self, node_id, values: dict):
+        self.store.update(node_id, values)
+        self.invalidate(node_id)
+
+    def inc_usage(self, node_ids: list, size: int, files: int):
+        self.store.inc_usage(node_ids, size, files)
+        for node_id in node_ids:
+            self.invalidate(node_id)
+
+    def set_usage(self, usages: Iterable):
+        usages = list(usages)
+        self.store.set_usage(usages)
+        for node_id, _, _ in usages:
+            self.invalidate(node_id)
+
+    def delete(self, node_ids: list):
+        self.store.delete(node_ids)
+        for node_id in node_ids:
+            self.invalidate(node_id)
+
+    def sum_files(self, parent_ids: list):
+        return self.store.sum_files(parent_ids)
+
+    def write_chunks(self, file_id, chunks: list):
+        self.store.write_chunks(file_id, chunks)
+        self.invalidate(file_id)
+
+    def iter_chunks(self, file_id, start: int=0, stop: Optional[int]=None):
+        with self._lock:
+            entry = self._chunks.get(file_id)
+            if entry is not None and self._fresh(entry):
+                self._chunks.move_to_end(file_id)
+                chunks = entry[1]
+            else:
+                chunks = None
+        if chunks is None:
+            if start != 0 or stop is not None:
+                # a range of a manifest that may be huge, not worth holding
+                yield from self.store.iter_chunks(file_id, start, stop)
+                return
+            generation = self._generation
+            chunks = list(self.store.iter_chunks(file_id))
+            with self._lock:
+                if generation == self._generation:
+                    self._chunks[file_id] = (time.monotonic(), chunks)
+                    while len(self._chunks) > self.max_entries:
+                        self._chunks.popitem(last=False)
+        for c in chunks[start:stop]:
+            yield dict(c)
+
+    def update_chunk_urls(self, file_id, urls: list):
+        self.store.update_chunk_urls(file_id, urls)
+        self.invalidate(file_id)
+
+    def copy_chunks(self, pairs: list):
+        self.store.copy_chunks(pairs)
+        for _, dst_id in pairs:
+            self.invalidate(dst_id)
+
+    def delete_chunks(self, file_ids: list):
+        self.store.delete_chunks(file_ids)
+        for file_id in file_ids:
+            self.invalidate(file_id)
+
+    def query_files(self, *args, **kwargs):
+        return self.store.query_files(*args, **kwargs)
+
+    def iter_pinned(self, *args, **kwargs):
+        return self.store.iter_pinned(*args, **kwargs)
+
+    def parse_id(self, text: str):
+        return self.store.parse_id(text)
+
+    def watch(self):
+        return self.store.watch()
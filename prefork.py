@@ -0,0 +1,166 @@
+import multiprocessing
+import os
+import queue
+import signal
+import socket
+import sys
+import threading
+import time
+import traceback
+from typing import Callable
+
+
+class PreforkSupervisor:
+    """
+    Serve from several worker processes listening on the same port
+
+    Each worker is forked from the supervisor and builds its own server with
+    make_server(index), after the fork, so database clients and threads are never
+    shared between processes. What was loaded before, such as the config and the
+    host key, is inherited instead of loaded again. The servers bind the same
+    address with SO_REUSEPORT and the kernel spreads the connections between them,
+    so the work runs on as many cores as there are workers.
+
+    A worker that dies is started again, after restart_delay seconds doubled for
+    each crash in a row, up to max_restart_delay. Every metrics_interval seconds
+    the workers send the metrics of their ConnectionManager, which the supervisor
+    sums up in metrics and prints when they change. The totals in cumulative carry
+    over the workers that died.
+
+    Attributes:
+        make_server (Callable[[int], BaseSFTPServer]): Builds the server of a worker, with reuse_port set
+        workers (int): The number of worker processes
+        metrics_interval (float): The time between two reports of a worker, in seconds
+        restart_delay (float): The wait before starting a crashed worker again, in seconds
+        max_restart_delay (float): The longest wait before starting a crashed worker again, in seconds
+    """
+
+    cumulative = ("accepted", "rejected_connections", "rejected_sessions", "busy_requests")
+
+    def __init__(
+        self,
+        make_server: Callable,
+        workers: int,
+        metrics_interval: float=10.0,
+        restart_delay: float=1.0,
+        max_restart_delay: float=60.0,
+    ):
+        self.make_server = make_server
+        self.workers = workers
+        self.metrics_interval = metrics_interval
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.restarts = 0
+        self._context = multiprocessing.get_context("fork")
+        self._reports = None
+        self._processes = [None] * workers
+        self._started_at = [0.0] * workers
+        self._crashes = [0] * workers
+        self._start_at = [0.0] * workers  # when a dead worker may be started again
+        self._metrics = {}  # worker index -> the last metrics it sent
+        self._retired = dict.fromkeys(self.cumulative, 0)  # the totals of the workers replaced
+        self._stop = threading.Event()
+
+    @staticmethod
+    def supported() -> bool:
+        """Whether this platform can fork workers that share a port"""
+        return hasattr(os, "fork") and hasattr(socket, "SO_REUSEPORT")
+
+    @property
+    def metrics(self) -> dict:
+        """The metrics of the workers summed up, with the number of workers alive and of restarts"""
+        totals = dict(self._retired)
+        for metrics in self._metrics.values():
+            for key, value in metrics.items():
+                totals[key] = totals.get(key, 0) + value
+        totals["workers"] = sum(1 for process in self._processes if process is not None and process.is_alive())
+        totals["restarts"] = self.restarts
+        return totals
+
+    def _work(self, index: int):
+        """The main function of a worker process"""
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        signal.signal(signal.SIGINT, signal.SIG_IGN)  # the supervisor stops the workers
+        server = self.make_server(index)
+        supervisor = os.getppid()
+
+        def report():
+            while True:
+                time.sleep(self.metrics_interval)
+                if os.getppid() != supervisor:
+                    os._exit(1)  # the supervisor is gone, nobody would restart or stop us
+                self._reports.put((index, os.getpid(), server.manager.metrics))
+
+        threading.Thread(target=report, name="metrics-report", daemon=True).start()
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+
+    def _spawn(self, index: int):
+        process = self._context.Process(target=self._work, args=(index,), name=f"sftp-worker-{index}", daemon=True)
+        process.start()
+        self._processes[index] = process
+        self._started_at[index] = time.monotonic()
+        last = self._metrics.pop(index, {})
+        for key in self.cumulative:
+            self._retired[key] += last.get(key, 0)
+
+    def _check_workers(self):
+        now = time.monotonic()
+        for index, process in enumerate(self._processes):
+            if process.is_alive():
+                continue
+            if self._start_at[index] == 0.0:
+                # just found dead, a worker that ran for a while starts its crash count over
+                if now - self._started_at[index] > self.max_restart_delay:
+                    self._crashes[index] = 0
+                delay = min(self.restart_delay * 2 ** self._crashes[index], self.max_restart_delay)
+                self._crashes[index] += 1
+                self._start_at[index] = now + delay
+                print(f"SFTP worker {index} (pid {process.pid}) exited with code {process.exitcode}, restarting in {delay:.1f}s")
+            elif now >= self._start_at[index]:
+                self._start_at[index] = 0.0
+                self.restarts += 1
+                self._spawn(index)
+
+    def serve_forever(self):
+        """Start the workers, keep them running until stop is called or the process is interrupted"""
+        self._reports = self._context.Queue()
+        for index in range(self.workers):
+            self._spawn(index)
+        printed = None
+        next_print = time.monotonic() + self.metrics_interval
+        try:
+            while not self._stop.is_set():
+                try:
+                    index, pid, metrics = self._reports.get(timeout=0.5)
+                    if self._processes[index] is not None and self._processes[index].pid == pid:
+                        self._metrics[index] = metrics
+                except queue.Empty:
+                    pass
+                except Exception:
+                    print(traceback.format_exc())
+                self._check_workers()
+                if time.monotonic() >= next_print:
+                    next_print = time.monotonic() + self.metrics_interval
+                    metrics = self.metrics
+                    if metrics != printed:
+                        printed = metrics
+                        print("SFTP workers: " + ", ".join(f"{key} {value}" for key, value in metrics.items()))
+        finally:
+            self._shutdown()
+
+    def stop(self):
+        """Make serve_forever stop the workers and return"""
+        self._stop.set()
+
+    def _shutdown(self):
+        for process in self._processes:
+            if process is not None and process.is_alive():
+                process.terminate()
+        for process in self._processes:
+            if process is not None:
+                process.join(5)
+                if process.is_alive():
+                    process.kill()
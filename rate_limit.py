@@ -0,0 +1,226 @@
+import asyncio
+import hashlib
+import os
+import socket
+import threading
+import time
+from typing import Optional
+
+from pymongo import MongoClient
+
+
+class _Bucket:
+    """What Discord told about a rate limit bucket"""
+
+    def __init__(self):
+        self.limit = 1
+        self.remaining = 1
+        self.reset_at = 0.0  # time.monotonic() when the bucket refills
+
+
+class RateLimiter:
+    """
+    Pace the calls made to the Discord API with a bot token
+
+    Calls take a token from a global bucket refilled at rate calls per second,
+    which keeps them under Discord's global limit, and wait on the per-route
+    bucket Discord reports in the X-RateLimit headers of the previous answers. Until
+    a route has answered, one call at a time is made to it. A 429 blocks the route,
+    or every route if it's global, for its Retry-After.
+
+    One limiter is shared by everything in the process using the same token, see
+    shared. With a MongoRateLease, the processes using the token split the rate
+    between them and a global 429 blocks them all.
+
+    Attributes:
+        rate (float): The calls per second allowed for the token, across all processes
+        burst (int): The calls that can be made at once after a quiet period
+        lease (Optional[MongoRateLease]): The lease shared with the other processes
+    """
+
+    probe_timeout = 1.0  # how long the other calls of a route wait for its first answer, in seconds
+    poll_interval = 0.05  # how often a waiting call checks again, answers may free it early
+
+    _shared = {}
+    _shared_lock = threading.Lock()
+
+    def __init__(self, rate: float=45.0, burst: int=5):
+        self.rate = rate
+        self.burst = burst
+        self.lease = None
+        self._share = 1  # the number of processes splitting the rate
+        self._tokens = float(burst)
+        self._filled_at = time.monotonic()
+        self._blocked_until = 0.0
+        self._buckets = {}  # (bucket, major parameter) -> _Bucket
+        self._route_buckets = {}  # route -> bucket hash, as told by Discord
+        self._lock = threading.Lock()
+        self._lease_thread = None
+
+    @classmethod
+    def shared(cls, token: Optional[str]):
+        """
+        Get the limiter of the process for a token
+
+        Args:
+            token (Optional[str]): The bot token
+
+        Returns:
+            RateLimiter: The same limiter for the same token
+        """
+        with cls._shared_lock:
+            if token not in cls._shared:
+                cls._shared[token] = cls()
+            return cls._shared[token]
+
+    def use_lease(self, lease):
+        """
+        Split the rate with the other processes holding the lease, renewed in a daemon thread
+
+        Args:
+            lease (MongoRateLease): The lease
+        """
+        self.lease = lease
+        self._apply_lease()
+        self._lease_thread = threading.Thread(target=self._renew_lease, name="rate-lease", daemon=True)
+        self._lease_thread.start()
+
+    def _renew_lease(self):
+        while True:
+            time.sleep(self.lease.ttl / 3)
+            try:
+                self._apply_lease()
+            except Exception as e:
+                print(f"Renewing the rate limit lease failed: {e}")
+
+    def _apply_lease(self):
+        members, blocked_until = self.lease.renew()
+        with self._lock:
+            self._share = max(1, members)
+            self._blocked_until = max(self._blocked_until, time.monotonic() + blocked_until - time.time())
+
+    def _key(self, route: str, major):
+        return (self._route_buckets.get(route, route), major)
+
+    def reserve(self, route: str, major=None) -> float:
+        """
+        Take the right to make a call now, if it's allowed
+
+        Args:
+            route (str): The route, as its template, such as "GET /channels/{channel_id}/messages/{message_id}"
+            major: The major parameter of the route, the channel ID for channel routes
+
+        Returns:
+            float: 0 if the call can be made, otherwise how long to wait before asking again, in seconds
+        """
+        with self._lock:
+            now = time.monotonic()
+            rate = self.rate / self._share
+            self._tokens = min(float(self.burst), self._tokens + (now - self._filled_at) * rate)
+            self._filled_at = now
+            wait = self._blocked_until - now
+            key = self._key(route, major)
+            bucket = self._buckets.get(key)
+            if bucket is not None and bucket.reset_at <= now:
+                # refilled, until the next answer tells when it resets again
+                bucket.remaining = bucket.limit
+                bucket.reset_at = now + self.probe_timeout
+            if bucket is not None and bucket.remaining <= 0:
+                wait = max(wait, bucket.reset_at - now)
+            if self._tokens < 1:
+                wait = max(wait, (1 - self._tokens) / rate)
+            if wait > 0:
+                return wait
+            self._tokens -= 1
+            if bucket is None:
+                # nothing known about the route yet, this call finds out while the others wait
+                bucket = self._buckets[key] = _Bucket()
+                bucket.reset_at = now + self.probe_timeout
+            bucket.remaining -= 1
+            return 0.0
+
+    async def acquire(self, route: str, major=None):
+        """Wait until a call can be made, see reserve"""
+        while True:
+            wait = self.reserve(route, major)
+            if wait <= 0:
+                return
+            await asyncio.sleep(min(wait, self.poll_interval))
+
+    def update(self, route: str, major, status: int, headers):
+        """
+        Learn the state of the buckets from the answer to a call
+
+        Args:
+            route (str): The route called
+            major: The major parameter of the route
+            status (int): The HTTP status of the answer
+            headers (Mapping): The headers of the answer
+        """
+        block_all = None
+        with self._lock:
+            now = time.monotonic()
+            if headers.get("X-RateLimit-Bucket"):
+                self._route_buckets[route] = headers["X-RateLimit-Bucket"]
+            key = self._key(route, major)
+            if headers.get("X-RateLimit-Remaining") is not None:
+                bucket = self._buckets.setdefault(key, _Bucket())
+                bucket.limit = int(headers.get("X-RateLimit-Limit", bucket.limit))
+                bucket.remaining = int(headers["X-RateLimit-Remaining"])
+                bucket.reset_at = now + float(headers.get("X-RateLimit-Reset-After", 0))
+            elif status != 429 or headers.get("X-RateLimit-Global") == "true":
+                self._buckets.pop(key, None)  # nothing learnt, the next call probes again
+            if status == 429:
+                retry_after = float(headers.get("Retry-After", 1))
+                if headers.get("X-RateLimit-Global") == "true" or headers.get("X-RateLimit-Scope") == "global":
+                    self._blocked_until = max(self._blocked_until, now + retry_after)
+                    block_all = time.time() + retry_after
+                else:
+                    bucket = self._buckets.setdefault(key, _Bucket())
+                    bucket.remaining = 0
+                    bucket.reset_at = max(bucket.reset_at, now + retry_after)
+        if block_all is not None and self.lease is not None:
+            self.lease.block(block_all)
+
+
+class MongoRateLease:
+    """
+    Let the processes using a bot token know about each other through MongoDB
+
+    Each process holds a lease document in the ``rate_leases`` collection, renewed
+    every ttl / 3 seconds, and the processes with a live lease split the rate of the
+    token between them. A process hit by a global 429 records until when, so the
+    others stop too. The token itself is never stored, only a hash of it.
+
+    Attributes:
+        ttl (float): How long a lease lives without being renewed, in seconds
+    """
+
+    def __init__(self, url: str, token: Optional[str], ttl: float=15.0):
+        self.collection = MongoClient(url)["dsdrive"]["rate_leases"]
+        self.key = hashlib.sha256((token or "").encode()).hexdigest()[:16]
+        self.id = f"{socket.gethostname()}:{os.getpid()}:{id(self):x}"
+        self.ttl = ttl
+
+    def renew(self):
+        """
+        Renew the lease of this process
+
+        Returns:
+            members (int): The number of processes holding a live lease, this one included
+            blocked_until (float): Until when every process must stop, as a UNIX timestamp
+        """
+        now = time.time()
+        self.collection.update_one({"_id": self.id}, {"$set": {"key": self.key, "expires": now + self.ttl}}, upsert=True)
+        self.collection.delete_many({"key": self.key, "expires": {"$lt": now}})
+        members = self.collection.count_documents({"key": self.key, "expires": {"$gte": now}})
+        block = self.collection.find_one({"_id": "block:" + self.key})
+        return members, block["until"] if block else 0.0
+
+    def block(self, until: float):
+        """Stop every process until a time, as a UNIX timestamp"""
+        self.collection.update_one({"_id": "block:" + self.key}, {"$max": {"until": until}}, upsert=True)
+
+    def release(self):
+        """Drop the lease of this process, the others get its share"""
+        self.collection.delete_one({"_id": self.id})
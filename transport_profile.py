@@ -0,0 +1,144 @@
+from typing import Optional
+
+import paramiko
+from paramiko.common import MIN_PACKET_SIZE
+
+
+class TransportProfile:
+    """
+    The SSH algorithms and flow control of the connections made to a listener
+
+    Algorithms are listed in the order of preference, although the client's order
+    decides among the ones both sides offer. None keeps the ones paramiko offers by
+    default. Names the installed paramiko doesn't know are left out with a warning,
+    so a profile written for a newer paramiko still loads.
+
+    Compression costs CPU on every packet and gains nothing on media that is
+    compressed already, it's only offered when enabled.
+
+    Attributes:
+        name (str): The name of the profile
+        ciphers (Optional[tuple]): The ciphers offered
+        macs (Optional[tuple]): The MACs offered
+        kex (Optional[tuple]): The key exchange algorithms offered
+        compression (bool): Whether zlib compression is offered
+        window_size (int): The bytes a client may send on a channel before waiting for us
+        max_packet_size (int): The largest SSH packet a client may send us
+        rekey_bytes (Optional[int]): The bytes sent or received before the keys are renegotiated, None for paramiko's
+        rekey_packets (Optional[int]): The packets sent or received before the keys are renegotiated, None for paramiko's
+    """
+
+    def __init__(
+        self,
+        name: str="default",
+        ciphers: Optional[list]=None,
+        macs: Optional[list]=None,
+        kex: Optional[list]=None,
+        compression: bool=False,
+        window_size: int=8 << 20,
+        max_packet_size: int=128 << 10,
+        rekey_bytes: Optional[int]=None,
+        rekey_packets: Optional[int]=None,
+    ):
+        if max_packet_size < MIN_PACKET_SIZE or window_size < max_packet_size:
+            raise ValueError(f"Transport profile {name}: MaxPacketSize must be at least {MIN_PACKET_SIZE} and WindowSize at least MaxPacketSize")
+        self.name = name
+        self.ciphers = self._known(name, "cipher", ciphers, paramiko.Transport._cipher_info)
+        self.macs = self._known(name, "MAC", macs, paramiko.Transport._mac_info)
+        self.kex = self._known(name, "kex", kex, paramiko.Transport._kex_info)
+        self.compression = compression
+        self.window_size = window_size
+        self.max_packet_size = max_packet_size
+        self.rekey_bytes = rekey_bytes
+        self.rekey_packets = rekey_packets
+
+    @staticmethod
+    def _known(name: str, kind: str, names: Optional[list], known: dict) -> Optional[tuple]:
+        if names is None:
+            return None
+        unknown = [n for n in names if n not in known]
+        if unknown:
+            print(f"Transport profile {name}: {kind} {', '.join(unknown)} not supported by this paramiko, left out")
+        names = tuple(n for n in names if n in known)
+        if not names:
+            raise ValueError(f"Transport profile {name}: no supported {kind} left")
+        return names
+
+    @classmethod
+    def from_config(cls, name: str, config: dict):
+        """
+        Build a profile from its section of the config file
+
+        Args:
+            name (str): The name of the profile
+            config (dict): The CamelCase keys of the profile, the missing ones take the defaults
+
+        Returns:
+            TransportProfile: The profile
+        """
+        keys = {
+            "Ciphers": "ciphers", "MACs": "macs", "Kex": "kex", "Compression": "compression",
+            "WindowSize": "window_size", "MaxPacketSize": "max_packet_size",
+            "RekeyBytes": "rekey_bytes", "RekeyPackets": "rekey_packets",
+        }
+        unknown = set(config) - set(keys)
+        if unknown:
+            raise ValueError(f"Transport profile {name}: unknown keys {', '.join(sorted(unknown))}")
+        return cls(name, **{keys[k]: v for k, v in config.items()})
+
+    def transport_options(self) -> dict:
+        """The keyword arguments of paramiko.Transport for this profile"""
+        return {"default_window_size": self.window_size, "default_max_packet_size": self.max_packet_size}
+
+    def apply(self, transport: paramiko.Transport):
+        """
+        Set the algorithms and rekey thresholds of a transport, before it starts
+
+        Args:
+            transport (paramiko.Transport): The transport, built with transport_options
+        """
+        so = transport.get_security_options()
+        if self.ciphers is not None:
+            so.ciphers = self.ciphers
+        if self.macs is not None:
+            so.digests = self.macs
+        if self.kex is not None:
+            so.kex = self.kex
+        so.compression = ("zlib@openssh.com", "zlib", "none") if self.compression else ("none",)
+        if self.rekey_bytes is not None:
+            transport.packetizer.REKEY_BYTES = self.rekey_bytes
+        if self.rekey_packets is not None:
+            transport.packetizer.REKEY_PACKETS = self.rekey_packets
+
+
+# Built in profiles, the config file may override them and add others
+TRANSPORT_PROFILES = {
+    # AEAD ciphers first, they spare the separate MAC pass, then encrypt-then-MAC
+    "default": TransportProfile(
+        "default",
+        ciphers=["aes128-gcm@openssh.com", "aes256-gcm@openssh.com", "aes128-ctr", "aes256-ctr"],
+        macs=["hmac-sha2-256-etm@openssh.com", "hmac-sha2-512-etm@openssh.com", "hmac-sha2-256", "hmac-sha2-512"],
+    ),
+    # what the server offered before profiles, for old clients
+    "compat": TransportProfile(
+        "compat",
+        macs=["hmac-sha1"],
+        compression=True,
+    ),
+}
+
+
+def make_profiles(config: Optional[dict]=None) -> dict:
+    """
+    Build the transport profiles, the built in ones overridden by the config file
+
+    Args:
+        config (Optional[dict]): The TransportProfiles section of the config file, by name
+
+    Returns:
+        dict: name -> TransportProfile
+    """
+    profiles = dict(TRANSPORT_PROFILES)
+    for name, profile_config in (config or {}).items():
+        profiles[name] = TransportProfile.from_config(name, profile_config or {})
+    return profiles
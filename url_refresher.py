@@ -0,0 +1,178 @@
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from typing import Optional
+
+from dsurl import DSUrl, BaseExpirePolicy
+
+
+_EXPIRE_FIELDS = {"type": 1, "url_expire": 1}
+
+
+class UrlRefresher:
+    """
+    Renew the CDN URLs of hot files in the background, so that reading them never waits on renewal
+
+    Hot files are the files read recently by this process, and the pinned files.
+    Once the earliest URL of a hot file expires in less than lead_time, the URLs
+    expiring by then are renewed and stored, the earliest to expire first. The
+    pinned files are found through an index on their earliest expiry, the recent
+    ones are remembered in memory with the expiry seen when they were read.
+
+    Each URL renewed is one call to the Discord API, and no more than budget calls
+    are spent per minute on average. The files that don't fit wait for the next
+    round and are counted in the backlog.
+
+    Attributes:
+        dsdrive (DSdriveApiWebhook): The DSdriveApi whose files are renewed
+        policy (BaseExpirePolicy): The expire policy renewing the URLs
+        lead_time (float): How long before a URL expires it's renewed, in seconds
+        interval (float): The time between two rounds, in seconds
+        budget (int): The number of URLs renewed per minute at most
+        recent_time (float): How long a file stays hot after it was read, in seconds
+        max_recent (int): The number of recent files remembered at most
+        pinned (bool): Whether the pinned files are renewed, one process is enough when several share the files
+        metrics (dict): Counters about the work done and left, see run_once
+    """
+
+    def __init__(
+        self,
+        dsdrive,
+        policy: BaseExpirePolicy,
+        lead_time: float=3600.0,
+        interval: float=60.0,
+        budget: int=600,
+        recent_time: float=86400.0,
+        max_recent: int=10000,
+        pinned: bool=True,
+    ):
+        self.dsdrive = dsdrive
+        self.policy = policy
+        self.lead_time = lead_time
+        self.interval = interval
+        self.budget = budget
+        self.recent_time = recent_time
+        self.max_recent = max_recent
+        self.pinned = pinned
+        self.metrics = {
+            "hot_files": 0,
+            "due_files": 0,
+            "backlog_files": 0,
+            "renewed_files": 0,
+            "renewed_urls": 0,
+            "errors": 0,
+            "tokens": float(budget),
+            "last_run": None,
+        }
+        self._recent = OrderedDict()  # file ID -> (read at, earliest expire)
+        self._lock = threading.Lock()
+        self._tokens = float(budget)
+        self._filled_at = time.monotonic()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def touch(self, file_id, url_expire: Optional[float]):
+        """
+        Remember that a file was just read
+
+        Args:
+            file_id (ObjectId): The ID of the file
+            url_expire (Optional[float]): The earliest expire timestamp of its URLs, None if it has no chunk
+        """
+        if url_expire is None:
+            return
+        with self._lock:
+            self._recent[file_id] = (time.time(), url_expire)
+            self._recent.move_to_end(file_id)
+            while len(self._recent) > self.max_recent:
+                self._recent.popitem(last=False)
+
+    def start(self):
+        """Start renewing in a daemon thread"""
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="url-refresher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the thread, after the file being renewed"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                metrics = self.run_once()
+                if metrics["due_files"]:
+                    print(
+                        f"URL refresher: renewed {metrics['renewed_urls']} URLs of {metrics['renewed_files']} files so far, "
+                        f"{metrics['backlog_files']} files waiting for budget"
+                    )
+            except Exception:
+                self.metrics["errors"] += 1
+                print(traceback.format_exc())
+            self._stop.wait(self.interval)
+
+    def _due(self, horizon: float):
+        """The hot files whose earliest URL expires before horizon, as (earliest expire, file ID) sorted"""
+        now = time.time()
+        with self._lock:
+            while self._recent and next(iter(self._recent.values()))[0] < now - self.recent_time:
+                self._recent.popitem(last=False)
+            due = {file_id: expire for file_id, (_, expire) in self._recent.items() if expire < horizon}
+            hot = len(self._recent)
+        if self.pinned:
+            for fn in self.dsdrive.store.iter_pinned(horizon, _EXPIRE_FIELDS):
+                due[fn["_id"]] = fn["url_expire"]
+        self.metrics["hot_files"] = hot
+        return sorted((expire, file_id) for file_id, expire in due.items())
+
+    def run_once(self) -> dict:
+        """
+        Renew the URLs of the hot files that expire within lead_time, as far as the budget allows
+
+        Returns:
+            metrics (dict): hot_files, the recent files remembered; due_files, the hot files
+                to renew this round; backlog_files, the ones left for lack of budget;
+                renewed_files and renewed_urls, the totals since the start; errors, the
+                rounds and files that failed; tokens, the API calls left to spend;
+                last_run, when the round ended
+        """
+        now = time.monotonic()
+        self._tokens = min(float(self.budget), self._tokens + (now - self._filled_at) * self.budget / 60)
+        self._filled_at = now
+        horizon = time.time() + self.lead_time
+        due = self._due(horizon)
+        backlog = len(due)
+        for _, file_id in due:
+            # a file may cost more than what's left, the debt is paid before the next one
+            if self._tokens <= 0:
+                break
+            try:
+                urls = [DSUrl(*c["url"]) for c in self.dsdrive.iter_chunks(file_id)]
+                cost = sum(1 for url in urls if self.policy.is_expired(url, self.lead_time))
+                if cost:
+                    urls = self.dsdrive.renew_file_urls(file_id, self.lead_time, self.policy)
+                    self._tokens -= cost
+                    self.metrics["renewed_files"] += 1
+                    self.metrics["renewed_urls"] += cost
+                url_expire = min((url.expire for url in urls), default=None)
+                with self._lock:
+                    if file_id in self._recent:
+                        if url_expire is None:
+                            del self._recent[file_id]  # removed, or emptied
+                        else:
+                            self._recent[file_id] = (self._recent[file_id][0], url_expire)
+            except Exception:
+                self.metrics["errors"] += 1
+                print(traceback.format_exc())
+            backlog -= 1
+        self.metrics.update(
+            due_files=len(due),
+            backlog_files=backlog,
+            tokens=self._tokens,
+            last_run=time.time(),
+        )
+        return dict(self.metrics)